@@ -0,0 +1,496 @@
+# Offline benchmark of the export stages
+# Runs the exporter outside Blender on a synthetic scene, with the fake
+# bpy module in bench/fakebpy and the stub tools in bench/stubs, and
+# reports time, throughput and peak RSS of every stage. Results can be
+# stored as a baseline, later runs print the difference against it.
+#
+# Usage: python3 bench/exportBench.py [--meshes N] [--materials M]
+#     [--textures K] [--texture-size S] [--mix-depth D] [--grid G] [--frames F] [--save-baseline]
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import math
+import numpy as np
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchDir, "fakebpy"))
+sys.path.insert(1, os.path.join(benchDir, "..", "render_pbrt"))
+
+import bpy
+import syntheticScene
+
+# The add-on loads pbrt first, which imports renderer
+import pbrt
+import animationExport
+import imageIo
+import materialPreview
+import pbrtParser
+import plyConvert
+import meshExport
+import renderer
+import sceneParser
+import sceneParts
+import textureUtil
+import toolchain
+
+STUBS_DIR = os.path.join(benchDir, "stubs")
+BASELINE_PATH = os.path.join(benchDir, "baselines.json")
+
+# Slowdowns above this fraction are flagged, when longer than
+# REGRESSION_MIN_SECONDS so that timer noise on short stages is not
+REGRESSION_THRESHOLD = 0.10
+REGRESSION_MIN_SECONDS = 0.02
+
+# Memory =======================================================================
+
+# Resets the peak RSS of the process, so that every stage reports its own
+# Returns False when the kernel does not support it
+def resetPeakRss():
+    try:
+        f = open("/proc/self/clear_refs", "w")
+        f.write("5")
+        f.close()
+        return True
+    except (IOError, OSError):
+        return False
+
+# Peak RSS in MB, since the last reset when supported
+def peakRssMb():
+    try:
+        f = open("/proc/self/status", "r")
+        for line in f:
+            if line.startswith("VmHWM:"):
+                f.close()
+                return int(line.split()[1]) / 1024.0
+        f.close()
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# Stages =======================================================================
+
+def fileLines(path):
+    f = open(path, "rb")
+    count = sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+    f.close()
+    return count
+
+def dirLines(path, suffix):
+    return sum(fileLines(os.path.join(path, n)) for n in os.listdir(path) if n.endswith(suffix))
+
+def dirBytes(path, prefix):
+    return sum(os.path.getsize(os.path.join(path, n)) for n in os.listdir(path) if n.startswith(prefix))
+
+# Runs fn, which returns (lines, bytes) processed
+# Returns the measurements of the stage
+def measure(name, fn, verbose):
+    resetPeakRss()
+    out = io.StringIO()
+    startWall = time.time()
+    startCpu = time.process_time()
+    if verbose:
+        lines, nBytes = fn()
+    else:
+        with contextlib.redirect_stdout(out):
+            lines, nBytes = fn()
+    wall = time.time() - startWall
+    cpu = time.process_time() - startCpu
+    res = {
+        "seconds": wall,
+        "cpuSeconds": cpu,
+        "lines": lines,
+        "bytes": nBytes,
+        "linesPerSecond": lines / wall if wall > 0.0 else 0.0,
+        "mbPerSecond": nBytes / (1024.0 * 1024.0) / wall if wall > 0.0 else 0.0,
+        "peakRssMb": peakRssMb()
+    }
+    return name, res
+
+def freshDir(root, name):
+    path = os.path.join(root, name)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    return path
+
+def runStages(args, root, verbose):
+    texDir = freshDir(root, "textures")
+    sceneDir = freshDir(root, "scene")
+    scene = syntheticScene.createScene(sceneDir, texDir, args.meshes, args.materials,
+        args.textures, args.mix_depth, args.grid, args.texture_size)
+    engine = renderer.IILERenderEngine()
+    results = []
+    toolchain.globalToolchain = toolchain.Toolchain(os.path.join(root, "toolchain_cache.json"))
+
+    # obj2pbrt output for the legacy path
+    expPath = os.path.join(root, "exp.pbrt")
+    syntheticScene.writeObj2PbrtScene(expPath, scene)
+
+    # Geometry ----------------------------------------------------------------
+    geoDir = freshDir(root, "geometry")
+    results.append(measure("geometry native", lambda: (
+        sum(b.lineCount() for b in meshExport.exportGeometry(scene, geoDir, False)),
+        dirBytes(geoDir, "geo_")), verbose))
+
+    # Fill the cache, then measure an unchanged scene
+    with contextlib.redirect_stdout(io.StringIO()):
+        meshExport.exportGeometry(scene, geoDir, True)
+    results.append(measure("geometry native, cached", lambda: (
+        sum(b.lineCount() for b in meshExport.exportGeometry(scene, geoDir, True)),
+        dirBytes(geoDir, "geo_")), verbose))
+
+    plyDir = freshDir(root, "toply")
+    exp2Path = os.path.join(plyDir, "exp2.pbrt")
+    def toply():
+        plyConvert.convertToPly(expPath, exp2Path, plyDir)
+        return fileLines(expPath), os.path.getsize(expPath)
+    results.append(measure("toply conversion", toply, verbose))
+
+    def parse():
+        for block in pbrtParser.iterSceneBlocks(exp2Path):
+            block.isAreaLightSource()
+        return fileLines(exp2Path), os.path.getsize(exp2Path)
+    results.append(measure("parse exp2", parse, verbose))
+
+    # Materials and textures ----------------------------------------------------
+    matDir = freshDir(root, "materials")
+    textureUtil.beginTextures(matDir)
+    materialBlocks = []
+    def materials():
+        materialBlocks.extend(renderer.createMaterialBlocks(engine, matDir, meshExport.collectGeometryObjects(scene)))
+        text = "\n".join(b.toString() for b in materialBlocks)
+        return text.count("\n") + 1, len(text)
+    results.append(measure("materials", materials, verbose))
+
+    def stageTextures():
+        store = textureUtil.globalTextureStore
+        errors = textureUtil.waitTextures()
+        if len(errors) > 0:
+            raise Exception("\n".join(errors))
+        nBytes = sum(e["size"] for e in store.entries.values())
+        textureUtil.endTextures()
+        return len(store.entries), nBytes
+    results.append(measure("textures", stageTextures, verbose))
+
+    # Unchanged materials, the blocks come from the cache filled above
+    def materialsCached():
+        textureUtil.beginTextures(matDir)
+        blocks = renderer.createMaterialBlocks(engine, matDir, meshExport.collectGeometryObjects(scene))
+        errors = textureUtil.waitTextures()
+        textureUtil.endTextures()
+        text = "\n".join(b.toString() for b in blocks)
+        if len(errors) > 0 or text != "\n".join(b.toString() for b in materialBlocks):
+            raise Exception("Cached material blocks differ from the generated ones")
+        return text.count("\n") + 1, len(text)
+    results.append(measure("materials, cached", materialsCached, verbose))
+
+    # Preview at a quarter of the texture size, then again with the
+    # proxies already in the store
+    proxyDir = freshDir(root, "proxies")
+    proxySize = max(args.texture_size // 4, 1)
+    def proxies():
+        textureUtil.beginTextures(proxyDir, proxySize=proxySize)
+        renderer.createMaterialBlocks(engine, proxyDir, meshExport.collectGeometryObjects(scene), False)
+        store = textureUtil.globalTextureStore
+        errors = textureUtil.waitTextures()
+        textureUtil.endTextures()
+        if len(errors) > 0:
+            raise Exception("\n".join(errors))
+        for name in store.jobs:
+            height, width = imageIo.readPng(os.path.join(proxyDir, name)).shape[:2]
+            if max(width, height) > proxySize:
+                raise Exception("Proxy {} is {}x{}".format(name, width, height))
+        return len(store.jobs), dirBytes(proxyDir, "tex_")
+    results.append(measure("texture proxies", proxies, verbose))
+    results.append(measure("texture proxies, cached", proxies, verbose))
+
+    # Textures pbrt has to resample and convert at load: odd sizes, half
+    # of them 16 bit. Loading is timed with the readers of imageIo, plus
+    # the power of two resampling pbrt does for the originals
+    oddDir = freshDir(root, "odd_textures")
+    oddSize = args.texture_size + args.texture_size // 2 + 1
+    oddTextures = []
+    for i in range(max(args.textures // 4, 2)):
+        path = os.path.join(oddDir, "odd_{:03d}.png".format(i))
+        syntheticScene.writePng(path, oddSize, i, 16 if i % 2 == 1 else 8)
+        oddTextures.append(path)
+    preparedDir = freshDir(root, "prepared")
+    prepared = []
+    def prepareTextures():
+        del prepared[:]
+        textureUtil.beginTextures(preparedDir, normalize=True)
+        store = textureUtil.globalTextureStore
+        for path in oddTextures:
+            prepared.append(os.path.join(preparedDir, store.stage(path)))
+        errors = textureUtil.waitTextures()
+        textureUtil.endTextures()
+        if len(errors) > 0:
+            raise Exception("\n".join(errors))
+        return len(prepared), dirBytes(preparedDir, "tex_")
+    results.append(measure("prepare textures", prepareTextures, verbose))
+    results.append(measure("prepare textures, cached", prepareTextures, verbose))
+
+    def loadTextures(paths):
+        nBytes = 0
+        for path in paths:
+            pixels = imageIo.readImage(path)
+            height, width = pixels.shape[:2]
+            potWidth = textureUtil.roundUpPow2(width)
+            potHeight = textureUtil.roundUpPow2(height)
+            if (potWidth, potHeight) != (width, height):
+                pixels = imageIo.resize(pixels, potWidth, potHeight)
+            nBytes += os.path.getsize(path)
+        return len(paths), nBytes
+    results.append(measure("texture load, original", lambda: loadTextures(oddTextures), verbose))
+    results.append(measure("texture load, prepared", lambda: loadTextures(prepared), verbose))
+
+    # Scene write ---------------------------------------------------------------
+    outPath = os.path.join(matDir, "scene.pbrt")
+    def writeScene():
+        weBlock = sceneParser.SceneBlock([])
+        weBlock.appendLine(0, "WorldEnd")
+        stages = [renderer.setAreaLightEmission, renderer.stripNamedMaterial]
+        sceneParser.writeBlocks(outPath, itertools.chain(
+            materialBlocks,
+            sceneParser.pipeline(pbrtParser.iterSceneBlocks(exp2Path), stages),
+            [weBlock]))
+        return fileLines(outPath), os.path.getsize(outPath)
+    results.append(measure("write scene", writeScene, verbose))
+
+    # End to end ----------------------------------------------------------------
+    os.environ["PBRT_BENCH_OBJ2PBRT_SCENE"] = expPath
+    bpy.app.binary_path = os.path.join(STUBS_DIR, "blender")
+    scene.iilePath = STUBS_DIR
+    for mode in ("NATIVE", "OBJ"):
+        renderDir = freshDir(root, "render_" + mode.lower())
+        scene.render.filepath = renderDir
+        scene.iileGeometryExport = mode
+        renderPath = os.path.join(renderDir, "scene.pbrt")
+        def render():
+            engine.render(scene)
+            return sceneSize(renderDir)
+        results.append(measure("render {}".format(mode.lower()), render, verbose))
+        checkScene(renderPath)
+
+    # Only the camera part is written again
+    location = scene.camera.location
+    scene.camera.location = (location[0] + 1.0, location[1], location[2])
+    def writtenParts():
+        engine.render(scene)
+        record = [r for r in engine.profile.stages if r["name"] == "write scene"][0]
+        paths = [os.path.join(renderDir, name) for name in record["written"]]
+        return sum(fileLines(p) for p in paths), sum(os.path.getsize(p) for p in paths)
+    results.append(measure("render obj, camera moved", writtenParts, verbose))
+    scene.camera.location = location
+    checkScene(renderPath)
+
+    # One scene file per selected camera, sharing the other parts
+    renderDir = freshDir(root, "render_batch")
+    scene.render.filepath = renderDir
+    scene.iileGeometryExport = "NATIVE"
+    scene.iileCameraBatch = True
+    cameras = []
+    for i in range(args.cameras):
+        camera = syntheticScene.FakeCamera("Turntable {}".format(i + 1),
+            (8.0 * math.sin(i * 2.0 * math.pi / args.cameras), -8.0 * math.cos(i * 2.0 * math.pi / args.cameras), 4.0))
+        camera.select = True
+        cameras.append(camera)
+    scene.objects.extend(cameras)
+    def renderBatch():
+        engine.render(scene)
+        return dirLines(renderDir, ".pbrt"), dirBytes(renderDir, "")
+    results.append(measure("render batch, {} cameras".format(args.cameras), renderBatch, verbose))
+    del scene.objects[-len(cameras):]
+    scene.iileCameraBatch = False
+    for stem in sceneParts.batchStems([camera.name for camera in cameras]):
+        checkScene(os.path.join(renderDir, sceneParts.batchSceneName(stem)))
+
+    # Frame range, static geometry shared by all frames
+    renderDir = freshDir(root, "render_animation")
+    scene.render.filepath = renderDir
+    scene.iileGeometryExport = "NATIVE"
+    scene.iileExportAnimation = True
+    scene.frame_end = scene.frame_start + args.frames - 1
+    framePaths = [os.path.join(renderDir, animationExport.frameSceneName(frame))
+        for frame in animationExport.frameRange(scene)]
+    def renderAnimation():
+        engine.render(scene)
+        return (sum(fileLines(p) for p in framePaths) + fileLines(os.path.join(renderDir, animationExport.STATIC_NAME)),
+            dirBytes(renderDir, ""))
+    results.append(measure("render animation", renderAnimation, verbose))
+    scene.iileExportAnimation = False
+    scene.frame_end = scene.frame_start
+    for p in framePaths:
+        checkScene(p)
+
+    # Image loaded into the render result, rows bottom to top
+    renderDir = freshDir(root, "render_image")
+    scene.render.filepath = renderDir
+    scene.iileRenderImage = True
+    imagePath = os.path.join(renderDir, "scene.pfm")
+    def renderImage():
+        del engine.results[:]
+        engine.render(scene)
+        return scene.render.resolution_y, os.path.getsize(imagePath)
+    results.append(measure("render image", renderImage, verbose))
+    scene.iileRenderImage = False
+    expected = imageIo.toRgba(imageIo.readPfm(imagePath))[::-1].reshape(-1, 4)
+    if not np.array_equal(engine.results[-1].layers[0].passes[0].rect, expected):
+        raise Exception("Render result differs from the pbrt image")
+
+    # Tiles rendered by the stub pbrt must merge into its full frame image
+    renderDir = freshDir(root, "render_tiled")
+    scene.render.filepath = renderDir
+    scene.iileTiledRender = True
+    scene.iileTileSize = 64
+    renderPath = os.path.join(renderDir, "scene.pbrt")
+    imagePath = os.path.join(renderDir, "scene.pfm")
+    def renderTiled():
+        del engine.results[:]
+        engine.render(scene)
+        return scene.render.resolution_y, os.path.getsize(imagePath)
+    results.append(measure("render tiled", renderTiled, verbose))
+    scene.iileTiledRender = False
+    checkScene(renderPath)
+    merged = imageIo.readPfm(imagePath)
+    full = imageIo.readPfm(os.path.join(renderDir, "check.pfm"))
+    if not np.array_equal(merged, full):
+        raise Exception("Merged tiles differ from the full frame render")
+    # Every tile is shown as soon as it is done
+    shown = np.zeros((scene.render.resolution_y, scene.render.resolution_x, 4), dtype=np.float32)
+    for result in engine.results:
+        rect = result.layers[0].passes[0].rect.reshape(result.resolution_y, result.resolution_x, 4)
+        shown[result.y:result.y + result.resolution_y, result.x:result.x + result.resolution_x] = rect
+    if not np.array_equal(shown[::-1], imageIo.toRgba(full)):
+        raise Exception("Tiles shown in the render result differ from the merged image")
+
+    # Material previews with the cached template, then after an edit
+    previewDir = freshDir(root, "preview")
+    materialPreview.globalPreviewRenderer = materialPreview.PreviewRenderer(previewDir)
+    previewMat = bpy.data.materials["mix_{:03d}".format(max(args.mix_depth - 1, 0))] \
+        if args.mix_depth > 0 else bpy.data.materials["mat_0001"]
+    previewScene = bpy.Namespace(
+        name="preview",
+        render=bpy.Namespace(resolution_x=128, resolution_y=128, resolution_percentage=100),
+        objects=[bpy.Namespace(name="preview", hide_render=False, is_visible=lambda s: True,
+            material_slots=[bpy.Namespace(material=previewMat)])])
+    imagePath = os.path.join(previewDir, materialPreview.IMAGE_NAME)
+    def preview():
+        del engine.results[:]
+        engine.is_preview = True
+        try:
+            engine.render(previewScene)
+        finally:
+            engine.is_preview = False
+        if engine.results[-1].layers[0].passes[0].rect is None:
+            raise Exception("Material preview rendered nothing")
+        return fileLines(os.path.join(previewDir, materialPreview.MATERIAL_NAME)), os.path.getsize(imagePath)
+    results.append(measure("material preview", preview, verbose))
+    previewMat.iileMatMixAmount = (0.25, 0.25, 0.25)
+    results.append(measure("material preview, edited", preview, verbose))
+    checkScene(os.path.join(previewDir, materialPreview.TEMPLATE_NAME))
+
+    return results
+
+# Lines and bytes of the scene file and its parts
+def sceneSize(renderDir):
+    paths = [os.path.join(renderDir, name) for name in ("scene.pbrt",
+        sceneParts.CAMERA_NAME, sceneParts.ENVIRONMENT_NAME,
+        sceneParts.MATERIALS_NAME, sceneParts.GEOMETRY_NAME)]
+    return sum(fileLines(p) for p in paths), sum(os.path.getsize(p) for p in paths)
+
+# Runs the stub pbrt on a written scene, which fails on syntax errors
+def checkScene(scenePath):
+    cmd = [sys.executable, os.path.join(STUBS_DIR, "pbrt"),
+        "--outfile", os.path.join(os.path.dirname(scenePath), "check.pfm"), scenePath]
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise Exception("Invalid scene {}: {}".format(scenePath, proc.stderr.decode("utf-8", "replace")))
+
+# Report =======================================================================
+
+def configKey(args):
+    key = "meshes={} materials={} textures={} mixDepth={} grid={}".format(
+        args.meshes, args.materials, args.textures, args.mix_depth, args.grid)
+    # Keys of the baselines saved before the option existed
+    if args.texture_size != 256:
+        key += " textureSize={}".format(args.texture_size)
+    return key
+
+def loadBaselines():
+    if not os.path.exists(BASELINE_PATH):
+        return {}
+    f = open(BASELINE_PATH, "r")
+    baselines = json.load(f)
+    f.close()
+    return baselines
+
+def saveBaseline(key, results):
+    baselines = loadBaselines()
+    baselines[key] = dict(results)
+    f = open(BASELINE_PATH, "w")
+    json.dump(baselines, f, indent=1, sort_keys=True)
+    f.write("\n")
+    f.close()
+
+def formatDiff(current, base):
+    if base is None or base <= 0.0:
+        return ""
+    change = (current - base) / base
+    isRegression = change > REGRESSION_THRESHOLD and current - base > REGRESSION_MIN_SECONDS
+    flag = "  REGRESSION" if isRegression else ""
+    return "{:+.1f}%{}".format(100.0 * change, flag)
+
+def report(results, baseline):
+    print("{:<26} {:>9} {:>12} {:>9} {:>9}  {}".format(
+        "stage", "seconds", "lines/s", "MB/s", "RSS MB", "vs baseline"))
+    for name, res in results:
+        base = baseline.get(name, {})
+        print("{:<26} {:>9.3f} {:>12.0f} {:>9.1f} {:>9.1f}  {}".format(
+            name, res["seconds"], res["linesPerSecond"], res["mbPerSecond"], res["peakRssMb"],
+            formatDiff(res["seconds"], base.get("seconds"))))
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline export benchmark")
+    parser.add_argument("--meshes", type=int, default=200)
+    parser.add_argument("--materials", type=int, default=40)
+    parser.add_argument("--textures", type=int, default=16)
+    parser.add_argument("--texture-size", type=int, default=256)
+    parser.add_argument("--mix-depth", type=int, default=8)
+    parser.add_argument("--grid", type=int, default=32, help="quads per mesh side")
+    parser.add_argument("--frames", type=int, default=10, help="frames of the animation stage")
+    parser.add_argument("--cameras", type=int, default=8, help="cameras of the batch stage")
+    parser.add_argument("--save-baseline", action="store_true",
+        help="store the results as the baseline of this configuration")
+    parser.add_argument("--keep", action="store_true", help="keep the generated files")
+    parser.add_argument("--verbose", action="store_true", help="show the exporter output")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="pbrt_bench_")
+    try:
+        results = runStages(args, root, args.verbose)
+    finally:
+        if args.keep:
+            print("Files kept in {}".format(root))
+        else:
+            shutil.rmtree(root)
+
+    key = configKey(args)
+    print(key)
+    report(results, loadBaselines().get(key, {}))
+    if args.save_baseline:
+        saveBaseline(key, results)
+        print("Baseline saved to {}".format(BASELINE_PATH))
+
+if __name__ == "__main__":
+    main()
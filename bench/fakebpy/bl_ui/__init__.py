@@ -0,0 +1,25 @@
+# UI modules imported by pbrt.py, only the names it uses at import time
+
+class _Panel():
+    COMPAT_ENGINES = set()
+
+class _Module():
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+properties_render = _Module(
+    RenderButtonsPanel=_Panel,
+    RENDER_PT_output=type("RENDER_PT_output", (_Panel,), {"COMPAT_ENGINES": set()}),
+    RENDER_PT_dimensions=type("RENDER_PT_dimensions", (_Panel,), {"COMPAT_ENGINES": set()})
+)
+properties_material = _Module(
+    MaterialButtonsPanel=_Panel,
+    MATERIAL_PT_context_material=type("MATERIAL_PT_context_material", (_Panel,), {"COMPAT_ENGINES": set()})
+)
+properties_data_camera = _Module(
+    DATA_PT_lens=type("DATA_PT_lens", (_Panel,), {"COMPAT_ENGINES": set()})
+)
+properties_world = _Module(
+    WorldButtonsPanel=_Panel
+)
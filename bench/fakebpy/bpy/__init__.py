@@ -0,0 +1,49 @@
+# Minimal stand-in for the Blender Python API
+# Implements only what the exporter uses, so that it can run outside
+# Blender in the benchmarks. Scenes are built by bench/syntheticScene.py
+
+import collections
+
+from . import path
+from . import props
+from . import types
+from . import utils
+
+class Namespace():
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+# Datablocks by name, in creation order
+class Collection(collections.OrderedDict):
+
+    def add(self, item):
+        self[item.name] = item
+        return item
+
+    def remove(self, item):
+        if self.get(item.name) is item:
+            del self[item.name]
+
+data = Namespace(
+    filepath="",
+    materials=Collection(),
+    meshes=Collection(),
+    objects=Collection(),
+    cameras=Collection(),
+    images=Collection(),
+    scenes=Collection(),
+    worlds=Collection()
+)
+
+context = Namespace(scene=None)
+
+app = Namespace(binary_path="blender", version=(2, 79, 0))
+
+# Empties all datablocks
+def reset():
+    for collection in data.__dict__.values():
+        if isinstance(collection, Collection):
+            collection.clear()
+    data.filepath = ""
+    context.scene = None
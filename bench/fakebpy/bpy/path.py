@@ -0,0 +1,8 @@
+import os
+
+# Blender paths starting with // are relative to the .blend file
+def abspath(p):
+    import bpy
+    if p.startswith("//"):
+        return os.path.join(os.path.dirname(bpy.data.filepath), p[2:])
+    return p
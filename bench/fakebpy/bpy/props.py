@@ -0,0 +1,12 @@
+# Property definitions are not evaluated, fake datablocks
+# carry their values as plain attributes
+
+def _property(**kwargs):
+    return kwargs
+
+BoolProperty = _property
+EnumProperty = _property
+FloatProperty = _property
+FloatVectorProperty = _property
+IntProperty = _property
+StringProperty = _property
@@ -0,0 +1,67 @@
+class RenderPass():
+
+    def __init__(self, name):
+        self.name = name
+        self.rect = None
+
+class RenderLayer():
+
+    def __init__(self):
+        self.passes = [RenderPass("Combined")]
+
+class RenderResult():
+
+    def __init__(self, x, y, w, h):
+        self.x = x
+        self.y = y
+        self.resolution_x = w
+        self.resolution_y = h
+        self.layers = [RenderLayer()]
+
+class RenderEngine():
+
+    is_preview = False
+
+    def __init__(self):
+        self.reports = []
+        self.results = []
+
+    def report(self, level, message):
+        self.reports.append((level, message))
+        print("{}: {}".format(", ".join(sorted(level)), message))
+
+    def begin_result(self, x, y, w, h, layer="", view=""):
+        return RenderResult(x, y, w, h)
+
+    def update_result(self, result):
+        pass
+
+    def end_result(self, result, cancel=False, highlight=False, do_merge_results=False):
+        self.results.append(result)
+
+    def update_progress(self, progress):
+        pass
+
+    def update_stats(self, stats, info):
+        pass
+
+    def test_break(self):
+        return False
+
+class Panel():
+    pass
+
+class Menu():
+    pass
+
+class Scene():
+    pass
+
+class World():
+    pass
+
+class Material():
+    pass
+
+class Object():
+    pass
@@ -0,0 +1,15 @@
+import os
+import tempfile
+
+def register_class(cls):
+    pass
+
+def unregister_class(cls):
+    pass
+
+# Blender user directories, in the temp directory
+def user_resource(resource_type, path="", create=False):
+    target = os.path.join(tempfile.gettempdir(), "fakebpy_" + resource_type.lower(), path)
+    if create and not os.path.isdir(target):
+        os.makedirs(target)
+    return target
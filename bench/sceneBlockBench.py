@@ -0,0 +1,255 @@
+# Micro-benchmark of sceneParser.SceneBlock against the original
+# list based implementation, on a generated scene of about a million lines
+#
+# A randomized equivalence check of the two runs first
+#
+# Usage: python3 bench/sceneBlockBench.py [lines]
+
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "render_pbrt"))
+
+import sceneParser
+
+# Original implementation ======================================================
+
+def legacyLineIndentTabs(l):
+    count = 0
+    for c in l:
+        if c == ' ':
+            count += 1
+        else:
+            break
+    if (count % sceneParser.TABSIZE) != 0:
+        return 0
+    return count / sceneParser.TABSIZE
+
+def legacyIndentBy(l, levels):
+    idt = ""
+    for i in range(sceneParser.TABSIZE * levels):
+        idt += " "
+    return idt + l
+
+class LegacySceneBlock():
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def toString(self):
+        return "\n".join(self.lines)
+
+    def getBlockType(self):
+        if len(self.lines) == 0:
+            return None
+        first = self.lines[0]
+        splt = first.split(" ")
+        if len(splt) != 0:
+            return splt[0]
+        else:
+            return None
+
+    def replaceLine(self, level, startMatch, newStr):
+        for i in range(len(self.lines)):
+            l = self.lines[i]
+            if legacyLineIndentTabs(l) == level:
+                rawLine = l[(sceneParser.TABSIZE * level):]
+                if rawLine.startswith(startMatch):
+                    self.lines[i] = legacyIndentBy(newStr, level)
+
+    def contains(self, level, startMatch):
+        for i in range(len(self.lines)):
+            l = self.lines[i]
+            if legacyLineIndentTabs(l) == level:
+                rawLine = l[(sceneParser.TABSIZE * level):]
+                if rawLine.startswith(startMatch):
+                    return True
+        return False
+
+    def findLine(self, level, startMatch):
+        for i in range(len(self.lines)):
+            l = self.lines[i]
+            if legacyLineIndentTabs(l) == level:
+                rawLine = l[(sceneParser.TABSIZE * level):]
+                if rawLine.startswith(startMatch):
+                    return rawLine
+        return None
+
+    def isAreaLightSource(self):
+        return (self.getBlockType() == "AttributeBegin") and (self.contains(1, "AreaLightSource"))
+
+    def isMakeNamedMaterial(self):
+        return self.getBlockType() == "MakeNamedMaterial"
+
+    def getAssignedMaterial(self):
+        line = self.findLine(1, "NamedMaterial")
+        return " ".join(line.split(" ")[1:]).replace('"', '')
+
+    def appendLine(self, level, content):
+        self.lines.append(legacyIndentBy(content, level))
+
+    def addBeginning(self, level, content):
+        self.lines = [legacyIndentBy(content, level)] + self.lines
+
+def legacyParse(path):
+    blocks = []
+    current = []
+    f = open(path, "r")
+    for line in f:
+        line = line[:-1]
+        if legacyLineIndentTabs(line) > 0:
+            current.append(line)
+        else:
+            if len(current) > 0:
+                blocks.append(LegacySceneBlock(current))
+            current = [line]
+    if len(current) > 0:
+        blocks.append(LegacySceneBlock(current))
+    f.close()
+    return blocks
+
+# Benchmark ====================================================================
+
+# Writes a pbrt --toply style scene with about lineCount lines
+# Every 10th shape is an area light
+def generateScene(path, lineCount):
+    f = open(path, "w")
+    written = 0
+    i = 0
+    while written < lineCount:
+        f.write('MakeNamedMaterial "mat_{}" \n'.format(i))
+        f.write('        "string type" [ "matte" ]\n')
+        f.write('        "rgb Kd" [ 0.5 0.5 0.5 ]\n')
+        f.write("AttributeBegin\n")
+        f.write('    NamedMaterial "mat_{}"\n'.format(i))
+        written += 5
+        if i % 10 == 0:
+            f.write('    AreaLightSource "diffuse" \n')
+            f.write('            "rgb L" [ 1 1 1 ]\n')
+            written += 2
+        f.write('    Shape "plymesh" "string filename" "mesh_{:05d}.ply" \n'.format(i))
+        f.write("AttributeEnd\n")
+        written += 2
+        i += 1
+    f.close()
+
+# Equivalence check ============================================================
+
+EQUIVALENCE_LINES = [
+    (0, 'AttributeBegin'),
+    (0, 'MakeNamedMaterial "mat_0"'),
+    (0, 'Texture "t0" "color" "imagemap"'),
+    (1, 'NamedMaterial "mat_0"'),
+    (1, 'NamedMaterial "mat_1"'),
+    (1, 'AreaLightSource "diffuse"'),
+    (1, 'Shape "plymesh" "string filename" "mesh_00000.ply"'),
+    (1, '"string type" [ "matte" ]'),
+    (2, '"rgb L" [ 1 1 1 ]'),
+    (2, '"rgb Kd" [ 0.5 0.5 0.5 ]'),
+    (2, '"float roughness" [ 0.1 ]'),
+]
+
+EQUIVALENCE_MATCHES = ["", "A", "AttributeBegin", "MakeNamedMaterial", "Texture", "Named",
+    "NamedMaterial", "AreaLightSource", "Shape", '"', '"rgb', '"rgb L"', '"string type"', '"float']
+
+# Applies the same random operations to a SceneBlock and a LegacySceneBlock
+# and compares them after each one, on blocks below and above the index
+# threshold
+# Raises an Exception on the first difference
+def checkEquivalence(trials, seed=0):
+    rng = random.Random(seed)
+    for trial in range(trials):
+        count = rng.randint(0, 2 * sceneParser.INDEX_MIN_LINES)
+        lines = [sceneParser.indentBy(text, level) for level, text in
+            (rng.choice(EQUIVALENCE_LINES) for i in range(count))]
+        block = sceneParser.SceneBlock(list(lines))
+        legacy = LegacySceneBlock(list(lines))
+        for step in range(20):
+            op = rng.randint(0, 4)
+            level, text = rng.choice(EQUIVALENCE_LINES)
+            match = rng.choice(EQUIVALENCE_MATCHES)
+            if op == 0:
+                block.appendLine(level, text)
+                legacy.appendLine(level, text)
+            elif op == 1:
+                block.addBeginning(level, text)
+                legacy.addBeginning(level, text)
+            else:
+                block.replaceLine(level, match, text)
+                legacy.replaceLine(level, match, text)
+            results = [
+                (block.toString(), legacy.toString()),
+                (block.getBlockType(), legacy.getBlockType()),
+                (block.isAreaLightSource(), legacy.isAreaLightSource()),
+                (block.isMakeNamedMaterial(), legacy.isMakeNamedMaterial()),
+                (block.contains(level, match), legacy.contains(level, match)),
+                (block.findLine(level, match), legacy.findLine(level, match)),
+            ]
+            for current, expected in results:
+                if current != expected:
+                    raise Exception("Trial {} step {}: got {!r}, expected {!r}".format(
+                        trial, step, current, expected))
+    return trials
+
+def timed(label, fn):
+    start = time.time()
+    res = fn()
+    print("{:<40} {:8.3f}s".format(label, time.time() - start))
+    return res
+
+def transform(blocks):
+    count = 0
+    for b in blocks:
+        if b.isAreaLightSource():
+            b.getAssignedMaterial()
+            b.replaceLine(3, '"rgb L"', '"rgb L" [ 9 9 9 ]')
+            count += 1
+        b.isMakeNamedMaterial()
+    return count
+
+def prepend(blockClass, count):
+    b = blockClass([])
+    b.appendLine(0, 'MakeNamedMaterial "big"')
+    for i in range(count):
+        b.addBeginning(0, 'Texture "t{}" "color" "imagemap"'.format(i))
+    return b
+
+def runSuite(label, path, parse, blockClass):
+    print("-- {}".format(label))
+    blocks = timed("parse", lambda: parse(path))
+    timed("area lights + material blocks", lambda: transform(blocks))
+    timed("toString", lambda: [b.toString() for b in blocks])
+    timed("prepend 20000 lines", lambda: prepend(blockClass, 20000))
+
+def main():
+    lineCount = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    timed("equivalence check, 3000 blocks", lambda: checkEquivalence(3000))
+    tmpDir = tempfile.mkdtemp()
+    path = os.path.join(tmpDir, "scene.pbrt")
+    timed("generate {} lines".format(lineCount), lambda: generateScene(path, lineCount))
+
+    # Each suite releases its blocks before the next one starts,
+    # so both run with the same heap size
+    runSuite("legacy", path, legacyParse, LegacySceneBlock)
+    gc.collect()
+    runSuite("current", path, lambda p: list(sceneParser.iterBlocks(p)), sceneParser.SceneBlock)
+    timed("streamed parse + transform + toString",
+        lambda: [transform([b]) and b.toString() for b in sceneParser.iterBlocks(path)])
+
+    # Unmodified blocks are copied from the source, so the rewrite time
+    # follows the number of edited blocks
+    outPath = os.path.join(tmpDir, "out.pbrt")
+    timed("rewrite, every 10th block edited", lambda: sceneParser.writeBlocks(outPath,
+        (b for b in sceneParser.iterBlocks(path) if transform([b]) >= 0)))
+    timed("rewrite, no edit", lambda: sceneParser.writeBlocks(outPath, sceneParser.iterBlocks(path)))
+    os.remove(outPath)
+
+    os.remove(path)
+    os.rmdir(tmpDir)
+
+if __name__ == "__main__":
+    main()
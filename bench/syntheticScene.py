@@ -0,0 +1,408 @@
+# Synthetic scenes for the benchmarks
+# Fills the fake bpy module with N grid meshes, M materials, K image
+# textures and a chain of nested MIX materials, and writes the matching
+# obj2pbrt output for the legacy geometry path
+
+import math
+import numpy as np
+import os
+import struct
+import zlib
+
+import bpy
+
+BASE_TYPES = ["MATTE", "PLASTIC", "GLASS", "MIRROR"]
+
+# Every EMITTER_EVERY-th mesh uses the emitting material
+EMITTER_EVERY = 25
+
+# Over the frame range every MOVING_EVERY-th mesh translates along X and
+# every DEFORMING_EVERY-th mesh changes shape
+MOVING_EVERY = 10
+DEFORMING_EVERY = 20
+
+Namespace = bpy.Namespace
+
+# Textures ======================================================================
+
+# Filter type of every row, mostly Paeth and Average like the adaptive
+# filtering of libpng on photographs
+PNG_ROW_FILTERS = [4, 4, 3, 4, 1, 4, 3, 2]
+
+# Filters the rows of an (height, width, bpp) byte array with filterTypes
+# Returns the rows with their filter type byte in front
+def filterPngRows(values, filterTypes):
+    height, width, bpp = values.shape
+    cur = values.astype(np.int16)
+    a = np.zeros_like(cur)
+    a[:, 1:] = cur[:, :-1]
+    b = np.zeros_like(cur)
+    b[1:] = cur[:-1]
+    c = np.zeros_like(cur)
+    c[1:, 1:] = cur[:-1, :-1]
+    pa = np.abs(b - c)
+    pb = np.abs(a - c)
+    pc = np.abs(a + b - c - c)
+    paeth = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+    ft = filterTypes.reshape(-1, 1, 1)
+    pred = np.where(ft == 4, paeth, np.where(ft == 3, (a + b) >> 1,
+        np.where(ft == 2, b, np.where(ft == 1, a, 0))))
+    rows = ((cur - pred) & 255).astype(np.uint8).reshape(height, -1)
+    return np.concatenate([filterTypes.reshape(-1, 1).astype(np.uint8), rows], axis=1)
+
+# Writes an 8 or 16 bit RGB PNG with deterministic content
+def writePng(path, size, seed, depth=8):
+    rng = np.random.RandomState(seed)
+    # Smooth gradients with noise, so that filters matter
+    ramp = np.add.outer(np.arange(size), np.arange(size)) * (255.0 / max(2 * size - 2, 1))
+    values = ramp[:, :, None] + rng.randint(0, 32, size=(size, size, 3))
+    if depth == 16:
+        pixels = (values * 257.0).clip(0, 65535).astype(">u2").view(np.uint8)
+    else:
+        pixels = values.clip(0, 255).astype(np.uint8)
+    bpp = 3 * depth // 8
+    filterTypes = np.resize(np.array(PNG_ROW_FILTERS, dtype=np.uint8), size)
+    raw = filterPngRows(pixels.reshape(size, size, bpp), filterTypes)
+
+    def chunk(tag, payload):
+        body = tag + payload
+        return struct.pack(">I", len(payload)) + body + struct.pack(">I", zlib.crc32(body) & 0xffffffff)
+
+    f = open(path, "wb")
+    f.write(b"\x89PNG\r\n\x1a\n")
+    f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, depth, 2, 0, 0, 0)))
+    f.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 1)))
+    f.write(chunk(b"IEND", b""))
+    f.close()
+
+# Meshes ========================================================================
+
+class FakeCollection():
+
+    def __init__(self, **arrays):
+        self.arrays = arrays
+        self.count = len(next(iter(arrays.values())))
+
+    def __len__(self):
+        return self.count
+
+    def foreach_get(self, attr, out):
+        out[:] = self.arrays[attr].ravel()
+
+class FakeMesh():
+
+    def __init__(self, name, co, loopVerts, loopStart, loopTotal, normals, uvs):
+        self.name = name
+        nPolys = len(loopStart)
+        self.vertices = FakeCollection(co=co)
+        self.loops = FakeCollection(vertex_index=loopVerts, normal=normals)
+        self.polygons = FakeCollection(
+            loop_start=loopStart,
+            loop_total=loopTotal,
+            material_index=np.zeros(nPolys, dtype=np.int32),
+            use_smooth=np.ones(nPolys, dtype=bool))
+        self.uv_layers = Namespace(active=Namespace(data=FakeCollection(uv=uvs)))
+
+    def calc_normals_split(self):
+        pass
+
+# A gridSize x gridSize quad grid in the XY plane, with a sine bump
+def gridMesh(name, gridSize, phase):
+    n = gridSize + 1
+    u, v = np.meshgrid(np.linspace(0.0, 1.0, n), np.linspace(0.0, 1.0, n))
+    z = 0.1 * np.sin(6.0 * u + phase) * np.cos(6.0 * v)
+    co = np.stack([u.ravel() - 0.5, v.ravel() - 0.5, z.ravel()], axis=1).astype(np.float32)
+
+    i, j = np.meshgrid(np.arange(gridSize), np.arange(gridSize))
+    first = (j * n + i).ravel()
+    loopVerts = np.stack([first, first + 1, first + n + 1, first + n], axis=1).ravel().astype(np.int32)
+    nPolys = gridSize * gridSize
+    loopStart = (np.arange(nPolys) * 4).astype(np.int32)
+    loopTotal = np.full(nPolys, 4, dtype=np.int32)
+
+    normals = np.zeros((len(loopVerts), 3), dtype=np.float32)
+    normals[:, 2] = 1.0
+    uvs = co[loopVerts, :2] + 0.5
+    return FakeMesh(name, co, loopVerts, loopStart, loopTotal, normals, uvs)
+
+class FakeObject():
+
+    def __init__(self, name, mesh, material, matrix):
+        self.name = name
+        self.type = "MESH"
+        self.data = mesh
+        self.matrix_world = matrix
+        self.material_slots = [Namespace(material=material, name=material.name)]
+        self.modifiers = []
+        self.hide_render = False
+        self.parent = None
+        self.is_duplicator = False
+        self.dupli_type = "NONE"
+
+    def is_visible(self, scene):
+        return True
+
+    def to_mesh(self, scene, applyModifiers, settings):
+        return self.data
+
+# Materials =====================================================================
+
+def createMaterial(name, matType):
+    m = Namespace(
+        name=name,
+        iileMaterial=matType,
+        emit=0.0,
+        iileEmission=(1.0, 1.0, 1.0),
+        iileMatteColor=(0.8, 0.8, 0.8),
+        iileMatteColorTexture="",
+        iilePlasticDiffuseColor=(0.5, 0.2, 0.2),
+        iilePlasticDiffuseTexture="",
+        iilePlasticSpecularColor=(0.2, 0.2, 0.2),
+        iilePlasticSpecularTexture="",
+        iilePlasticRoughnessValue=0.1,
+        iilePlasticRoughnessTexture="",
+        iileMirrorKr=(0.9, 0.9, 0.9),
+        iileMirrorKrTex="",
+        iileMatMixSlot1Val="",
+        iileMatMixSlot2Val="",
+        iileMatMixAmount=(0.5, 0.5, 0.5),
+        iileMatMixAmountTex="",
+        iileMatGlassKr=(1.0, 1.0, 1.0),
+        iileMatGlassKrTex="",
+        iileMatGlassKt=(1.0, 1.0, 1.0),
+        iileMatGlassKtTex="",
+        iileMatGlassIor=1.5,
+        iileMatGlassIorTex="",
+        iileMatGlassURough=0.0,
+        iileMatGlassURoughTex="",
+        iileMatGlassVRough=0.0,
+        iileMatGlassVRoughTex="")
+    return bpy.data.materials.add(m)
+
+# Describes the iile* attributes of the synthetic materials the way
+# Blender describes registered properties
+def materialRna():
+    template = createMaterial("template", "MATTE")
+    bpy.data.materials.remove(template)
+    properties = []
+    for name, value in sorted(template.__dict__.items()):
+        if isinstance(value, str):
+            propType = "ENUM" if name == "iileMaterial" else "STRING"
+            subtype = "FILE_PATH" if name.endswith("Texture") or name.endswith("Tex") else "NONE"
+        else:
+            propType = "FLOAT"
+            subtype = "COLOR" if isinstance(value, tuple) else "NONE"
+        properties.append(Namespace(identifier=name, type=propType, subtype=subtype))
+    return Namespace(properties=properties)
+
+# Scene =========================================================================
+
+class FakeCamera():
+
+    def __init__(self, name, location):
+        self.name = name
+        self.type = "CAMERA"
+        self.data = bpy.data.cameras.add(Namespace(name=name, angle=0.8575))
+        self.select = False
+        self.rotation_mode = "XYZ"
+        self.rotation_axis_angle = [0.5, 1.0, 0.0, 0.0]
+        self.location = location
+        self.material_slots = []
+        self.hide_render = False
+        self.parent = None
+        self.is_duplicator = False
+        self.dupli_type = "NONE"
+
+    def is_visible(self, scene):
+        return True
+
+    # From location and axis angle rotation, unparented
+    @property
+    def matrix_world(self):
+        angle = self.rotation_axis_angle[0]
+        axis = np.array(self.rotation_axis_angle[1:], dtype=np.float64)
+        axis /= np.linalg.norm(axis)
+        cross = np.array([[0.0, -axis[2], axis[1]], [axis[2], 0.0, -axis[0]], [-axis[1], axis[0], 0.0]])
+        m = np.identity(4)
+        m[:3, :3] = np.identity(3) + math.sin(angle) * cross + (1.0 - math.cos(angle)) * np.dot(cross, cross)
+        m[:3, 3] = self.location
+        return m
+
+def createSceneObject(outDir):
+    camera = FakeCamera("Camera", (0.0, -8.0, 4.0))
+
+    world = Namespace(
+        name="World",
+        iileEnvcolor=(0.1, 0.1, 0.1),
+        iileEnvMagnitude=1.0,
+        iileEnvmapPath="",
+        iileEnvmapRotation=0.0)
+
+    render = Namespace(
+        resolution_x=320,
+        resolution_y=240,
+        resolution_percentage=100,
+        filepath=outDir)
+
+    scene = Namespace(
+        name="Scene",
+        render=render,
+        camera=camera,
+        world=world,
+        objects=[],
+        iilePath="",
+        iileGeometryExport="NATIVE",
+        frame_start=1,
+        frame_end=1,
+        frame_step=1,
+        frame_current=1,
+        iileGeometryCache=False,
+        iileMaterialCache=False,
+        iileExportTimeout=30,
+        iileExportAnimation=False,
+        iileCameraBatch=False,
+        iileTextureStoreSize=2048,
+        iileTextureProxies=True,
+        iileTextureNormalize=False,
+        iileLogLevel="WARNING",
+        iileProfileExport=False,
+        iileStartRenderer=False,
+        iileRenderImage=False,
+        iileImageFormat="PFM",
+        iileTiledRender=False,
+        iileTileSize=128,
+        iileRenderExecutor="LOCAL",
+        iileRenderHosts="",
+        iileRenderWorkers=4,
+        iileWorkerThreads=1,
+        iileIntegrator="PATH",
+        iileIntegratorIileIndirect=8,
+        iileIntegratorIileDirect=1,
+        iileIntegratorPathSampler="RANDOM",
+        iileIntegratorPathSamples=16,
+        iileIntegratorBdptMaxdepth=5,
+        iileIntegratorBdptLightsamplestrategy="POWER",
+        iileIntegratorBdptVisualizestrategies=False,
+        iileIntegratorBdptVisualizeweights=False)
+    bpy.data.scenes.add(scene)
+    bpy.context.scene = scene
+    return scene
+
+# Builds the synthetic scene in the fake bpy module
+# Textures are written to texDir, the scene renders to outDir
+# Returns the scene
+def createScene(outDir, texDir, meshCount, materialCount, textureCount,
+        mixDepth, gridSize, textureSize=256):
+    bpy.reset()
+    bpy.data.filepath = os.path.join(texDir, "bench.blend")
+    open(bpy.data.filepath, "a").close()
+    scene = createSceneObject(outDir)
+    bpy.types.Material.bl_rna = materialRna()
+
+    textures = []
+    for i in range(textureCount):
+        path = os.path.join(texDir, "tex_{:04d}.png".format(i))
+        if not os.path.exists(path):
+            writePng(path, textureSize, i)
+        textures.append(path)
+
+    # Base materials, textures assigned round robin
+    materials = []
+    for i in range(materialCount):
+        mat = createMaterial("mat_{:04d}".format(i), BASE_TYPES[i % len(BASE_TYPES)])
+        if len(textures) > 0:
+            tex = textures[i % len(textures)]
+            if mat.iileMaterial == "MATTE":
+                mat.iileMatteColorTexture = tex
+            elif mat.iileMaterial == "PLASTIC":
+                mat.iilePlasticDiffuseTexture = tex
+                mat.iilePlasticRoughnessTexture = textures[(i + 1) % len(textures)]
+        materials.append(mat)
+
+    # Nested MIX chain, each level mixes the previous one with a base material
+    previous = materials[0]
+    for d in range(mixDepth):
+        mix = createMaterial("mix_{:03d}".format(d), "MIX")
+        mix.iileMatMixSlot1Val = previous.name
+        mix.iileMatMixSlot2Val = materials[(d + 1) % len(materials)].name
+        if len(textures) > 0 and d % 2 == 1:
+            mix.iileMatMixAmountTex = textures[d % len(textures)]
+        materials.append(mix)
+        previous = mix
+
+    emitter = createMaterial("emitter", "MATTE")
+    emitter.emit = 5.0
+
+    # Meshes on a square layout
+    side = int(np.ceil(np.sqrt(max(meshCount, 1))))
+    for i in range(meshCount):
+        mesh = bpy.data.meshes.add(gridMesh("mesh_{:05d}".format(i), gridSize, 0.1 * i))
+        if i % EMITTER_EVERY == EMITTER_EVERY - 1:
+            mat = emitter
+        else:
+            mat = materials[i % len(materials)]
+        matrix = np.identity(4)
+        matrix[0, 3] = 1.2 * (i % side)
+        matrix[1, 3] = 1.2 * (i // side)
+        obj = bpy.data.objects.add(FakeObject("obj_{:05d}".format(i), mesh, mat, matrix))
+        obj.baseMatrix = matrix
+        obj.phase = 0.1 * i
+        if i % DEFORMING_EVERY == DEFORMING_EVERY - 2:
+            mesh.shape_keys = Namespace(name="Key")
+        scene.objects.append(obj)
+
+    scene.frame_set = lambda frame: setFrame(scene, frame, gridSize)
+    return scene
+
+# Moves and deforms the animated meshes to frame
+def setFrame(scene, frame, gridSize):
+    scene.frame_current = frame
+    offset = frame - scene.frame_start
+    for i, obj in enumerate(scene.objects):
+        if i % MOVING_EVERY == MOVING_EVERY - 1:
+            matrix = obj.baseMatrix.copy()
+            matrix[0, 3] += 0.1 * offset
+            obj.matrix_world = matrix
+        if i % DEFORMING_EVERY == DEFORMING_EVERY - 2:
+            obj.data = gridMesh(obj.data.name, gridSize, obj.phase + 0.5 * offset)
+            obj.data.shape_keys = Namespace(name="Key")
+
+# obj2pbrt output ===============================================================
+
+def formatArray(values):
+    return " ".join("{:g}".format(v) for v in values.ravel())
+
+# Writes what obj2pbrt produces for the scene: one MakeNamedMaterial per
+# material and one AttributeBegin with a trianglemesh per object
+# Returns the number of lines written
+def writeObj2PbrtScene(path, scene):
+    import meshExport
+    f = open(path, "w")
+    lines = 0
+    for mat in bpy.data.materials.values():
+        f.write('MakeNamedMaterial "{}"\n    "string type" [ "matte" ] "rgb Kd" [ 0.8 0.8 0.8 ]\n'.format(mat.name))
+        lines += 2
+    for obj in scene.objects:
+        arrays = meshExport.MeshArrays(obj.data)
+        m = meshExport.pbrtTransform(obj.matrix_world)
+        for slot, positions, indices, normals, uvs in meshExport.buildSlotMeshes(arrays, m):
+            mat = obj.material_slots[0].material
+            f.write("AttributeBegin\n")
+            f.write('  NamedMaterial "{}"\n'.format(mat.name))
+            lines += 2
+            if mat.emit > 0.0:
+                f.write('  AreaLightSource "diffuse" "rgb L" [ 1 1 1 ]\n')
+                lines += 1
+            f.write('  Shape "trianglemesh"\n')
+            f.write('    "integer indices" [ {} ]\n'.format(formatArray(indices)))
+            f.write('    "point P" [ {} ]\n'.format(formatArray(positions)))
+            if normals is not None:
+                f.write('    "normal N" [ {} ]\n'.format(formatArray(normals)))
+                lines += 1
+            if uvs is not None:
+                f.write('    "float uv" [ {} ]\n'.format(formatArray(uvs)))
+                lines += 1
+            f.write("AttributeEnd\n")
+            lines += 4
+    f.close()
+    return lines
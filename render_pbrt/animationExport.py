@@ -0,0 +1,180 @@
+import collections
+import itertools
+import numpy as np
+import os
+
+import generalUtil
+import geometryCache
+import meshExport
+import sceneParser
+
+log = generalUtil.getLogger(__name__)
+
+# Animation export =============================================================
+# Exports the frame range as one scene file per frame. Objects are sampled
+# over the range first. Geometry that neither moves nor deforms is written
+# once to STATIC_NAME, with the materials and lights, and meshes that only
+# move are defined there as object instances. A frame file holds the
+# camera, an Include of the static file, the instances of moving meshes
+# and the meshes that deform, so the export time follows what moves.
+
+STATIC_NAME = "world_static.pbrt"
+
+def frameSceneName(frame):
+    return "scene_{:04d}.pbrt".format(frame)
+
+def frameImageName(frame):
+    return "scene_{:04d}.exr".format(frame)
+
+def frameRange(scene):
+    return range(scene.frame_start, scene.frame_end + 1, max(scene.frame_step, 1))
+
+# Objects whose evaluated mesh can change while their transform does not
+# Only these are evaluated at every frame of the classification
+def mayDeform(obj):
+    if obj.type != "MESH" or len(obj.modifiers) > 0:
+        return True
+    return getattr(obj.data, "shape_keys", None) is not None \
+        or getattr(obj.data, "animation_data", None) is not None
+
+# Geometry objects at the current frame, by (object name, occurrence),
+# since dupli instances repeat the same object
+def collectOccurrences(scene):
+    res = collections.OrderedDict()
+    counts = {}
+    for obj, matrix in meshExport.collectGeometryObjects(scene):
+        n = counts.get(obj.name, 0)
+        counts[obj.name] = n + 1
+        res[(obj.name, n)] = (obj, matrix)
+    return res
+
+# Hash of the evaluated geometry in object space, or None
+def objectGeometryKey(scene, obj):
+    arrays = meshExport.evaluateMesh(scene, obj)
+    if arrays is None:
+        return None
+    return geometryCache.geometryKey(arrays, np.identity(4), obj)
+
+# Samples every frame
+# Returns (set of static occurrences, names of objects that only move,
+# names of objects that deform)
+def classifyObjects(scene, frames):
+    firstMatrix = {}
+    firstGeometry = {}
+    present = None
+    moving = set()
+    deforming = set()
+    for frame in frames:
+        scene.frame_set(frame)
+        occurrences = collectOccurrences(scene)
+        keys = set(occurrences.keys())
+        # Objects hidden on some frames are exported per frame
+        present = keys if present is None else present & keys
+        frameGeometry = {}
+        for key, (obj, matrix) in occurrences.items():
+            m = np.array(matrix, dtype=np.float64).tobytes()
+            if firstMatrix.setdefault(key, m) != m:
+                moving.add(obj.name)
+            if obj.name in deforming or not mayDeform(obj):
+                continue
+            if obj.name not in frameGeometry:
+                frameGeometry[obj.name] = objectGeometryKey(scene, obj)
+            if firstGeometry.setdefault(obj.name, frameGeometry[obj.name]) != frameGeometry[obj.name]:
+                deforming.add(obj.name)
+    if present is None:
+        present = set()
+    static = set(key for key in present if key[0] not in moving and key[0] not in deforming)
+    return static, moving - deforming, deforming
+
+# Writes the object space meshes of moving objects as object instances,
+# emitters excepted since pbrt does not instance area lights
+# Returns (blocks, object name -> instance name)
+def defineInstances(scene, objects, outDir, cache):
+    blocks = []
+    names = {}
+    defined = set()
+    for obj in objects:
+        if meshExport.isEmitterObject(obj):
+            continue
+        arrays = meshExport.evaluateMesh(scene, obj)
+        if arrays is None:
+            continue
+        key, files = meshExport.writeMeshFiles(arrays, np.identity(4), obj, cache, outDir)
+        if len(files) == 0:
+            continue
+        instanceName = "anim_{}".format(key[:20])
+        names[obj.name] = instanceName
+        if instanceName in defined:
+            continue
+        defined.add(instanceName)
+        shapes = []
+        for slot, plyName in files:
+            mat = meshExport.slotMaterial(obj, slot)
+            shapes.append((None if mat is None else mat.name, plyName))
+        blocks.append(meshExport.createObjectBlock(instanceName, shapes))
+    return blocks, names
+
+# Exports every frame of the scene range to outDir
+# worldBlocks are the environment and material blocks, createCameraBlock
+# creates the camera block of a frame, stages are applied to geometry
+# blocks
+# Returns a dict of statistics
+def exportAnimation(scene, outDir, worldBlocks, createCameraBlock, stages, useCache=True):
+    frames = frameRange(scene)
+    if len(frames) == 0:
+        raise Exception("Empty frame range")
+    originalFrame = scene.frame_current
+    cache = geometryCache.GeometryCache(outDir, useCache)
+    cache.load()
+    try:
+        static, moving, deforming = classifyObjects(scene, frames)
+        log.info("Animation: {} frames, {} static objects, {} moving, {} deforming".format(
+            len(frames), len(static), len(moving), len(deforming)))
+
+        # Shared file
+        scene.frame_set(frames[0])
+        occurrences = collectOccurrences(scene)
+        staticObjects = [occurrences[key] for key in occurrences if key in static]
+        movingObjects = collections.OrderedDict()
+        for key, (obj, matrix) in occurrences.items():
+            if obj.name in moving:
+                movingObjects[obj.name] = obj
+        staticBlocks = meshExport.exportObjects(scene, staticObjects, outDir, cache)
+        instanceBlocks, instanceNames = defineInstances(scene, movingObjects.values(), outDir, cache)
+        sceneParser.writeBlocks(os.path.join(outDir, STATIC_NAME), itertools.chain(
+            worldBlocks,
+            sceneParser.pipeline(itertools.chain(staticBlocks, instanceBlocks), stages)))
+
+        includeBlock = sceneParser.SceneBlock([])
+        includeBlock.appendLine(0, 'Include "{}"'.format(STATIC_NAME))
+        weBlock = sceneParser.SceneBlock([])
+        weBlock.appendLine(0, "WorldEnd")
+
+        # Frame files
+        for frame in frames:
+            scene.frame_set(frame)
+            blocks = []
+            dynamicObjects = []
+            for key, (obj, matrix) in collectOccurrences(scene).items():
+                if key in static:
+                    continue
+                if obj.name in instanceNames:
+                    blocks.append(meshExport.createInstanceBlock(
+                        instanceNames[obj.name], meshExport.pbrtTransform(matrix)))
+                else:
+                    dynamicObjects.append((obj, matrix))
+            blocks.extend(meshExport.exportObjects(scene, dynamicObjects, outDir, cache))
+            sceneParser.writeBlocks(os.path.join(outDir, frameSceneName(frame)), itertools.chain(
+                [createCameraBlock(frame), includeBlock],
+                sceneParser.pipeline(blocks, stages),
+                [weBlock]))
+    finally:
+        cache.save()
+        scene.frame_set(originalFrame)
+
+    return {
+        "frames": len(frames),
+        "staticObjects": len(static),
+        "movingObjects": len(moving),
+        "deformingObjects": len(deforming)
+    }
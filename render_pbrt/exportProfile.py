@@ -0,0 +1,125 @@
+import cProfile
+import json
+import os
+import threading
+import time
+
+import generalUtil
+
+log = generalUtil.getLogger(__name__)
+
+# Export profile ===============================================================
+# Records wall time, CPU time, I/O and subprocess exit status of every
+# stage of a render, and writes them to export_profile.json in the output
+# directory. With the profiler enabled the whole render is also recorded
+# with cProfile, to export_profile.pstats. Stages can run on several
+# threads at once, each thread has its own current stage; CPU and I/O
+# counters are per process, so they include the overlapping stages
+
+PROFILE_NAME = "export_profile.json"
+PSTATS_NAME = "export_profile.pstats"
+PROFILE_VERSION = 2
+
+# Bytes read and written by this process, all threads included
+# Returns (read, written), or None where /proc is not available
+def processIo():
+    try:
+        f = open("/proc/self/io", "r")
+        counters = {}
+        for line in f:
+            key, value = line.split(":", 1)
+            counters[key] = int(value)
+        f.close()
+        return counters["rchar"], counters["wchar"]
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+# CPU seconds of this process and of its finished children
+def cpuTimes():
+    t = os.times()
+    return t[0] + t[1], t[2] + t[3]
+
+class ExportProfile():
+
+    def __init__(self, useCProfile=False):
+        self.startTime = time.time()
+        self.stages = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.graph = None
+        self.profiler = None
+        if useCProfile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    # Starts measuring stage <name>, ending the current one
+    # Returns the stage record, where the code can add fields such as
+    # the exit status of a subprocess
+    def begin(self, name):
+        self.end()
+        startCpu, startChildCpu = cpuTimes()
+        self.local.current = {
+            "name": name,
+            "thread": threading.current_thread().name,
+            "start": time.time() - self.startTime,
+            "cpu": startCpu,
+            "childCpu": startChildCpu,
+            "io": processIo()
+        }
+        return self.local.current
+
+    # Ends the current stage of this thread, if any
+    def end(self, status="ok"):
+        record = getattr(self.local, "current", None)
+        if record is None:
+            return
+        self.local.current = None
+        endCpu, endChildCpu = cpuTimes()
+        endIo = processIo()
+        startIo = record.pop("io")
+        record["status"] = status
+        record["wallSeconds"] = time.time() - self.startTime - record["start"]
+        record["cpuSeconds"] = endCpu - record.pop("cpu")
+        record["childCpuSeconds"] = endChildCpu - record.pop("childCpu")
+        if startIo is not None and endIo is not None:
+            record["bytesRead"] = endIo[0] - startIo[0]
+            record["bytesWritten"] = endIo[1] - startIo[1]
+        with self.lock:
+            self.stages.append(record)
+        log.info("{}: {:.3f}s".format(record["name"], record["wallSeconds"]))
+
+    # Adds the size of a file produced by a subprocess to the stage record
+    def addOutputFile(self, record, path):
+        if os.path.exists(path):
+            record["outputBytes"] = record.get("outputBytes", 0) + os.path.getsize(path)
+
+    # Adds the stage timings and critical path of a stageGraph.StageGraph
+    def setGraph(self, summary):
+        self.graph = summary
+
+    # Writes the profile to outDir
+    # A stage still open did not complete
+    # Returns the path of the JSON profile
+    def write(self, outDir):
+        self.end("failed")
+        pstatsPath = None
+        if self.profiler is not None:
+            self.profiler.disable()
+            pstatsPath = os.path.join(outDir, PSTATS_NAME)
+            self.profiler.dump_stats(pstatsPath)
+            self.profiler = None
+
+        profile = {
+            "version": PROFILE_VERSION,
+            "started": self.startTime,
+            "totalSeconds": time.time() - self.startTime,
+            "stages": self.stages,
+            "graph": self.graph,
+            "pstats": pstatsPath
+        }
+        path = os.path.join(outDir, PROFILE_NAME)
+        f = open(path, "w")
+        json.dump(profile, f, indent=1, sort_keys=True)
+        f.close()
+        log.info("Export profile written to {}".format(path))
+        return path
@@ -1,2 +1,24 @@
+import logging
+import sys
+
 def emptyObject():
-    return type('test', (object,), {})()
\ No newline at end of file
+    return type('test', (object,), {})()
+
+# Logging ======================================================================
+# Exporter messages go through loggers under LOGGER_NAME. Only warnings
+# are shown by default, the scene log level enables info and debug output
+
+LOGGER_NAME = "render_pbrt"
+
+def getLogger(moduleName):
+    return logging.getLogger("{}.{}".format(LOGGER_NAME, moduleName))
+
+# levelName is a logging level name: WARNING, INFO or DEBUG
+def setLogLevel(levelName):
+    logger = logging.getLogger(LOGGER_NAME)
+    if len(logger.handlers) == 0:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(getattr(logging, levelName))
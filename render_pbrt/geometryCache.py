@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+
+import generalUtil
+
+log = generalUtil.getLogger(__name__)
+
+# Geometry cache ===============================================================
+# PLY files are named after a hash of the evaluated mesh data, the export
+# transform and the modifier stack, so unchanged objects are not rewritten
+# between renders. The manifest keeps the key -> files mapping and hit/miss
+# statistics in the output directory
+
+MANIFEST_NAME = "geometry_cache.json"
+MANIFEST_VERSION = 1
+
+def geometryKey(arrays, m, obj):
+    h = hashlib.sha1()
+    for a in (arrays.co, arrays.loopVerts, arrays.loopStart,
+            arrays.loopTotal, arrays.matIndex, arrays.normals, arrays.uvs):
+        if a is None:
+            h.update(b"-")
+        else:
+            h.update(a.tobytes())
+    for row in m:
+        h.update(" ".join(repr(float(v)) for v in row).encode("ascii"))
+    for mod in obj.modifiers:
+        h.update("{} {} {}".format(mod.type, mod.name, mod.show_render).encode("utf-8"))
+    return h.hexdigest()
+
+def plyName(key, slot):
+    return "geo_{}_{}.ply".format(key[:20], slot)
+
+class GeometryCache():
+
+    def __init__(self, outDir, enabled=True):
+        self.outDir = outDir
+        self.enabled = enabled
+        self.entries = {}
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+        self.totalHits = 0
+        self.totalMisses = 0
+
+    def manifestPath(self):
+        return os.path.join(self.outDir, MANIFEST_NAME)
+
+    def load(self):
+        path = self.manifestPath()
+        if not os.path.exists(path):
+            return
+        try:
+            f = open(path, "r")
+            manifest = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            log.warning("Ignoring unreadable geometry cache manifest")
+            return
+        if manifest.get("version") != MANIFEST_VERSION:
+            return
+        self.entries = manifest.get("entries", {})
+        self.totalHits = manifest.get("totalHits", 0)
+        self.totalMisses = manifest.get("totalMisses", 0)
+
+    # Returns the list of (slot, ply name) for key,
+    # or None if the geometry must be generated
+    def lookup(self, key):
+        if self.enabled and key in self.entries:
+            files = self.entries[key]
+            if all(os.path.exists(os.path.join(self.outDir, f[1])) for f in files):
+                self.hits += 1
+                self.used[key] = files
+                return [(f[0], f[1]) for f in files]
+        self.misses += 1
+        return None
+
+    def store(self, key, files):
+        self.entries[key] = [[slot, name] for slot, name in files]
+        self.used[key] = self.entries[key]
+
+    # Deletes cached files that are no longer used by the scene
+    def prune(self):
+        keep = set()
+        for files in self.used.values():
+            for f in files:
+                keep.add(f[1])
+        for key, files in self.entries.items():
+            if key in self.used:
+                continue
+            for f in files:
+                path = os.path.join(self.outDir, f[1])
+                if f[1] not in keep and os.path.exists(path):
+                    os.remove(path)
+        self.entries = dict(self.used)
+
+    def save(self):
+        self.prune()
+        self.totalHits += self.hits
+        self.totalMisses += self.misses
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "hits": self.hits,
+            "misses": self.misses,
+            "totalHits": self.totalHits,
+            "totalMisses": self.totalMisses,
+            "entries": self.entries
+        }
+        f = open(self.manifestPath(), "w")
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.close()
+        log.info("Geometry cache: {} hits, {} misses".format(self.hits, self.misses))
@@ -0,0 +1,468 @@
+import numpy as np
+import os
+import struct
+import zlib
+
+import generalUtil
+
+log = generalUtil.getLogger(__name__)
+
+# Image files ==================================================================
+# Rendered images are float32 arrays of shape (height, width, channels),
+# top row first
+
+# Returns the pixels of a PFM file
+def readPfm(path):
+    f = open(path, "rb")
+    try:
+        header = f.readline().strip()
+        if header == b"PF":
+            channels = 3
+        elif header == b"Pf":
+            channels = 1
+        else:
+            raise Exception("{} is not a PFM file".format(path))
+        dims = f.readline().split()
+        width = int(dims[0])
+        height = int(dims[1])
+        # A negative scale means little endian
+        scale = float(f.readline().strip())
+        dtype = "<f4" if scale < 0.0 else ">f4"
+        count = width * height * channels
+        data = np.fromfile(f, dtype=dtype, count=count)
+    finally:
+        f.close()
+    if len(data) != count:
+        raise Exception("{} is truncated".format(path))
+    # PFM rows go bottom to top
+    return data.reshape(height, width, channels)[::-1].astype(np.float32)
+
+def writePfm(path, pixels):
+    height, width, channels = pixels.shape
+    f = open(path, "wb")
+    try:
+        f.write("{}\n{} {}\n-1.0\n".format("PF" if channels == 3 else "Pf", width, height).encode("ascii"))
+        np.ascontiguousarray(pixels[::-1], dtype="<f4").tofile(f)
+    finally:
+        f.close()
+
+# Images written by pbrt ------------------------------------------------------
+
+# Inverse of the sRGB curve pbrt applies to 8 bit images
+def srgbToLinear(values):
+    return np.where(values <= 0.04045, values / 12.92,
+        np.power((values + 0.055) / 1.055, 2.4)).astype(np.float32)
+
+# Undoes the byte predictor and interleaving of ZIP compressed EXR chunks
+def undoExrZip(buf):
+    d = np.frombuffer(buf, dtype=np.uint8).astype(np.int64)
+    d[1:] -= 128
+    t = (np.cumsum(d) & 255).astype(np.uint8)
+    half = (len(t) + 1) // 2
+    out = np.empty(len(t), dtype=np.uint8)
+    out[0::2] = t[:half]
+    out[1::2] = t[half:]
+    return out
+
+EXR_MAGIC = b"\x76\x2f\x31\x01"
+# Tiled, deep and multipart files
+EXR_UNSUPPORTED_FLAGS = 0x200 | 0x800 | 0x1000
+EXR_PIXEL_TYPES = {0: "<u4", 1: "<f2", 2: "<f4"}
+# Compression -> scanlines per chunk. NONE, ZIPS and ZIP are supported,
+# which covers what pbrt writes through OpenEXR
+EXR_LINES_PER_CHUNK = {0: 1, 2: 1, 3: 16}
+
+# Returns (list of (name, pixel type), sorted as in the file)
+def parseExrChannels(value):
+    channels = []
+    pos = 0
+    while value[pos:pos + 1] not in (b"\0", b""):
+        end = value.index(b"\0", pos)
+        name = value[pos:end].decode("utf-8")
+        pixelType = struct.unpack_from("<i", value, end + 1)[0]
+        channels.append((name, pixelType))
+        pos = end + 1 + 16
+    return channels
+
+# Returns (version, attributes by name, offset of the chunk table)
+def parseExrHeader(data, path):
+    if data[:4] != EXR_MAGIC:
+        raise Exception("{} is not an EXR file".format(path))
+    version = struct.unpack_from("<I", data, 4)[0]
+    attrs = {}
+    pos = 8
+    while data[pos] != 0:
+        end = data.index(b"\0", pos)
+        name = data[pos:end]
+        pos = data.index(b"\0", end + 1) + 1
+        size = struct.unpack_from("<i", data, pos)[0]
+        attrs[name] = data[pos + 4:pos + 4 + size]
+        pos += 4 + size
+    return version, attrs, pos + 1
+
+# Returns an error message if readExr cannot read a file with this header
+def exrUnsupported(version, attrs, path):
+    if version & EXR_UNSUPPORTED_FLAGS:
+        return "{}: only scanline EXR files are supported".format(path)
+    compression = attrs[b"compression"][0]
+    if compression not in EXR_LINES_PER_CHUNK:
+        return "{}: unsupported EXR compression {}".format(path, compression)
+    return None
+
+# Returns the pixels of the data window of a scanline EXR file
+def readExr(path):
+    f = open(path, "rb")
+    data = f.read()
+    f.close()
+    version, attrs, pos = parseExrHeader(data, path)
+    error = exrUnsupported(version, attrs, path)
+    if error is not None:
+        raise Exception(error)
+
+    channels = parseExrChannels(attrs[b"channels"])
+    compression = attrs[b"compression"][0]
+    xMin, yMin, xMax, yMax = struct.unpack("<4i", attrs[b"dataWindow"])
+    width = xMax - xMin + 1
+    height = yMax - yMin + 1
+    linesPerChunk = EXR_LINES_PER_CHUNK[compression]
+    sizes = [np.dtype(EXR_PIXEL_TYPES[t]).itemsize for name, t in channels]
+    lineBytes = width * sum(sizes)
+
+    # Chunks are decompressed into one buffer of scanlines
+    chunkCount = (height + linesPerChunk - 1) // linesPerChunk
+    offsets = np.frombuffer(data, dtype="<u8", count=chunkCount, offset=pos)
+    raw = np.empty(height * lineBytes, dtype=np.uint8)
+    for offset in offsets:
+        offset = int(offset)
+        y, size = struct.unpack_from("<ii", data, offset)
+        lines = min(linesPerChunk, yMax + 1 - y)
+        expected = lines * lineBytes
+        chunk = data[offset + 8:offset + 8 + size]
+        start = (y - yMin) * lineBytes
+        # Chunks that do not shrink are stored uncompressed
+        if compression != 0 and size < expected:
+            raw[start:start + expected] = undoExrZip(zlib.decompress(chunk))
+        else:
+            raw[start:start + expected] = np.frombuffer(chunk, dtype=np.uint8)
+    rows = raw.reshape(height, lineBytes)
+
+    # Every scanline holds the channels one after the other
+    planes = {}
+    column = 0
+    for (name, pixelType), size in zip(channels, sizes):
+        plane = rows[:, column:column + width * size].copy().view(EXR_PIXEL_TYPES[pixelType])
+        planes[name.split(".")[-1]] = plane.astype(np.float32)
+        column += width * size
+
+    if "R" in planes and "G" in planes and "B" in planes:
+        names = ["R", "G", "B"] + (["A"] if "A" in planes else [])
+    elif "Y" in planes:
+        names = ["Y"]
+    else:
+        raise Exception("{}: no RGB or Y channels".format(path))
+    return np.stack([planes[n] for n in names], axis=2)
+
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+# Color type -> channels. Palette images are not supported
+PNG_CHANNELS = {0: 1, 2: 3, 4: 2, 6: 4}
+
+# Rows undone together by unfilterWavefront, which bounds its memory
+WAVEFRONT_ROWS = 1024
+
+# Reverses the filters of rows, for images with Average or Paeth rows
+# Those filters depend on the pixel to the left, so rows cannot be undone
+# in one operation. A pixel only depends on the pixels to its left, above
+# and above left, so the pixels of an anti-diagonal are undone together,
+# width + height steps per band of rows instead of one per byte. The band
+# is skewed so that every anti-diagonal is a contiguous row.
+# filtered has shape (height, width, bpp), filterTypes one type per row,
+# prev the row above the band
+def unfilterBand(filtered, filterTypes, prev):
+    height, width, bpp = filtered.shape
+    diagonals = width + height - 1
+    strided = np.lib.stride_tricks.as_strided
+
+    # Skewed input, pixel (y, x) is at [x + y, y]
+    skewed = np.zeros((diagonals, height, bpp), dtype=np.uint8)
+    strided(skewed, (height, width, bpp), (skewed.strides[0] + skewed.strides[1],
+        skewed.strides[0], skewed.strides[2]))[:] = filtered
+
+    # Skewed output, pixel (y, x) is at [x + y + 2, y + 1], the row above
+    # at y = -1. Pixels that are never written are the zero neighbours
+    # left of the image
+    out = np.zeros((diagonals + 2, height + 1, bpp), dtype=np.uint8)
+    out[1:width + 1, 0] = prev
+
+    # Filter type masks of the rows, as multipliers
+    types = np.repeat(filterTypes.reshape(-1, 1), bpp, axis=1)
+    masks = [(types == filterType).astype(np.int16) for filterType in range(5)]
+    for t in range(diagonals):
+        y0 = max(0, t - width + 1)
+        y1 = min(height, t + 1)
+        a = out[t + 1, y0 + 1:y1 + 1].astype(np.int16)
+        b = out[t + 1, y0:y1].astype(np.int16)
+        c = out[t, y0:y1].astype(np.int16)
+
+        pa = np.abs(b - c)
+        pb = np.abs(a - c)
+        pc = np.abs(a + b - c - c)
+        paeth = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+        pred = masks[1][y0:y1] * a + masks[2][y0:y1] * b \
+            + masks[3][y0:y1] * ((a + b) >> 1) + masks[4][y0:y1] * paeth
+        out[t + 2, y0 + 1:y1 + 1] = skewed[t, y0:y1] + pred.astype(np.uint8)
+
+    return strided(out[2:, 1:], (height, width, bpp),
+        (out.strides[0] + out.strides[1], out.strides[0], out.strides[2]))
+
+# Returns the unfiltered rows, undone a band of rows at a time
+def unfilterWavefront(filtered, filterTypes):
+    height, width, bpp = filtered.shape
+    rows = np.empty(filtered.shape, dtype=np.uint8)
+    prev = np.zeros((width, bpp), dtype=np.uint8)
+    for y0 in range(0, height, WAVEFRONT_ROWS):
+        y1 = min(height, y0 + WAVEFRONT_ROWS)
+        rows[y0:y1] = unfilterBand(filtered[y0:y1], filterTypes[y0:y1], prev)
+        prev = rows[y1 - 1]
+    return rows
+
+# Returns (width, height, bit depth, color type, interlace) of a PNG file
+def readPngHeader(path):
+    f = open(path, "rb")
+    data = f.read(33)
+    f.close()
+    if data[:8] != PNG_MAGIC or data[12:16] != b"IHDR":
+        raise Exception("{} is not a PNG file".format(path))
+    width, height, depth, colorType, compression, filterMethod, interlace = \
+        struct.unpack(">IIBBBBB", data[16:29])
+    return width, height, depth, colorType, interlace
+
+# Returns (values, depth) of a non interlaced 8 or 16 bit PNG, values
+# being the stored integers in an array of shape (height, width, channels)
+def decodePng(path):
+    f = open(path, "rb")
+    data = f.read()
+    f.close()
+    if data[:8] != PNG_MAGIC:
+        raise Exception("{} is not a PNG file".format(path))
+    idat = []
+    header = None
+    pos = 8
+    while pos < len(data):
+        length, tag = struct.unpack_from(">I4s", data, pos)
+        body = data[pos + 8:pos + 8 + length]
+        if tag == b"IHDR":
+            header = struct.unpack(">IIBBBBB", body)
+        elif tag == b"IDAT":
+            idat.append(body)
+        elif tag == b"IEND":
+            break
+        pos += 12 + length
+    if header is None:
+        raise Exception("{} has no header".format(path))
+    width, height, depth, colorType, compression, filterMethod, interlace = header
+    if interlace != 0 or depth not in (8, 16) or colorType not in PNG_CHANNELS:
+        raise Exception("{}: unsupported PNG format".format(path))
+
+    channels = PNG_CHANNELS[colorType]
+    bpp = channels * depth // 8
+    stride = width * bpp
+    raw = np.frombuffer(zlib.decompress(b"".join(idat)), dtype=np.uint8).reshape(height, stride + 1)
+
+    filterTypes = raw[:, 0]
+    if np.any(filterTypes > 4):
+        raise Exception("{}: invalid PNG filter type".format(path))
+    if np.any(filterTypes >= 3):
+        rows = unfilterWavefront(raw[:, 1:].reshape(height, width, bpp), filterTypes) \
+            .reshape(height, stride)
+    else:
+        # None, Sub and Up rows are undone one row at a time
+        rows = np.empty((height, stride), dtype=np.uint8)
+        prev = np.zeros(stride, dtype=np.uint8)
+        for y in range(height):
+            filterType = filterTypes[y]
+            line = raw[y, 1:]
+            if filterType == 0:
+                cur = line
+            elif filterType == 1:
+                cur = (np.cumsum(line.reshape(width, bpp), axis=0, dtype=np.int64) & 255) \
+                    .astype(np.uint8).ravel()
+            else:
+                cur = line + prev
+            rows[y] = cur
+            prev = rows[y]
+
+    if depth == 16:
+        rows = rows.view(">u2").astype(np.uint16)
+    return rows.reshape(height, width, channels), depth
+
+# Linear values of PNG integers, through a lookup table of the sRGB curve
+# Alpha is stored linear
+def pngToLinear(values, depth):
+    maxValue = float((1 << depth) - 1)
+    lut = srgbToLinear(np.arange(1 << depth, dtype=np.float32) / maxValue)
+    channels = values.shape[2]
+    colors = channels if channels in (1, 3) else channels - 1
+    pixels = np.empty(values.shape, dtype=np.float32)
+    pixels[:, :, :colors] = lut[values[:, :, :colors]]
+    pixels[:, :, colors:] = values[:, :, colors:] / maxValue
+    return pixels
+
+# Returns the pixels of a non interlaced 8 or 16 bit PNG, linearized
+def readPng(path):
+    values, depth = decodePng(path)
+    return pngToLinear(values, depth)
+
+def linearToSrgb(values):
+    values = np.clip(values, 0.0, 1.0)
+    return np.where(values <= 0.0031308, values * 12.92,
+        1.055 * np.power(values, 1.0 / 2.4) - 0.055).astype(np.float32)
+
+# Channels -> PNG color type
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+# Writes linear pixels as an 8 bit sRGB PNG
+def writePng(path, pixels):
+    height, width, channels = pixels.shape
+    colors = channels if channels in (1, 3) else channels - 1
+    values = np.empty(pixels.shape, dtype=np.float32)
+    values[:, :, :colors] = linearToSrgb(pixels[:, :, :colors])
+    values[:, :, colors:] = np.clip(pixels[:, :, colors:], 0.0, 1.0)
+    rows = (values * 255.0 + 0.5).astype(np.uint8).reshape(height, width * channels)
+    # Up filter on every row
+    raw = np.empty((height, width * channels + 1), dtype=np.uint8)
+    raw[:, 0] = 2
+    raw[0, 1:] = rows[0]
+    raw[1:, 1:] = rows[1:] - rows[:-1]
+
+    def chunk(tag, body):
+        return struct.pack(">I", len(body)) + tag + body \
+            + struct.pack(">I", zlib.crc32(tag + body) & 0xffffffff)
+
+    f = open(path, "wb")
+    try:
+        f.write(PNG_MAGIC)
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8,
+            PNG_COLOR_TYPES[channels], 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+    finally:
+        f.close()
+
+IMAGE_READERS = {
+    ".pfm": readPfm,
+    ".exr": readExr,
+    ".png": readPng
+}
+
+# Headers of EXR files are read up to this size to check them
+EXR_HEADER_BYTES = 65536
+
+# True if readImage can decode the file at path, from its header
+def canRead(path):
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        if ext == ".png":
+            width, height, depth, colorType, interlace = readPngHeader(path)
+            return interlace == 0 and depth in (8, 16) and colorType in PNG_CHANNELS
+        if ext == ".exr":
+            f = open(path, "rb")
+            data = f.read(EXR_HEADER_BYTES)
+            f.close()
+            version, attrs, pos = parseExrHeader(data, path)
+            return exrUnsupported(version, attrs, path) is None
+    except Exception:
+        return False
+    return ext in IMAGE_READERS
+
+# Returns (width, height) of an image readImage can decode, from its
+# header, None for other files
+def readDimensions(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".png":
+        return readPngHeader(path)[:2]
+    f = open(path, "rb")
+    try:
+        if ext == ".exr":
+            version, attrs, pos = parseExrHeader(f.read(EXR_HEADER_BYTES), path)
+            xMin, yMin, xMax, yMax = struct.unpack("<4i", attrs[b"dataWindow"])
+            return xMax - xMin + 1, yMax - yMin + 1
+        if ext == ".pfm":
+            f.readline()
+            dims = f.readline().split()
+            return int(dims[0]), int(dims[1])
+    finally:
+        f.close()
+    return None
+
+# Returns the linear pixels of an image written by pbrt
+def readImage(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in IMAGE_READERS:
+        raise Exception("Unsupported image format {}".format(path))
+    return IMAGE_READERS[ext](path)
+
+# Resampling -----------------------------------------------------------------
+
+# Rows converted to float at a time when resizing 8 and 16 bit images
+RESIZE_STRIP = 256
+
+# Resizes values along axis to n samples
+# Shrinking averages the source samples covered by each output sample,
+# from prefix sums so the cost does not grow with the ratio. Enlarging
+# interpolates linearly between sample centers
+def resizeAxis(values, n, axis):
+    src = values.shape[axis]
+    if n == src:
+        return values.astype(np.float32)
+
+    def along(a):
+        shape = [1] * values.ndim
+        shape[axis] = len(a)
+        return a.reshape(shape)
+
+    if n < src:
+        sums = np.cumsum(values, axis=axis, dtype=np.float64)
+        sums = np.concatenate([np.zeros_like(sums.take([0], axis=axis)), sums], axis=axis)
+        edges = np.arange(n + 1) * (src / float(n))
+        first = np.minimum(np.floor(edges).astype(np.int64), src - 1)
+        # Integral of the samples from 0 to each edge
+        integral = sums.take(first, axis=axis) \
+            + along(edges - first) * values.take(first, axis=axis)
+        return (np.diff(integral, axis=axis) * (n / float(src))).astype(np.float32)
+
+    centers = np.clip((np.arange(n) + 0.5) * (src / float(n)) - 0.5, 0.0, src - 1)
+    lo = np.floor(centers).astype(np.int64)
+    hi = np.minimum(lo + 1, src - 1)
+    t = along((centers - lo).astype(np.float32))
+    a = np.asarray(values.take(lo, axis=axis), dtype=np.float32)
+    b = np.asarray(values.take(hi, axis=axis), dtype=np.float32)
+    # In place, the images can be large
+    b -= a
+    b *= t
+    a += b
+    return a
+
+# Returns values resized to width by height, as float32
+# convert(strip) turns rows of values into linear floats, so that large
+# 8 and 16 bit images are converted a strip at a time
+def resize(values, width, height, convert=None):
+    rows = values.shape[0]
+    tmp = np.empty((rows, width) + values.shape[2:], dtype=np.float32)
+    for y0 in range(0, rows, RESIZE_STRIP):
+        strip = values[y0:y0 + RESIZE_STRIP]
+        if convert is not None:
+            strip = convert(strip)
+        tmp[y0:y0 + RESIZE_STRIP] = resizeAxis(strip, width, 1)
+    return resizeAxis(tmp, height, 0)
+
+# Returns the pixels as RGBA, with opaque alpha where there is none
+def toRgba(pixels):
+    height, width, channels = pixels.shape
+    rgba = np.ones((height, width, 4), dtype=np.float32)
+    if channels <= 2:
+        rgba[:, :, :3] = pixels[:, :, :1]
+        if channels == 2:
+            rgba[:, :, 3] = pixels[:, :, 1]
+    else:
+        rgba[:, :, :min(channels, 4)] = pixels[:, :, :4]
+    return rgba
@@ -1,13 +1,25 @@
 import os
 import subprocess
 
+import generalUtil
+import toolchain
+
+log = generalUtil.getLogger(__name__)
+
+# The archive is only looked for once per session
+installChecked = False
+
 def install():
+    global installChecked
+    if installChecked:
+        return
+    installChecked = True
 
     currDir = os.path.abspath(os.path.dirname(__file__))
     compressedIilePath = os.path.join(currDir, "PBRT-IILE.tgz")
     if os.path.exists(compressedIilePath):
 
-        print("First run, extracting PBRT-IILE project files")
+        log.info("First run, extracting PBRT-IILE project files")
 
         # Extract
         subprocess.call([
@@ -20,33 +32,23 @@ def install():
         os.remove(compressedIilePath)
 
 # Useful to check if PBRT or OBJ2PBRT are in one of the available paths
-# Returns the path or executable name if found,
+# Looks in the user defined path, the default path, then PATH,
+# without running the executable
+# Returns the path if found,
 # returns None if not available
 def getExecutablePath(userDefinedBuildPath, defaultIileBuildPath, execName):
-
-    # Check user defined path
-    userDefinedPbrt = os.path.join(userDefinedBuildPath, execName)
-    if os.path.exists(userDefinedPbrt):
-        return userDefinedPbrt
-
-    # Check default path
-    defaultPbrt = os.path.join(defaultIileBuildPath, execName)
-    if os.path.exists(defaultPbrt):
-        return defaultPbrt
-
-    # Check if the executable is in PATH
-    try:
-        subprocess.call([execName, "-h"])
-        return execName
-    except OSError as e:
+    info = toolchain.getToolchain().lookup(execName, [userDefinedBuildPath, defaultIileBuildPath])
+    if info is None:
         return None
+    return info.path
 
+# Returns the directory of the node executable installed with PBRT-IILE,
+# or None
 def findNodeDir(buildPath):
     iileDir = os.path.dirname(buildPath)
     pbrtIileDir = os.path.dirname(iileDir)
     nodeBinDir = os.path.join(pbrtIileDir, "node", "bin")
-    nodePath = os.path.join(nodeBinDir, "node")
-    if os.path.exists(nodePath):
-        return nodeBinDir
-    else:
+    info = toolchain.getToolchain().lookup("node", [nodeBinDir], usePath=False)
+    if info is None:
         return None
+    return os.path.dirname(info.path)
@@ -0,0 +1,131 @@
+import bpy
+import hashlib
+import json
+import os
+
+import generalUtil
+
+log = generalUtil.getLogger(__name__)
+
+# Material cache ===============================================================
+# The MakeNamedMaterial block of a material is kept in the output directory
+# under a fingerprint of its iile* properties and of the size and mtime of
+# the texture files they point to. Materials with the same fingerprint as in
+# the last render reuse their block lines verbatim, and only declare and
+# stage their textures again.
+# The manifest is dropped when the material properties of the add-on
+# change, or when CACHE_VERSION is bumped because the blocks are written
+# differently
+
+MANIFEST_NAME = "material_cache.json"
+CACHE_VERSION = 1
+
+PROPERTY_PREFIX = "iile"
+
+# Returns [(identifier, type, subtype)] of the iile* material properties
+def materialSchema():
+    schema = []
+    for prop in bpy.types.Material.bl_rna.properties:
+        if prop.identifier.startswith(PROPERTY_PREFIX):
+            schema.append((prop.identifier, prop.type, prop.subtype))
+    schema.sort()
+    return schema
+
+def schemaKey(schema):
+    h = hashlib.sha1("{}".format(CACHE_VERSION).encode("ascii"))
+    for identifier, propType, subtype in schema:
+        h.update("{} {} {};".format(identifier, propType, subtype).encode("utf-8"))
+    return h.hexdigest()
+
+# Size and mtime of a texture file, None if it cannot be read
+def fileStats(texSource):
+    try:
+        st = os.stat(bpy.path.abspath(texSource))
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+def materialFingerprint(matObj, schema):
+    values = []
+    for identifier, propType, subtype in schema:
+        value = getattr(matObj, identifier, None)
+        if value is None or isinstance(value, (str, bool, int, float)):
+            values.append(value)
+        else:
+            # Vector properties
+            values.append(tuple(value))
+        if subtype == "FILE_PATH" and value:
+            values.append(fileStats(value))
+    return hashlib.sha1(repr(values).encode("utf-8")).hexdigest()
+
+class MaterialCache():
+
+    def __init__(self, outDir, enabled=True):
+        self.outDir = outDir
+        self.enabled = enabled
+        self.schema = materialSchema()
+        self.schemaKey = schemaKey(self.schema)
+        self.entries = {}
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+        self.loaded = {}
+
+    def manifestPath(self):
+        return os.path.join(self.outDir, MANIFEST_NAME)
+
+    def load(self):
+        path = self.manifestPath()
+        if not os.path.exists(path):
+            return
+        try:
+            f = open(path, "r")
+            manifest = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            log.warning("Ignoring unreadable material cache manifest")
+            return
+        if manifest.get("schema") != self.schemaKey:
+            log.info("Material properties changed, material cache cleared")
+            return
+        self.entries = manifest.get("entries", {})
+        self.loaded = self.entries
+
+    def fingerprint(self, matObj):
+        return materialFingerprint(matObj, self.schema)
+
+    # Returns the cached entry of material matName, a dict with the block
+    # "lines" and "levels" and the [source path, type] of its "textures",
+    # or None if the block must be generated
+    def lookup(self, matName, fingerprint):
+        entry = self.entries.get(matName)
+        if self.enabled and entry is not None and entry["fingerprint"] == fingerprint:
+            self.hits += 1
+            self.used[matName] = entry
+            return entry
+        self.misses += 1
+        return None
+
+    def store(self, matName, fingerprint, block, textures):
+        self.used[matName] = {
+            "fingerprint": fingerprint,
+            "lines": list(block.body),
+            "levels": list(block.bodyLevels),
+            "textures": [[texAbsPath, texType] for texAbsPath, texType in textures]
+        }
+
+    # Materials not exported by this render are dropped
+    # The manifest is only rewritten when it changed
+    def save(self):
+        log.info("Material cache: {} hits, {} misses".format(self.hits, self.misses))
+        if self.misses == 0 and len(self.used) == len(self.loaded):
+            return
+        manifest = {
+            "schema": self.schemaKey,
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": self.used
+        }
+        f = open(self.manifestPath(), "w")
+        json.dump(manifest, f)
+        f.close()
@@ -0,0 +1,150 @@
+import os
+import tempfile
+import threading
+
+import generalUtil
+import imageIo
+import sceneParser
+import textureUtil
+
+log = generalUtil.getLogger(__name__)
+
+# Material previews ============================================================
+# Previews render a template scene that is written once: a sphere on a
+# checkered plane, lit by an environment and a distant light. The template
+# includes two small files, the film settings and the previewed material,
+# which are the only files written for each preview. Textures are staged
+# as proxies no larger than the preview.
+# One renderer is kept for the session. Previews run one at a time, and a
+# preview still waiting its turn is dropped when the same material is
+# previewed again, so that quick edits do not queue up renders.
+
+PREVIEW_DIR = os.path.join(tempfile.gettempdir(), "pbrt_material_preview")
+TEMPLATE_NAME = "preview.pbrt"
+FILM_NAME = "preview_film.pbrt"
+MATERIAL_NAME = "preview_material.pbrt"
+IMAGE_NAME = "preview.pfm"
+
+# Bumped when the template changes
+TEMPLATE_VERSION = 1
+
+PREVIEW_SAMPLES = 16
+PREVIEW_MAXDEPTH = 5
+
+def templateLines():
+    return [
+        "# Material preview template {}".format(TEMPLATE_VERSION),
+        'Include "{}"'.format(FILM_NAME),
+        "Scale -1 1 1",
+        "LookAt 0 -6 2.5  0 0 0.9  0 0 1",
+        'Camera "perspective" "float fov" [ 24 ]',
+        "WorldBegin",
+        "AttributeBegin",
+        '    LightSource "infinite" "rgb L" [ 0.5 0.5 0.5 ] "integer samples" [ 4 ]',
+        "AttributeEnd",
+        'LightSource "distant" "point from" [ 3 -4 6 ] "point to" [ 0 0 0 ] "rgb L" [ 2.5 2.5 2.5 ]',
+        'Include "{}"'.format(MATERIAL_NAME),
+        "AttributeBegin",
+        "    Translate 0 0 1",
+        '    Shape "sphere" "float radius" [ 1 ]',
+        "AttributeEnd",
+        "AttributeBegin",
+        '    Texture "preview_checks" "spectrum" "checkerboard"',
+        '        "float uscale" [ 16 ] "float vscale" [ 16 ]',
+        '        "rgb tex1" [ 0.7 0.7 0.7 ] "rgb tex2" [ 0.3 0.3 0.3 ]',
+        '    Material "matte" "texture Kd" "preview_checks"',
+        '    Shape "trianglemesh" "integer indices" [ 0 1 2 0 2 3 ]',
+        '        "point P" [ -8 -8 0  8 -8 0  8 8 0  -8 8 0 ]',
+        '        "float uv" [ 0 0  1 0  1 1  0 1 ]',
+        "AttributeEnd",
+        "WorldEnd"
+    ]
+
+def filmLines(width, height):
+    return [
+        'Film "image" "integer xresolution" [ {} ] "integer yresolution" [ {} ] "string filename" "{}"'.format(
+            width, height, IMAGE_NAME),
+        'Sampler "halton" "integer pixelsamples" [ {} ]'.format(PREVIEW_SAMPLES),
+        'Integrator "path" "integer maxdepth" [ {} ]'.format(PREVIEW_MAXDEPTH)
+    ]
+
+# Writes lines to path unless it already holds them
+def writeIfChanged(path, lines):
+    text = "\n".join(lines) + "\n"
+    if os.path.exists(path):
+        f = open(path, "r")
+        same = f.read() == text
+        f.close()
+        if same:
+            return False
+    f = open(path, "w")
+    f.write(text)
+    f.close()
+    return True
+
+class PreviewRenderer():
+
+    def __init__(self, outDir=PREVIEW_DIR):
+        self.outDir = outDir
+        # Held while a preview renders
+        self.lock = threading.Lock()
+        # Preview key -> number of its latest request
+        self.latest = {}
+        self.requests = 0
+        self.requestsLock = threading.Lock()
+
+    def templatePath(self):
+        return os.path.join(self.outDir, TEMPLATE_NAME)
+
+    def writeTemplate(self):
+        if not os.path.isdir(self.outDir):
+            os.makedirs(self.outDir)
+        if writeIfChanged(self.templatePath(), templateLines()):
+            log.info("Wrote material preview template {}".format(self.templatePath()))
+
+    # Renders material matName at width by height
+    # createBlocks(outDir) returns the MakeNamedMaterial blocks of the
+    # material and the ones it depends on, and runs on the calling thread.
+    # runPbrt(cmd, cwd) runs pbrt to completion
+    # Returns the pixels, or None if matName was previewed again meanwhile
+    def render(self, matName, width, height, pbrtPath, createBlocks, runPbrt):
+        key = (matName, width, height)
+        with self.requestsLock:
+            self.requests += 1
+            request = self.requests
+            self.latest[key] = request
+
+        with self.lock:
+            if self.latest.get(key) != request:
+                log.debug("Preview of {} superseded".format(matName))
+                return None
+            self.writeTemplate()
+            writeIfChanged(os.path.join(self.outDir, FILM_NAME), filmLines(width, height))
+
+            store = textureUtil.openTextureStore(self.outDir, proxySize=max(width, height))
+            try:
+                blocks = createBlocks(self.outDir)
+            finally:
+                errors = store.wait()
+                textureUtil.closeTextureStore(store)
+            if len(errors) > 0:
+                raise Exception("\n".join(errors))
+
+            useBlock = sceneParser.SceneBlock([])
+            useBlock.appendLine(0, 'NamedMaterial "{}"'.format(matName))
+            sceneParser.writeBlocks(os.path.join(self.outDir, MATERIAL_NAME), blocks + [useBlock])
+
+            imagePath = os.path.join(self.outDir, IMAGE_NAME)
+            if os.path.exists(imagePath):
+                os.remove(imagePath)
+            runPbrt([pbrtPath, "--outfile", imagePath, self.templatePath()], self.outDir)
+            return imageIo.readPfm(imagePath)
+
+# Renderer kept for the session
+globalPreviewRenderer = None
+
+def getPreviewRenderer():
+    global globalPreviewRenderer
+    if globalPreviewRenderer is None:
+        globalPreviewRenderer = PreviewRenderer()
+    return globalPreviewRenderer
@@ -1,5 +1,12 @@
 import bpy
 
+import generalUtil
+
+log = generalUtil.getLogger(__name__)
+
+class MaterialCycleError(Exception):
+    pass
+
 def materialDependencies(matName):
     if matName not in bpy.data.materials:
         return []
@@ -16,30 +23,60 @@ def materialDependencies(matName):
     else:
         return []
 
-def _resolveMaterialDependencies(acc, seen, currMaterial):
-    if currMaterial in seen:
-        return
-    
-    # Add the dependencies of the current material
-    dependencies = materialDependencies(currMaterial)
-    for i in range(len(dependencies)):
-        aDep = dependencies[i]
-        _resolveMaterialDependencies(acc, seen, aDep)
-
-    # Add current material
-    acc.append(currMaterial)
-
-    # Add to seen
-    seen[currMaterial] = True
-
-def buildMaterialsDependencies():
-    materialsList = list(bpy.data.materials.keys())
+# Names of the materials assigned to the (object, world matrix) pairs,
+# in the order they are first used. Emitting materials of area lights
+# are assigned the same way
+def objectMaterials(objects):
+    names = []
+    seen = set()
+    for obj, matrix in objects:
+        for slot in obj.material_slots:
+            if slot.material is not None and slot.material.name not in seen:
+                seen.add(slot.material.name)
+                names.append(slot.material.name)
+    return names
 
+# Orders roots and the materials they depend on, dependencies first
+# Depth first with an explicit stack, so that long MIX chains do not hit
+# the recursion limit
+# Raises MaterialCycleError if materials depend on each other
+def resolveMaterialOrder(roots):
     acc = []
-    seen = {}
-    for i in range(len(materialsList)):
-        aMatName = materialsList[i]
-        _resolveMaterialDependencies(acc, seen, aMatName)
-    
-    print("Resolved materials order is {}".format(acc))
-    return acc
\ No newline at end of file
+    done = set()
+    # Materials on the current path -> position in path
+    onPath = {}
+    path = []
+    for root in roots:
+        if root in done:
+            continue
+        # (material, iterator over its dependencies)
+        stack = [(root, iter(materialDependencies(root)))]
+        onPath[root] = 0
+        path.append(root)
+        while len(stack) > 0:
+            matName, deps = stack[-1]
+            dep = next(deps, None)
+            if dep is None:
+                stack.pop()
+                path.pop()
+                del onPath[matName]
+                done.add(matName)
+                # Add current material
+                acc.append(matName)
+            elif dep in onPath:
+                cycle = path[onPath[dep]:] + [dep]
+                raise MaterialCycleError("Materials depend on each other: {}".format(
+                    " -> ".join(cycle)))
+            elif dep not in done:
+                onPath[dep] = len(path)
+                path.append(dep)
+                stack.append((dep, iter(materialDependencies(dep))))
+    return acc
+
+# Returns the names of the materials used by the (object, world matrix)
+# pairs, dependencies first
+def buildMaterialsDependencies(objects):
+    acc = resolveMaterialOrder(objectMaterials(objects))
+    log.info("Exporting {} of {} materials".format(len(acc), len(bpy.data.materials)))
+    log.debug("Resolved materials order is {}".format(acc))
+    return acc
@@ -0,0 +1,363 @@
+import bpy
+import collections
+import math
+import numpy as np
+import os
+
+import generalUtil
+import geometryCache
+import plyUtil
+import sceneParser
+
+log = generalUtil.getLogger(__name__)
+
+# In-process geometry export ===================================================
+# Reads evaluated mesh data in bulk and writes one plymesh per object and
+# material slot, producing the same blocks that pbrt --toply used to emit
+
+# Same axis conversion as the OBJ exporter with
+# axis_forward="Y", axis_up="-Z"
+AXIS_CONVERSION = np.array([
+    [-1.0, 0.0, 0.0, 0.0],
+    [0.0, 1.0, 0.0, 0.0],
+    [0.0, 0.0, -1.0, 0.0],
+    [0.0, 0.0, 0.0, 1.0]
+])
+
+GEOMETRY_TYPES = {"MESH", "CURVE", "SURFACE", "META", "FONT"}
+
+# Raw evaluated mesh arrays, as read with foreach_get
+class MeshArrays():
+
+    def __init__(self, mesh):
+        nVerts = len(mesh.vertices)
+        nLoops = len(mesh.loops)
+        nPolys = len(mesh.polygons)
+
+        self.co = np.empty(nVerts * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", self.co)
+        self.co = self.co.reshape(-1, 3)
+
+        self.loopVerts = np.empty(nLoops, dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", self.loopVerts)
+
+        self.loopStart = np.empty(nPolys, dtype=np.int32)
+        mesh.polygons.foreach_get("loop_start", self.loopStart)
+        self.loopTotal = np.empty(nPolys, dtype=np.int32)
+        mesh.polygons.foreach_get("loop_total", self.loopTotal)
+        self.matIndex = np.empty(nPolys, dtype=np.int32)
+        mesh.polygons.foreach_get("material_index", self.matIndex)
+        smooth = np.empty(nPolys, dtype=bool)
+        mesh.polygons.foreach_get("use_smooth", smooth)
+
+        # Split normals are only needed when something is smooth shaded
+        self.normals = None
+        if smooth.any():
+            mesh.calc_normals_split()
+            self.normals = np.empty(nLoops * 3, dtype=np.float32)
+            mesh.loops.foreach_get("normal", self.normals)
+            self.normals = self.normals.reshape(-1, 3)
+
+        self.uvs = None
+        if mesh.uv_layers.active is not None:
+            self.uvs = np.empty(nLoops * 2, dtype=np.float32)
+            mesh.uv_layers.active.data.foreach_get("uv", self.uvs)
+            self.uvs = self.uvs.reshape(-1, 2)
+
+# Fan-triangulates all polygons
+# Returns (triangles as loop indices, polygon index of each triangle)
+def triangulate(loopStart, loopTotal):
+    triCounts = np.maximum(loopTotal - 2, 0)
+    polyOfTri = np.repeat(np.arange(len(loopTotal)), triCounts)
+    firstTri = np.cumsum(triCounts) - triCounts
+    k = np.arange(len(polyOfTri)) - np.repeat(firstTri, triCounts)
+    base = loopStart[polyOfTri]
+    tris = np.stack([base, base + k + 1, base + k + 2], axis=1)
+    return tris, polyOfTri
+
+# Merges loops that share vertex, normal and uv into a single PLY vertex
+# Returns (vertex index of each unique corner, loop -> corner map)
+def uniqueCorners(arrays):
+    if arrays.normals is None and arrays.uvs is None:
+        return np.arange(len(arrays.co), dtype=np.int32), arrays.loopVerts
+
+    fields = [("v", "<i4")]
+    if arrays.normals is not None:
+        fields.append(("n", "<f4", (3,)))
+    if arrays.uvs is not None:
+        fields.append(("uv", "<f4", (2,)))
+    keys = np.empty(len(arrays.loopVerts), dtype=fields)
+    keys["v"] = arrays.loopVerts
+    if arrays.normals is not None:
+        keys["n"] = arrays.normals
+    if arrays.uvs is not None:
+        keys["uv"] = arrays.uvs
+
+    raw = keys.view("V{}".format(keys.dtype.itemsize))
+    _, first, inverse = np.unique(raw, return_index=True, return_inverse=True)
+    return first, inverse.astype(np.int32)
+
+# Returns the 4x4 transform from object space to pbrt world space
+def pbrtTransform(worldMatrix):
+    return np.dot(AXIS_CONVERSION, np.array(worldMatrix, dtype=np.float64))
+
+# Returns (angle in radians, axis, location) of a world matrix, the
+# rotation as the axis angle rotation mode shows it, without the scale
+def worldAxisAngle(worldMatrix):
+    m = np.array(worldMatrix, dtype=np.float64)
+    rotation = m[:3, :3] / np.linalg.norm(m[:3, :3], axis=0)
+    angle = math.acos(min(max((np.trace(rotation) - 1.0) / 2.0, -1.0), 1.0))
+    axis = np.array([rotation[2, 1] - rotation[1, 2],
+        rotation[0, 2] - rotation[2, 0],
+        rotation[1, 0] - rotation[0, 1]])
+    length = np.linalg.norm(axis)
+    if length > 1e-6:
+        axis /= length
+    elif angle < math.pi / 2.0:
+        # No rotation, Blender shows the Y axis
+        axis = np.array([0.0, 1.0, 0.0])
+    else:
+        # Half turn, the axis is the eigenvector of the symmetric rotation
+        i = int(np.argmax(np.diag(rotation)))
+        axis = np.empty(3)
+        axis[i] = math.sqrt((rotation[i, i] + 1.0) / 2.0)
+        for j in range(3):
+            if j != i:
+                axis[j] = rotation[i, j] / (2.0 * axis[i])
+    return angle, [float(v) for v in axis], [float(v) for v in m[:3, 3]]
+
+# Transforms mesh arrays with the 4x4 matrix m
+# Returns (positions, normals or None, flipWinding)
+def transformArrays(arrays, m):
+    linear = m[:3, :3]
+    positions = np.dot(arrays.co, linear.T) + m[:3, 3]
+    normals = None
+    if arrays.normals is not None:
+        normalMatrix = np.linalg.inv(linear).T
+        normals = np.dot(arrays.normals, normalMatrix.T)
+        lengths = np.linalg.norm(normals, axis=1)
+        lengths[lengths == 0.0] = 1.0
+        normals /= lengths[:, np.newaxis]
+    flipWinding = np.linalg.det(linear) < 0.0
+    return positions, normals, flipWinding
+
+# Builds the PLY data of every material slot of a mesh,
+# transformed by the 4x4 matrix m
+# Returns a list of (slot index, positions, indices, normals, uvs)
+def buildSlotMeshes(arrays, m):
+    tris, polyOfTri = triangulate(arrays.loopStart, arrays.loopTotal)
+    if len(tris) == 0:
+        return []
+    positions, normals, flipWinding = transformArrays(arrays, m)
+    if flipWinding:
+        tris = tris[:, ::-1]
+
+    cornerLoop, loopToCorner = uniqueCorners(arrays)
+    cornerTris = loopToCorner[tris]
+    triSlots = arrays.matIndex[polyOfTri]
+
+    res = []
+    for slot in np.unique(triSlots):
+        slotTris = cornerTris[triSlots == slot]
+        used, localTris = np.unique(slotTris, return_inverse=True)
+        localTris = localTris.reshape(-1, 3).astype(np.int32)
+        if arrays.normals is None and arrays.uvs is None:
+            slotPositions = positions[used]
+            slotNormals = None
+            slotUvs = None
+        else:
+            loops = cornerLoop[used]
+            slotPositions = positions[arrays.loopVerts[loops]]
+            slotNormals = None if normals is None else normals[loops]
+            slotUvs = None if arrays.uvs is None else arrays.uvs[loops]
+        res.append((int(slot), slotPositions, localTris, slotNormals, slotUvs))
+    return res
+
+# Creates the AttributeBegin block for one plymesh
+# Area lights get a placeholder emission, set later from the material
+def createShapeBlock(matName, isEmitter, plyName):
+    block = sceneParser.SceneBlock([])
+    appendShape(block, 0, matName, isEmitter, plyName)
+    return block
+
+def appendShape(block, level, matName, isEmitter, plyName):
+    block.appendLine(level, "AttributeBegin")
+    if matName is not None:
+        block.appendLine(level + 1, 'NamedMaterial "{}"'.format(matName))
+    if isEmitter:
+        block.appendLine(level + 1, 'AreaLightSource "diffuse"')
+        block.appendLine(level + 3, '"rgb L" [ 0 0 0 ]')
+    block.appendLine(level + 1, 'Shape "plymesh" "string filename" "{}"'.format(plyName))
+    block.appendLine(level, "AttributeEnd")
+
+# Creates the ObjectBegin block defining an instanced mesh
+# shapes is a list of (material name, ply name)
+def createObjectBlock(instanceName, shapes):
+    block = sceneParser.SceneBlock([])
+    block.appendLine(0, 'ObjectBegin "{}"'.format(instanceName))
+    for matName, plyName in shapes:
+        appendShape(block, 1, matName, False, plyName)
+    block.appendLine(0, "ObjectEnd")
+    return block
+
+# Creates the block placing one instance with the 4x4 transform m
+def createInstanceBlock(instanceName, m):
+    block = sceneParser.SceneBlock([])
+    block.appendLine(0, "AttributeBegin")
+    # pbrt matrices are column major
+    values = " ".join(repr(float(v)) for v in m.T.flatten())
+    block.appendLine(1, "Transform [ {} ]".format(values))
+    block.appendLine(1, 'ObjectInstance "{}"'.format(instanceName))
+    block.appendLine(0, "AttributeEnd")
+    return block
+
+def slotMaterial(obj, slot):
+    if slot < len(obj.material_slots):
+        return obj.material_slots[slot].material
+    return None
+
+# Lists (object, world matrix) pairs of everything that has geometry,
+# flattening dupli instances the same way the OBJ exporter does
+# Objects hidden from the render are skipped when renderedOnly is set,
+# the OBJ exporter writes them too
+def collectGeometryObjects(scene, renderedOnly=True):
+    res = []
+    for obj in scene.objects:
+        if renderedOnly and (obj.hide_render or not obj.is_visible(scene)):
+            continue
+        if obj.parent is not None and obj.parent.dupli_type in {"VERTS", "FACES"}:
+            continue
+        if obj.is_duplicator:
+            obj.dupli_list_create(scene, "RENDER")
+            for dob in obj.dupli_list:
+                if dob.object.type in GEOMETRY_TYPES:
+                    res.append((dob.object, dob.matrix.copy()))
+            obj.dupli_list_clear()
+            # Vertex and face duplicators are not rendered themselves
+            if obj.dupli_type in {"VERTS", "FACES"}:
+                continue
+        if obj.type in GEOMETRY_TYPES:
+            res.append((obj, obj.matrix_world.copy()))
+    return res
+
+# Fingerprint of the modifier stack settings, so that objects sharing
+# a mesh are only instanced if they evaluate to the same geometry
+def modifierSignature(obj):
+    parts = []
+    for mod in obj.modifiers:
+        for prop in mod.bl_rna.properties:
+            if prop.identifier == "rna_type":
+                continue
+            value = getattr(mod, prop.identifier, None)
+            if prop.type == "POINTER":
+                value = None if value is None else value.name
+            elif prop.type in {"INT", "FLOAT", "BOOLEAN"} and getattr(prop, "is_array", False):
+                value = tuple(value)
+            elif prop.type not in {"INT", "FLOAT", "BOOLEAN", "ENUM", "STRING"}:
+                continue
+            parts.append((prop.identifier, value))
+    return repr(parts)
+
+# Objects with the same key evaluate to the same geometry and materials
+def instanceKey(obj, signatures):
+    if obj.name not in signatures:
+        materials = tuple(
+            None if slot.material is None else slot.material.name
+            for slot in obj.material_slots)
+        signatures[obj.name] = (obj.type, obj.data.name, materials, modifierSignature(obj))
+    return signatures[obj.name]
+
+# Returns the MeshArrays of the evaluated object, or None
+def evaluateMesh(scene, obj):
+    try:
+        mesh = obj.to_mesh(scene, True, "RENDER")
+    except RuntimeError:
+        return None
+    if mesh is None:
+        return None
+    try:
+        return MeshArrays(mesh)
+    finally:
+        bpy.data.meshes.remove(mesh)
+
+# Writes the PLY files of a mesh transformed by m, unless cached
+# Returns (geometry key, list of (slot, ply name))
+def writeMeshFiles(arrays, m, obj, cache, outDir):
+    key = geometryCache.geometryKey(arrays, m, obj)
+    files = cache.lookup(key)
+    if files is None:
+        files = []
+        for slot, positions, indices, normals, uvs in buildSlotMeshes(arrays, m):
+            plyName = geometryCache.plyName(key, slot)
+            plyUtil.writePly(os.path.join(outDir, plyName), positions, indices, normals, uvs)
+            files.append((slot, plyName))
+        cache.store(key, files)
+    return key, files
+
+# True if a material of obj emits light
+def isEmitterObject(obj):
+    return any(slot.material is not None and slot.material.emit > 0.0
+        for slot in obj.material_slots)
+
+# Exports the (object, world matrix) pairs to PLY files in outDir
+# Meshes used more than once are written once as an object instance,
+# except emitters since pbrt does not support instanced area lights
+# Returns the list of SceneBlock for the scene file
+def exportObjects(scene, objects, outDir, cache):
+    # Group objects that share evaluated geometry
+    groups = collections.OrderedDict()
+    signatures = {}
+    for obj, worldMatrix in objects:
+        key = instanceKey(obj, signatures)
+        if key not in groups:
+            groups[key] = (obj, [])
+        groups[key][1].append(worldMatrix)
+
+    blocks = []
+    shapeCount = 0
+    instanceCount = 0
+    for obj, matrices in groups.values():
+        arrays = evaluateMesh(scene, obj)
+        if arrays is None:
+            continue
+
+        isEmitter = isEmitterObject(obj)
+
+        if len(matrices) > 1 and not isEmitter:
+            key, files = writeMeshFiles(arrays, np.identity(4), obj, cache, outDir)
+            if len(files) == 0:
+                continue
+            instanceName = "inst_{}".format(key[:20])
+            shapes = []
+            for slot, plyName in files:
+                mat = slotMaterial(obj, slot)
+                shapes.append((None if mat is None else mat.name, plyName))
+            blocks.append(createObjectBlock(instanceName, shapes))
+            for worldMatrix in matrices:
+                blocks.append(createInstanceBlock(instanceName, pbrtTransform(worldMatrix)))
+            shapeCount += len(files)
+            instanceCount += len(matrices)
+            continue
+
+        for worldMatrix in matrices:
+            key, files = writeMeshFiles(arrays, pbrtTransform(worldMatrix), obj, cache, outDir)
+            for slot, plyName in files:
+                mat = slotMaterial(obj, slot)
+                matName = None if mat is None else mat.name
+                slotEmitter = mat is not None and mat.emit > 0.0
+                blocks.append(createShapeBlock(matName, slotEmitter, plyName))
+            shapeCount += len(files)
+
+    log.info("Exported {} meshes, {} instances".format(shapeCount, instanceCount))
+    return blocks
+
+# Exports all geometry of the scene to PLY files in outDir
+# Unchanged objects reuse the PLY files of the previous render
+# when useCache is set
+# Returns the list of SceneBlock for the scene file
+def exportGeometry(scene, outDir, useCache=True):
+    cache = geometryCache.GeometryCache(outDir, useCache)
+    cache.load()
+    blocks = exportObjects(scene, collectGeometryObjects(scene), outDir, cache)
+    cache.save()
+    return blocks
@@ -34,6 +34,14 @@ class RENDER_PT_pbrtoutput(properties_render.RenderButtonsPanel, Panel):
         layout = self.layout
         rd = context.scene.render
         layout.prop(rd, "filepath", text="Exporter output directory")
+        layout.prop(context.scene, "iileTextureStoreSize", text="Texture store size (MB)")
+        layout.prop(context.scene, "iileTextureProxies", text="Proxy textures in previews")
+        layout.prop(context.scene, "iileTextureNormalize", text="Prepare textures for pbrt")
+        layout.prop(context.scene, "iileRenderImage", text="Render with pbrt")
+        if context.scene.iileRenderImage:
+            layout.prop(context.scene, "iileImageFormat", text="Image format")
+        layout.prop(context.scene, "iileLogLevel", text="Log level")
+        layout.prop(context.scene, "iileProfileExport", text="Profile export")
 
 class RENDER_PT_iile(properties_render.RenderButtonsPanel, Panel):
     bl_label = "PBRT Build Path"
@@ -45,6 +53,16 @@ class RENDER_PT_iile(properties_render.RenderButtonsPanel, Panel):
         s = context.scene
         layout.prop(s, "iilePath", text="PBRT binaries directory")
 
+        layout.prop(s, "iileMaterialCache", text="Reuse unchanged materials")
+        layout.prop(s, "iileGeometryExport", text="Geometry export")
+        if s.iileGeometryExport == "NATIVE":
+            layout.prop(s, "iileGeometryCache", text="Reuse unchanged geometry")
+            layout.prop(s, "iileExportAnimation", text="Export frame range")
+        else:
+            layout.prop(s, "iileExportTimeout", text="Timeout (minutes)")
+        if not s.iileExportAnimation:
+            layout.prop(s, "iileCameraBatch", text="Render selected cameras")
+
         layout.prop(s, "iileIntegrator", text="Integrator")
 
         if bpy.context.scene.iileIntegrator == "IILE":
@@ -67,6 +85,23 @@ class RENDER_PT_iile(properties_render.RenderButtonsPanel, Panel):
         else:
             raise Exception("Unsupported integrator {}".format(bpy.context.scene.iileIntegrator))
 
+class RENDER_PT_pbrttiles(properties_render.RenderButtonsPanel, Panel):
+    bl_label = "PBRT Tiled Render"
+    COMPAT_ENGINES = {renderer.IILERenderEngine.bl_idname}
+
+    def draw(self, context):
+        layout = self.layout
+
+        s = context.scene
+        layout.prop(s, "iileTiledRender", text="Render in tiles")
+        if s.iileTiledRender:
+            layout.prop(s, "iileTileSize", text="Tile size")
+            layout.prop(s, "iileRenderExecutor", text="Workers")
+            if s.iileRenderExecutor == "SSH":
+                layout.prop(s, "iileRenderHosts", text="Hosts")
+            layout.prop(s, "iileRenderWorkers", text="Workers per host")
+            layout.prop(s, "iileWorkerThreads", text="Threads per worker")
+
 class WORLD_PT_iileEnv(properties_world.WorldButtonsPanel, Panel):
     bl_label = "Environment map"
     COMPAT_ENGINES = {renderer.IILERenderEngine.bl_idname}
@@ -177,12 +212,145 @@ def register():
         subtype='DIR_PATH'
     )
 
+    Scene.iileGeometryExport = bpy.props.EnumProperty(
+        name="Geometry export",
+        description="How scene geometry is converted to PBRT",
+        items=[
+            ("NATIVE", "Native", "Write PLY meshes directly from Blender. Does not require saving the file or obj2pbrt"),
+            ("OBJ", "OBJ (legacy)", "Export an OBJ from a background Blender process and convert it with obj2pbrt")
+        ]
+    )
+
+    Scene.iileGeometryCache = bpy.props.BoolProperty(
+        name="Geometry cache",
+        description="Keep exported meshes in the output directory and only rewrite objects that changed since the last render",
+        default=True
+    )
+
+    Scene.iileMaterialCache = bpy.props.BoolProperty(
+        name="Material cache",
+        description="Keep exported materials in the output directory and only regenerate materials whose settings or textures changed since the last render",
+        default=True
+    )
+
+    Scene.iileExportTimeout = bpy.props.IntProperty(
+        name="Export timeout",
+        description="Minutes after which the background Blender and obj2pbrt are stopped. 0 waits forever",
+        default=30,
+        min=0
+    )
+
+    Scene.iileExportAnimation = bpy.props.BoolProperty(
+        name="Export animation",
+        description="Export one scene file per frame of the frame range. Geometry that does not change is written once and included by every frame",
+        default=False
+    )
+
+    Scene.iileCameraBatch = bpy.props.BoolProperty(
+        name="Camera batch",
+        description="Export geometry and materials once and render the scene from every selected camera, to one scene file and image per camera named after it. Without a selected camera the scene camera is rendered",
+        default=False
+    )
+
+    Scene.iileTextureStoreSize = bpy.props.IntProperty(
+        name="Texture store size",
+        description="Maximum size in MB of textures kept in the output directory. Textures not used by the current render are evicted least recently used first",
+        default=2048,
+        min=0
+    )
+
+    Scene.iileTextureProxies = bpy.props.BoolProperty(
+        name="Proxy textures",
+        description="Below 100% resolution, render with copies of the image textures scaled down to the film size. Renders at full resolution always use the original textures",
+        default=True
+    )
+
+    Scene.iileTextureNormalize = bpy.props.BoolProperty(
+        name="Prepare textures",
+        description="Resample image textures to power of two sizes once, instead of pbrt doing it at every scene load, and convert JPEG and 16 bit PNG textures to formats pbrt loads directly",
+        default=False
+    )
+
+    Scene.iileLogLevel = bpy.props.EnumProperty(
+        name="Log level",
+        description="Exporter messages printed to the console",
+        items=[
+            ("WARNING", "Warnings", "Only print problems"),
+            ("INFO", "Info", "Print the progress of every export stage"),
+            ("DEBUG", "Debug", "Also print every material, texture and light")
+        ]
+    )
+
+    Scene.iileProfileExport = bpy.props.BoolProperty(
+        name="Profile export",
+        description="Record the export with cProfile, to export_profile.pstats in the output directory",
+        default=False
+    )
+
     Scene.iileStartRenderer = bpy.props.BoolProperty(
         name="Start OSR renderer",
         description="Automatically start OSR renderer after exporting. Not compatible with vanilla PBRTv3",
         default=False
     )
 
+    Scene.iileRenderImage = bpy.props.BoolProperty(
+        name="Render with pbrt",
+        description="Run pbrt after exporting and show the rendered image in Blender",
+        default=False
+    )
+
+    Scene.iileImageFormat = bpy.props.EnumProperty(
+        name="Image format",
+        description="Format of the image written by pbrt",
+        items=[
+            ("PFM", "PFM", "Uncompressed float image, the fastest to load"),
+            ("EXR", "OpenEXR", "Compressed half float image"),
+            ("PNG", "PNG", "8 bit image with sRGB gamma")
+        ]
+    )
+
+    Scene.iileTiledRender = bpy.props.BoolProperty(
+        name="Tiled render",
+        description="Render the exported scene with pbrt in tiles, one process per tile, and merge the tiles into one image",
+        default=False
+    )
+
+    Scene.iileTileSize = bpy.props.IntProperty(
+        name="Tile size",
+        description="Width and height of a tile in pixels",
+        default=128,
+        min=16
+    )
+
+    Scene.iileRenderExecutor = bpy.props.EnumProperty(
+        name="Workers",
+        description="Where tiles are rendered",
+        items=[
+            ("LOCAL", "Local", "Run pbrt processes on this machine"),
+            ("SSH", "SSH", "Run pbrt processes on remote hosts with ssh. The hosts must see the output directory and pbrt at the same paths")
+        ]
+    )
+
+    Scene.iileRenderHosts = bpy.props.StringProperty(
+        name="Hosts",
+        description="Comma separated ssh hosts",
+        default=""
+    )
+
+    Scene.iileRenderWorkers = bpy.props.IntProperty(
+        name="Workers",
+        description="Tiles rendered at the same time on every host",
+        default=4,
+        min=1
+    )
+
+    Scene.iileWorkerThreads = bpy.props.IntProperty(
+        name="Threads per worker",
+        description="Threads of every pbrt process",
+        default=1,
+        min=1
+    )
+
     Scene.iileIntegrator = bpy.props.EnumProperty(
         name="Integrator",
         description="Surface Integrator",
@@ -506,11 +674,15 @@ def register():
     bpy.utils.register_class(RENDER_PT_pbrtoutput)
     # IILE Settings
     bpy.utils.register_class(RENDER_PT_iile)
+    # Tiled render
+    bpy.utils.register_class(RENDER_PT_pbrttiles)
 
     bpy.utils.register_class(WORLD_PT_iileEnv)
 
     # Material slots
     properties_material.MATERIAL_PT_context_material.COMPAT_ENGINES.add(renderer.IILERenderEngine.bl_idname)
+    # Material preview
+    properties_material.MATERIAL_PT_preview.COMPAT_ENGINES.add(renderer.IILERenderEngine.bl_idname)
     # Material type
     bpy.utils.register_class(MATERIAL_PT_material)
     # Material emission
@@ -0,0 +1,348 @@
+import numpy as np
+import re
+
+import sceneParser
+
+# PBRT-v3 scene file parser ====================================================
+# Tokenizes a memory mapped scenefile into directives with typed parameter
+# lists. Numeric arrays are only located while parsing, their content is
+# decoded into NumPy arrays the first time a pass reads them, so passes
+# that do not look at geometry do not pay for it.
+
+# Whitespace and comments, then one token:
+# 1 quoted string, 2 [, 3 ], 4 bare word (identifier, number, bool)
+TOKEN = re.compile(rb'\s*(?:#[^\n]*\s*)*(?:("[^"]*")|(\[)|(\])|([^\s\[\]"#]+))')
+TRAILING = re.compile(rb'\s*(?:#[^\n]*\s*)*\Z')
+
+STRING = 1
+OPEN = 2
+CLOSE = 3
+WORD = 4
+
+# Number of leading string arguments of directives followed by a parameter list
+PARAM_DIRECTIVES = {
+    "Accelerator": 1,
+    "AreaLightSource": 1,
+    "Camera": 1,
+    "Film": 1,
+    "Integrator": 1,
+    "LightSource": 1,
+    "MakeNamedMaterial": 1,
+    "MakeNamedMedium": 1,
+    "Material": 1,
+    "PixelFilter": 1,
+    "Sampler": 1,
+    "Shape": 1,
+    "SurfaceIntegrator": 1,
+    "Texture": 3,
+    "VolumeIntegrator": 1
+}
+
+# Directives that open a nested scope, and the directive closing them
+# WorldBegin is left flat so that world content stays at the top level
+SCOPES = {
+    "AttributeBegin": "AttributeEnd",
+    "TransformBegin": "TransformEnd",
+    "ObjectBegin": "ObjectEnd"
+}
+
+INTEGER_TYPES = {"integer"}
+
+# Unquoted bool values
+BOOL_WORDS = {"true", "false"}
+
+# Parameters ===================================================================
+
+# A "type name" parameter and its value
+# Numeric arrays keep their byte range in the source until read, source
+# is the sceneParser.SourceFile, which keeps the mapping open
+class Param():
+
+    __slots__ = ("type", "name", "source", "start", "end", "items", "numbers")
+
+    def __init__(self, paramType, name, source=None, start=0, end=0, items=None):
+        self.type = paramType
+        self.name = name
+        self.source = source
+        self.start = start
+        self.end = end
+        # Decoded tokens for string arrays and single values
+        self.items = items
+        # Decoded numeric array, or None until read
+        self.numbers = None
+
+    def isNumeric(self):
+        return self.items is None
+
+    def isModified(self):
+        return self.source is None
+
+    def dtype(self):
+        return np.int32 if self.type in INTEGER_TYPES else np.float64
+
+    # Raw text between the brackets of a numeric array
+    def rawBytes(self):
+        return self.source.data[self.start:self.end]
+
+    # Decodes the numeric array, once
+    @property
+    def values(self):
+        if self.items is not None:
+            return self.items
+        if self.numbers is None:
+            self.numbers = decodeNumbers(self.rawBytes(), self.dtype())
+        return self.numbers
+
+    # Replaces the value, the parameter is serialized again on write
+    def setValues(self, values):
+        self.source = None
+        if isinstance(values, np.ndarray):
+            self.items = None
+            self.numbers = values
+        else:
+            self.items = list(values)
+            self.numbers = None
+
+    # Decodes a numeric array in chunks of about chunkBytes of text,
+    # without holding the whole array in memory
+    def iterChunks(self, dtype, chunkBytes):
+        if self.source is None:
+            yield np.asarray(self.values, dtype=dtype)
+            return
+        data = self.source.data
+        pos = self.start
+        while pos < self.end:
+            cut = min(self.end, pos + chunkBytes)
+            if cut < self.end:
+                # Do not split a number
+                space = max(data.rfind(c, pos, cut) for c in (b" ", b"\n", b"\t", b"\r"))
+                if space > pos:
+                    cut = space
+            chunk = decodeNumbers(data[pos:cut], dtype)
+            if len(chunk) > 0:
+                yield chunk
+            pos = cut
+
+    # Text of the value, on a single line
+    def valueText(self):
+        if self.items is not None:
+            return "[ {} ]".format(" ".join(self.items))
+        if self.source is not None:
+            return "[ {} ]".format(b" ".join(self.rawBytes().split()).decode("ascii"))
+        return "[ {} ]".format(" ".join(repr(v) for v in self.numbers.tolist()))
+
+    def toString(self):
+        return '"{} {}" {}'.format(self.type, self.name, self.valueText())
+
+def decodeNumbers(raw, dtype):
+    if b"#" in raw:
+        raw = b"\n".join(l.split(b"#", 1)[0] for l in raw.split(b"\n"))
+    values = raw.split()
+    if dtype == np.int32:
+        return np.array(values, dtype=np.int64).astype(np.int32)
+    return np.array(values, dtype=np.float64).astype(dtype)
+
+# Directives ===================================================================
+
+# One directive with its positional arguments and parameters
+# Scope directives hold their content in children, and the closing
+# directive in closer
+class Directive():
+
+    __slots__ = ("name", "args", "params", "children", "closer", "start", "end")
+
+    def __init__(self, name, args=None, params=None, start=-1, end=-1):
+        self.name = name
+        self.args = [] if args is None else args
+        self.params = [] if params is None else params
+        self.children = None
+        self.closer = None
+        # Byte range in the source, including children and closer
+        self.start = start
+        self.end = end
+
+    def findParam(self, name):
+        for p in self.params:
+            if p.name == name:
+                return p
+        return None
+
+    def findChild(self, name):
+        if self.children is None:
+            return None
+        for c in self.children:
+            if c.name == name:
+                return c
+        return None
+
+    # First line of the directive, without parameters
+    def headText(self):
+        head = self.name
+        if len(self.args) > 0:
+            head += " " + " ".join(self.args)
+        if self.name in PARAM_DIRECTIVES:
+            head += " "
+        return head
+
+    # Lines in the pbrt --toply layout, as (indentation level, text)
+    def formatLines(self, level=0):
+        lines = [(level, self.headText())]
+        for p in self.params:
+            lines.append((level + 2, p.toString()))
+        if self.children is not None:
+            for c in self.children:
+                lines.extend(c.formatLines(level + 1))
+        if self.closer is not None:
+            lines.extend(self.closer.formatLines(level))
+        return lines
+
+    def toSceneBlock(self):
+        block = sceneParser.SceneBlock([])
+        for level, text in self.formatLines():
+            block.appendLine(level, text)
+        return block
+
+# Parser =======================================================================
+
+# Lazy parameters and blocks keep a reference to the SourceFile, so the
+# file stays mapped as long as they do, after the parser is released
+class PbrtParser():
+
+    def __init__(self, path):
+        self.sourceFile = sceneParser.SourceFile(path)
+        self.source = self.sourceFile.data
+        self.size = len(self.source)
+        self.pos = 0
+        self.peeked = None
+
+    def error(self, message):
+        line = self.source.count(b"\n", 0, min(self.pos, self.size)) + 1
+        return Exception("{} at line {}".format(message, line))
+
+    # Returns (kind, text, start, end) or None at the end of the file
+    def readToken(self):
+        m = TOKEN.match(self.source, self.pos)
+        if m is None:
+            if TRAILING.match(self.source, self.pos) is not None:
+                self.pos = self.size
+                return None
+            raise self.error("Unexpected character")
+        kind = m.lastindex
+        self.pos = m.end()
+        start = m.start(kind)
+        return (kind, m.group(kind).decode("utf-8"), start, self.pos)
+
+    def next(self):
+        if self.peeked is not None:
+            token = self.peeked
+            self.peeked = None
+            return token
+        return self.readToken()
+
+    def peek(self):
+        if self.peeked is None:
+            self.peeked = self.readToken()
+        return self.peeked
+
+    def expect(self, kind, what):
+        token = self.next()
+        if token is None or token[0] != kind:
+            raise self.error("Expected {}".format(what))
+        return token
+
+    # Reads a parameter value after its "type name" declaration
+    def readParam(self, declaration):
+        splt = declaration[1:-1].split()
+        if len(splt) != 2:
+            raise self.error("Bad parameter declaration {}".format(declaration))
+        paramType, name = splt
+        token = self.next()
+        if token is None:
+            raise self.error("Missing value for {}".format(declaration))
+        if token[0] != OPEN:
+            return Param(paramType, name, items=[token[1]])
+        # String, bool and empty arrays are read as tokens
+        following = self.peek()
+        if following is not None and (following[0] in (STRING, CLOSE) or
+                (following[0] == WORD and following[1] in BOOL_WORDS)):
+            items = []
+            token = self.next()
+            while token is not None and token[0] != CLOSE:
+                items.append(token[1])
+                token = self.next()
+            if token is None:
+                raise self.error("Unterminated array")
+            return Param(paramType, name, items=items)
+        # Numeric array: only find its end, the content is decoded lazily
+        self.peeked = None
+        start = token[3]
+        end = self.source.find(b"]", start)
+        if end < 0:
+            raise self.error("Unterminated array")
+        self.pos = end + 1
+        return Param(paramType, name, self.sourceFile, start, end)
+
+    # Parses one directive, with its scope content if any
+    # Returns None at the end of the file
+    def parseDirective(self):
+        token = self.next()
+        if token is None:
+            return None
+        kind, name, start, end = token
+        if kind != WORD or not (name[0].isalpha() or name[0] == "_"):
+            raise self.error("Unexpected token {}".format(name))
+        node = Directive(name, start=start)
+
+        if name in PARAM_DIRECTIVES:
+            for i in range(PARAM_DIRECTIVES[name]):
+                node.args.append(self.expect(STRING, "string argument of {}".format(name))[1])
+            while self.peek() is not None and self.peek()[0] == STRING:
+                node.params.append(self.readParam(self.next()[1]))
+        elif name == "ActiveTransform":
+            node.args.append(self.expect(WORD, "ActiveTransform type")[1])
+        else:
+            while True:
+                following = self.peek()
+                if following is None:
+                    break
+                if following[0] == WORD and (following[1][0].isalpha() or following[1][0] == "_"):
+                    break
+                node.args.append(self.next()[1])
+
+        if name in SCOPES:
+            closerName = SCOPES[name]
+            node.children = []
+            while True:
+                child = self.parseDirective()
+                if child is None:
+                    raise self.error("Missing {}".format(closerName))
+                if child.name == closerName:
+                    node.closer = child
+                    break
+                node.children.append(child)
+
+        node.end = self.pos if self.peeked is None else self.peeked[2]
+        return node
+
+    # Yields the top level directives
+    # Their byte range extends to the next directive, so that the ranges
+    # of consecutive directives are contiguous
+    def __iter__(self):
+        node = self.parseDirective()
+        while node is not None:
+            following = self.peek()
+            node.end = self.size if following is None else following[2]
+            yield node
+            node = self.parseDirective()
+
+# Yields the top level directives of a scenefile
+def iterDirectives(path):
+    return iter(PbrtParser(path))
+
+# Yields the top level directives of any scenefile as SceneBlock objects
+# Lines are produced in the pbrt --toply layout when a block is looked
+# at, unmodified blocks are written back as their source bytes
+def iterSceneBlocks(path):
+    parser = PbrtParser(path)
+    for node in parser:
+        yield sceneParser.sourceBlock(parser.sourceFile, node.start, node.end, node.name, node)
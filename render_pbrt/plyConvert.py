@@ -0,0 +1,167 @@
+import numpy as np
+import os
+import tempfile
+
+import generalUtil
+import pbrtParser
+import plyUtil
+import sceneParser
+
+log = generalUtil.getLogger(__name__)
+
+# Streaming trianglemesh to plymesh conversion =================================
+# Pure Python replacement for pbrt --toply
+# The input is parsed with pbrtParser, trianglemesh arrays are decoded in
+# bounded chunks, spooled to temporary files and assembled into binary PLY
+# files chunk by chunk, so memory usage does not depend on the size of
+# the input
+
+# Bytes of array text decoded at a time
+CHUNK_SIZE = 1 << 22
+
+# Vertices or faces written to a PLY file at a time
+PLY_CHUNK = 1 << 18
+
+# Trianglemesh arrays moved into the PLY file: name -> dtype
+PLY_ARRAYS = {
+    "P": np.float32,
+    "N": np.float32,
+    "uv": np.float32,
+    "st": np.float32,
+    "indices": np.int32
+}
+
+# Spooling =====================================================================
+
+# Accumulates an array on disk, chunk by chunk
+class SpoolArray():
+
+    def __init__(self, dtype, spoolDir):
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.file = tempfile.TemporaryFile(dir=spoolDir)
+        self.count = 0
+
+    def append(self, values):
+        values.astype(self.dtype).tofile(self.file)
+        self.count += len(values)
+
+    # Yields the content back in chunks of at most chunkLen values
+    def chunks(self, chunkLen):
+        self.file.seek(0)
+        remaining = self.count
+        while remaining > 0:
+            n = min(chunkLen, remaining)
+            yield np.fromfile(self.file, dtype=self.dtype, count=n)
+            remaining -= n
+
+    def close(self):
+        self.file.close()
+
+# Writes a PLY file from spooled trianglemesh arrays
+def writeSpooledPly(path, spools):
+    positions = spools["P"]
+    normals = spools.get("N")
+    uvs = spools.get("uv", spools.get("st"))
+    indices = spools["indices"]
+
+    vertexCount = positions.count // 3
+    if normals is not None and normals.count != positions.count:
+        normals = None
+    if uvs is not None and uvs.count // 2 != vertexCount:
+        uvs = None
+
+    f = open(path, "wb")
+    plyUtil.writePlyHeader(f, vertexCount, indices.count // 3,
+        normals is not None, uvs is not None)
+
+    streams = [positions.chunks(PLY_CHUNK * 3)]
+    if normals is not None:
+        streams.append(normals.chunks(PLY_CHUNK * 3))
+    if uvs is not None:
+        streams.append(uvs.chunks(PLY_CHUNK * 2))
+    for parts in zip(*streams):
+        parts = list(parts)
+        chunkPositions = parts.pop(0)
+        chunkNormals = parts.pop(0) if normals is not None else None
+        chunkUvs = parts.pop(0) if uvs is not None else None
+        plyUtil.packVertices(chunkPositions, chunkNormals, chunkUvs).tofile(f)
+
+    for chunk in indices.chunks(PLY_CHUNK * 3):
+        plyUtil.packTriangles(chunk).tofile(f)
+    f.close()
+
+# Conversion ===================================================================
+
+class PlyConverter():
+
+    def __init__(self, out, outDir):
+        self.out = out
+        self.outDir = outDir
+        self.meshCounter = 0
+
+    # Replaces trianglemesh shapes in node and its children by plymesh shapes
+    # Returns the converted node
+    def convertNode(self, node):
+        if node.name == "Shape" and node.args == ['"trianglemesh"']:
+            return self.convertTriangleMesh(node)
+        if node.children is not None:
+            node.children = [self.convertNode(c) for c in node.children]
+        return node
+
+    # Moves the geometry arrays of a trianglemesh to a PLY file,
+    # other parameters are kept on the plymesh
+    # A mesh that can not be converted is returned unchanged
+    def convertTriangleMesh(self, node):
+        spools = {}
+        others = []
+        try:
+            for param in node.params:
+                if param.name in PLY_ARRAYS and param.isNumeric():
+                    spool = SpoolArray(PLY_ARRAYS[param.name], self.outDir)
+                    spools[param.name] = spool
+                    for chunk in param.iterChunks(PLY_ARRAYS[param.name], CHUNK_SIZE):
+                        spool.append(chunk)
+                else:
+                    others.append(param)
+
+            if "P" not in spools:
+                log.warning("Trianglemesh without P left as is")
+                return node
+            # pbrt allows a single triangle without indices
+            if "indices" not in spools:
+                if spools["P"].count != 9:
+                    log.warning("Trianglemesh without indices left as is")
+                    return node
+                spools["indices"] = SpoolArray(PLY_ARRAYS["indices"], self.outDir)
+                spools["indices"].append(np.arange(3))
+
+            self.meshCounter += 1
+            plyName = "mesh_{:05d}.ply".format(self.meshCounter)
+            writeSpooledPly(os.path.join(self.outDir, plyName), spools)
+        finally:
+            for spool in spools.values():
+                spool.close()
+
+        filename = pbrtParser.Param("string", "filename", items=['"{}"'.format(plyName)])
+        return pbrtParser.Directive("Shape", ['"plymesh"'], [filename] + others)
+
+    def writeNode(self, node):
+        for level, text in node.formatLines():
+            self.out.write(sceneParser.indentBy(text, level) + "\n")
+
+    def convert(self, directives):
+        for node in directives:
+            self.writeNode(self.convertNode(node))
+
+# Converts inPath, writing PLY meshes to outDir and the
+# transformed scene to outPath
+# Returns the number of PLY files written
+def convertToPly(inPath, outPath, outDir):
+    outFile = open(outPath, "w")
+    try:
+        converter = PlyConverter(outFile, outDir)
+        converter.convert(pbrtParser.iterDirectives(inPath))
+    finally:
+        outFile.close()
+    log.info("Converted {} triangle meshes to PLY".format(converter.meshCounter))
+    return converter.meshCounter
@@ -0,0 +1,53 @@
+import numpy as np
+
+# Binary PLY writing ===========================================================
+
+# Writes the PLY header for a triangle mesh
+# hasNormals and hasUvs select the optional per-vertex attributes
+def writePlyHeader(f, vertexCount, faceCount, hasNormals, hasUvs):
+    lines = [
+        "ply",
+        "format binary_little_endian 1.0",
+        "element vertex {}".format(vertexCount),
+        "property float x",
+        "property float y",
+        "property float z"
+    ]
+    if hasNormals:
+        lines.append("property float nx")
+        lines.append("property float ny")
+        lines.append("property float nz")
+    if hasUvs:
+        lines.append("property float u")
+        lines.append("property float v")
+    lines.append("element face {}".format(faceCount))
+    lines.append("property list uint8 int vertex_indices")
+    lines.append("end_header")
+    f.write(("\n".join(lines) + "\n").encode("ascii"))
+
+# Packs vertex attributes into a single interleaved float32 array
+def packVertices(positions, normals=None, uvs=None):
+    columns = [np.asarray(positions, dtype="<f4").reshape(-1, 3)]
+    if normals is not None:
+        columns.append(np.asarray(normals, dtype="<f4").reshape(-1, 3))
+    if uvs is not None:
+        columns.append(np.asarray(uvs, dtype="<f4").reshape(-1, 2))
+    return np.ascontiguousarray(np.hstack(columns))
+
+# Packs triangle indices as PLY list records: uint8 count + 3 int32
+def packTriangles(indices):
+    tris = np.asarray(indices).reshape(-1, 3)
+    faces = np.empty(len(tris), dtype=[("n", "u1"), ("i", "<i4", (3,))])
+    faces["n"] = 3
+    faces["i"] = tris
+    return faces
+
+# Writes a complete triangle mesh to a binary little endian PLY file
+def writePly(path, positions, indices, normals=None, uvs=None):
+    vertices = packVertices(positions, normals, uvs)
+    faces = packTriangles(indices)
+    f = open(path, "wb")
+    writePlyHeader(f, len(vertices), len(faces), normals is not None, uvs is not None)
+    vertices.tofile(f)
+    faces.tofile(f)
+    f.close()
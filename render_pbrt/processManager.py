@@ -0,0 +1,169 @@
+import collections
+import os
+import queue
+import re
+import signal
+import subprocess
+import threading
+import time
+
+import generalUtil
+
+log = generalUtil.getLogger(__name__)
+
+# External processes ===========================================================
+# Runs the external tools without blocking the render. Output is read by
+# threads, while the calling thread polls the engine for cancellation,
+# enforces the timeout and reports the progress printed by the tool.
+# Children run in their own process group, so that stopping one also
+# stops the processes it started
+
+POLL_SECONDS = 0.1
+TAIL_LINES = 20
+KILL_GRACE_SECONDS = 2.0
+
+LINE_BREAK = re.compile(rb"[\r\n]")
+# pbrt redraws "Rendering: [+++++      ]  (1.2s|3.4s)" with \r
+PROGRESS_BAR = re.compile(r"\[([+ ]{4,})\]")
+PROGRESS_PERCENT = re.compile(r"(\d+(?:\.\d+)?)\s*%")
+
+if os.name == "nt":
+    NEW_GROUP = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+else:
+    NEW_GROUP = {"start_new_session": True}
+
+class ProcessError(Exception):
+
+    def __init__(self, message, tail=""):
+        if tail != "":
+            message = "{}\n{}".format(message, tail)
+        Exception.__init__(self, message)
+        self.tail = tail
+
+class ProcessCancelled(Exception):
+    pass
+
+# Returns the progress fraction printed on a line of output, or None
+def parseProgress(line):
+    m = PROGRESS_BAR.search(line)
+    if m is not None:
+        bar = m.group(1)
+        return bar.count("+") / float(len(bar))
+    m = PROGRESS_PERCENT.search(line)
+    if m is not None:
+        return min(float(m.group(1)) / 100.0, 1.0)
+    return None
+
+# Puts (stream name, line) in lines until the end of stream, then
+# (stream name, None)
+def readLines(stream, streamName, lines):
+    fd = stream.fileno()
+    pending = b""
+    try:
+        while True:
+            chunk = os.read(fd, 65536)
+            if chunk == b"":
+                break
+            parts = LINE_BREAK.split(pending + chunk)
+            pending = parts.pop()
+            for part in parts:
+                if part != b"":
+                    lines.put((streamName, part.decode("utf-8", "replace")))
+        if pending != b"":
+            lines.put((streamName, pending.decode("utf-8", "replace")))
+    finally:
+        stream.close()
+        lines.put((streamName, None))
+
+# Starts cmd in a new process group
+def startProcess(cmd, cwd=None, env=None, stdout=None, stderr=None):
+    return subprocess.Popen(cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+        stdout=stdout, stderr=stderr, **NEW_GROUP)
+
+# Stops a process started by startProcess and its children
+def killTree(proc):
+    if proc.poll() is not None:
+        return
+    if os.name == "nt":
+        subprocess.call(["taskkill", "/T", "/F", "/PID", "{}".format(proc.pid)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            try:
+                proc.wait(KILL_GRACE_SECONDS)
+            except subprocess.TimeoutExpired:
+                os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    proc.wait()
+
+# Runs cmd to completion
+# stdout may be a file, otherwise the output of the process is logged.
+# Progress printed by the process goes to onProgress(fraction), or to the
+# engine, with the last line as render stats. The process is killed when
+# engine.test_break() or cancelled() returns True, or after timeout
+# seconds. onPoll() is called regularly while it runs
+# Raises ProcessCancelled, or ProcessError with the end of the output
+# Returns the exit status, 0
+def runProcess(name, cmd, engine=None, cwd=None, env=None, stdout=None, timeout=None,
+        onPoll=None, onProgress=None, cancelled=None):
+    proc = startProcess(cmd, cwd, env,
+        subprocess.PIPE if stdout is None else stdout, subprocess.PIPE)
+    lines = queue.Queue()
+    tails = {"stdout": collections.deque(maxlen=TAIL_LINES), "stderr": collections.deque(maxlen=TAIL_LINES)}
+    readers = []
+    for streamName, stream in (("stdout", proc.stdout), ("stderr", proc.stderr)):
+        if stream is None:
+            continue
+        reader = threading.Thread(target=readLines, args=(stream, streamName, lines))
+        reader.daemon = True
+        reader.start()
+        readers.append(reader)
+
+    # Tools like Blender print their errors to stdout
+    def tail():
+        return "\n".join(tails["stderr"] if len(tails["stderr"]) > 0 else tails["stdout"])
+
+    startTime = time.time()
+    openStreams = len(readers)
+    try:
+        while openStreams > 0 or proc.poll() is None:
+            if openStreams == 0:
+                # Output closed, or redirected to a file
+                try:
+                    proc.wait(POLL_SECONDS)
+                except subprocess.TimeoutExpired:
+                    pass
+            try:
+                streamName, line = lines.get(timeout=POLL_SECONDS if openStreams > 0 else 0.0)
+                if line is None:
+                    openStreams -= 1
+                else:
+                    tails[streamName].append(line)
+                    log.debug("{} {}: {}".format(name, streamName, line))
+                    fraction = parseProgress(line)
+                    if fraction is not None:
+                        if onProgress is not None:
+                            onProgress(fraction)
+                        elif engine is not None:
+                            engine.update_progress(fraction)
+                    if engine is not None:
+                        engine.update_stats("", "{}: {}".format(name, line.strip()))
+            except queue.Empty:
+                pass
+
+            if (engine is not None and engine.test_break()) or (cancelled is not None and cancelled()):
+                raise ProcessCancelled("{} cancelled".format(name))
+            if timeout is not None and time.time() - startTime > timeout:
+                raise ProcessError("{} timed out after {} seconds".format(name, timeout), tail())
+            if onPoll is not None:
+                onPoll()
+    finally:
+        killTree(proc)
+        for reader in readers:
+            reader.join()
+
+    if proc.returncode != 0:
+        raise ProcessError("{} failed with exit status {}".format(name, proc.returncode), tail())
+    return proc.returncode
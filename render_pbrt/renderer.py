@@ -3,13 +3,32 @@ import textureUtil
 import install
 import pbrt
 import sceneParser
+import pbrtParser
 import generalUtil
+import exportProfile
 import materialTree
+import materialCache
+import materialPreview
 import lightEnv
-
+import meshExport
+import animationExport
+import tiledRender
+import processManager
+import stageGraph
+import sceneParts
+import imageIo
+import plyConvert
+import toolchain
+
+import hashlib
 import os
 import math
-import subprocess
+import time
+
+log = generalUtil.getLogger(__name__)
+
+# Seconds between reloads of the image pbrt is writing
+RESULT_REFRESH_SECONDS = 1.0
 
 # =============================================================================
 # Utils
@@ -22,12 +41,26 @@ def dump(obj):
 def wline(f, t):
     f.write("{}\n".format(t))
 
-def runCmd(cmd, stdout=None, cwd=None, env=None):
+# Returns the exit status of the command
+# Runs cmd without blocking the render, see processManager.runProcess
+# A failure is reported with the end of the output of the command
+# Off the main thread renderContext is None: the engine is not used, the
+# command stops when cancelled() returns True, and a failure raises
+# processManager.ProcessError for the main thread to report
+# Returns the exit status
+def runCmd(renderContext, name, cmd, stdout=None, cwd=None, env=None, timeout=None,
+        onPoll=None, onProgress=None, cancelled=None):
     stdoutInfo = ""
     if stdout is not None:
         stdoutInfo = " > {}".format(stdout.name)
-    print(">>> {}{}".format(cmd, stdoutInfo))
-    subprocess.call(cmd, shell=False, stdout=stdout, cwd=cwd, env=env)
+    log.info(">>> {}{}".format(cmd, stdoutInfo))
+    try:
+        return processManager.runProcess(name, cmd, renderContext, cwd, env, stdout,
+            timeout, onPoll, onProgress, cancelled)
+    except processManager.ProcessError as e:
+        if renderContext is None:
+            raise
+        errorMessage(renderContext, "{}".format(e))
 
 def appendFile(sourcePath, destFile):
     sourceFile = open(sourcePath, 'r')
@@ -35,6 +68,23 @@ def appendFile(sourcePath, destFile):
         destFile.write(line)
     sourceFile.close()
 
+# Returns the Combined pass of a render result
+def combinedPass(result):
+    layer = result.layers[0]
+    for p in layer.passes:
+        if p.name == "Combined":
+            return p
+    return layer.passes[0]
+
+# Fills a render result with pixels in one buffer assignment
+# Rows of the render result go bottom to top
+def setResultPixels(result, pixels):
+    height, width = pixels.shape[:2]
+    if (width, height) != (result.resolution_x, result.resolution_y):
+        raise Exception("Image is {}x{}, render result is {}x{}".format(
+            width, height, result.resolution_x, result.resolution_y))
+    combinedPass(result).rect = imageIo.toRgba(pixels)[::-1].reshape(height * width, 4)
+
 def warningMessage(renderContext, message):
     renderContext.report({"WARNING"}, message)
 
@@ -63,7 +113,7 @@ def processMatteMaterial(matName, outDir, block, matObj):
     else:
         # Diffuse texture
         # Get the absolute path of the texture
-        print("Texture detected for material {}".format(matName))
+        log.debug("Texture detected for material {}".format(matName))
         texSource = matObj.iileMatteColorTexture
         destName = textureUtil.addTexture(texSource, outDir, block)
         # Set Kd to the texture
@@ -221,64 +271,237 @@ def processGlassMaterial(matName, outDir, matBlock, matObj):
 def processNoneMaterial(matName, outDir, matBlock, matObj):
     matBlock.appendLine(2, '"string type" "none"')
 
+# Creates the MakeNamedMaterial block of a material
+def createMaterialBlock(renderContext, matName, matObj, outDir):
+    matBlock = sceneParser.SceneBlock([])
+    matBlock.appendLine(0, 'MakeNamedMaterial "{}"'.format(matName))
+    log.debug("Processing material {}".format(matName))
+    # Write material type
+    if matObj.iileMaterial == "MATTE":
+        processMatteMaterial(matName, outDir, matBlock, matObj)
+    elif matObj.iileMaterial == "PLASTIC":
+        processPlasticMaterial(matName, outDir, matBlock, matObj)
+    elif matObj.iileMaterial == "MIRROR":
+        processMirrorMaterial(matName, outDir, matBlock, matObj)
+    elif matObj.iileMaterial == "MIX":
+        processMixMaterial(matName, outDir, matBlock, matObj)
+    elif matObj.iileMaterial == "GLASS":
+        processGlassMaterial(matName, outDir, matBlock, matObj)
+    elif matObj.iileMaterial == "NONE":
+        processNoneMaterial(matName, outDir, matBlock, matObj)
+
+    else:
+        errorMessage(renderContext, "Unrecognized material {}".format(
+            matObj.iileMaterial))
+    return matBlock
+
+# Creates the MakeNamedMaterial blocks of the materials used by the
+# (object, world matrix) pairs, dependencies first. Unused materials and
+# their textures are not exported
+# Blocks of materials that did not change since the last render in outDir
+# are reused when useCache is set
+def createMaterialBlocks(renderContext, outDir, objects, useCache=True):
+    blocks = []
+    try:
+        materialsResolutionOrder = materialTree.buildMaterialsDependencies(objects)
+    except materialTree.MaterialCycleError as e:
+        errorMessage(renderContext, "{}".format(e))
+    cache = materialCache.MaterialCache(outDir, useCache)
+    cache.load()
+    store = textureUtil.getTextureStore(outDir)
+
+    for matName in materialsResolutionOrder:
+        if matName not in bpy.data.materials:
+            blocks.append(createMaterialBlock(renderContext, matName,
+                createEmptyMaterialObject(), outDir))
+            continue
+        matObj = bpy.data.materials[matName]
+        fingerprint = cache.fingerprint(matObj)
+        entry = cache.lookup(matName, fingerprint)
+        if entry is not None:
+            # Textures are declared again, the ones already declared by
+            # other materials only once
+            matBlock = sceneParser.SceneBlock(list(entry["lines"]), bytearray(entry["levels"]))
+            for texAbsPath, texType in entry["textures"]:
+                textureUtil.addTextureFile(texAbsPath, outDir, matBlock, texType)
+        else:
+            store.startRecording()
+            try:
+                matBlock = createMaterialBlock(renderContext, matName, matObj, outDir)
+            finally:
+                textures = store.stopRecording()
+            cache.store(matName, fingerprint, matBlock, textures)
+        blocks.append(matBlock)
+
+    cache.save()
+    return blocks
+
+# Creates the block with film, integrator, sampler and camera settings,
+# up to WorldBegin, which is left out when worldBegin is not set
+# filename is the output image of pbrt, pbrt.exr when None
+# cameraObj is the camera object rendered from, the scene camera when None
+def createCameraBlock(renderContext, sx, sy, filename=None, worldBegin=True, cameraObj=None):
+    # Film, Camera, transformations
+    b = sceneParser.SceneBlock([])
+    filmLine = 'Film "image" "integer xresolution" {} "integer yresolution" {}'.format(sx, sy)
+    if filename is not None:
+        filmLine += ' "string filename" "{}"'.format(filename)
+    b.appendLine(0, filmLine)
+
+    # Integrator name
+    integratorName = "path"
+    if bpy.context.scene.iileIntegrator == "PATH":
+        integratorName = "path"
+    elif bpy.context.scene.iileIntegrator == "IILE":
+        integratorName = "iispt"
+    elif bpy.context.scene.iileIntegrator == "BDPT":
+        integratorName = "bdpt"
+    else:
+        errorMessage(renderContext, "Unrecognized iileIntegrator {}".format(
+            bpy.context.scene.iileIntegrator))
+    b.appendLine(0, 'Integrator "{}"'.format(integratorName))
+
+    # Integrator specifics
+    if bpy.context.scene.iileIntegrator == "PATH":
+        pass
+    elif bpy.context.scene.iileIntegrator == "BDPT":
+        b.appendLine(1, '"integer maxdepth" [{}]'.format(bpy.context.scene.iileIntegratorBdptMaxdepth))
+        b.appendLine(1, '"string lightsamplestrategy" "{}"'.format(bpy.context.scene.iileIntegratorBdptLightsamplestrategy.lower()))
+        b.appendLine(1, '"bool visualizestrategies" "{}"'.format("true" if bpy.context.scene.iileIntegratorBdptVisualizestrategies else "false"))
+        b.appendLine(1, '"bool visualizeweights" "{}"'.format("true" if bpy.context.scene.iileIntegratorBdptVisualizeweights else "false"))
+
+    samplerName = "random"
+    if bpy.context.scene.iileIntegratorPathSampler == "RANDOM":
+        samplerName = "random"
+    elif bpy.context.scene.iileIntegratorPathSampler == "SOBOL":
+        samplerName = "sobol"
+    elif bpy.context.scene.iileIntegratorPathSampler == "HALTON":
+        samplerName = "halton"
+    else:
+        errorMessage(renderContext, "Unrecognized sampler {}".format(bpy.context.scene.iileIntegratorPathSampler))
+
+    b.appendLine(0, 'Sampler "{}" "integer pixelsamples" {}'.format(samplerName, bpy.context.scene.iileIntegratorPathSamples))
+
+    b.appendLine(0, 'Scale -1 1 1')
+
+    # Get camera
+    if cameraObj is None:
+        cameraObj = bpy.context.scene.camera
+    theCamera = cameraObj.data
+
+    # The world transform, so that parented cameras render from where
+    # they are. The object is left as it is
+    cameraAngle, cameraAxis, cameraLocation = meshExport.worldAxisAngle(cameraObj.matrix_world)
+    log.debug("Camera {} rotation axis angle is {} {} {} {}".format(cameraObj.name, cameraAngle, cameraAxis[0], cameraAxis[1], cameraAxis[2]))
+
+    # Write camera rotation
+    cameraRotationAmount = math.degrees(cameraAngle)
+    cameraRotationX, cameraRotationY, cameraRotationZ = cameraAxis
+    # Flip Y
+    cameraRotationY = -cameraRotationY
+    b.appendLine(0, 'Rotate {} {} {} {}'.format(
+        cameraRotationAmount, cameraRotationX,
+        cameraRotationY, cameraRotationZ))
+
+    # Write camera translation
+    cameraLocX, cameraLocY, cameraLocZ = cameraLocation
+    # Flip Y
+    cameraLocY = -cameraLocY
+    b.appendLine(0, 'Translate {} {} {}'.format(
+        cameraLocX, cameraLocY, cameraLocZ))
+
+    # Write camera fov
+    b.appendLine(0, 'Camera "perspective" "float fov" [{}]'.format(math.degrees(theCamera.angle / 2.0)))
+
+    # Write world begin
+    if worldBegin:
+        b.appendLine(0, 'WorldBegin')
+    return b
+
+# Camera objects of a batch render, the selected cameras by name, or the
+# scene camera when no camera is selected
+def batchCameras(scene):
+    cameras = [obj for obj in scene.objects if obj.type == "CAMERA" and obj.select]
+    if len(cameras) == 0:
+        return [scene.camera]
+    return sorted(cameras, key=lambda obj: obj.name)
+
+# Fingerprint of the emission of the materials, which area lights take
+# their emission from
+def emissionFingerprint():
+    emitters = [(m.name, m.emit, tuple(m.iileEmission))
+        for m in bpy.data.materials.values() if m.emit > 0.0]
+    return hashlib.sha1(repr(emitters).encode("utf-8")).hexdigest()
+
+# =============================================================================
+# Geometry blocks transformation
+
+# Sets the area light emission color from the assigned material
+def setAreaLightEmission(block):
+    if not block.isAreaLightSource():
+        return block
+    matName = block.getAssignedMaterial()
+    if matName not in bpy.data.materials:
+        return block
+    matObj = bpy.data.materials[matName]
+    emitIntensity = matObj.emit
+    emitColor = [0.0, 0.0, 0.0]
+    emitColor[0] = emitIntensity * matObj.iileEmission[0]
+    emitColor[1] = emitIntensity * matObj.iileEmission[1]
+    emitColor[2] = emitIntensity * matObj.iileEmission[2]
+    block.replaceLine(3, '"rgb L"',
+        '"rgb L" [ {} {} {} ]'.format(
+            emitColor[0], emitColor[1], emitColor[2]))
+    return block
+
+# Returns the material shown by a material preview scene, or None for
+# world and lamp previews
+def previewMaterial(scene):
+    for obj in scene.objects:
+        if obj.hide_render or not obj.is_visible(scene):
+            continue
+        for slot in obj.material_slots:
+            if slot.material is not None:
+                return slot.material
+    return None
+
+# Materials from the geometry export are replaced by the header ones
+def stripNamedMaterial(block):
+    if block.isMakeNamedMaterial():
+        return None
+    return block
+
 # Render engine ================================================================================
 
 class IILERenderEngine(bpy.types.RenderEngine):
     bl_idname = "iile_renderer" # internal name
     bl_label = "PBRTv3" # Visible name
-    bl_use_preview = False # capabilities
-
-    def render(self, scene):
-
-        # Check first-run installation
-        install.install()
-
-        # Compute film dimensions
-        scale = scene.render.resolution_percentage / 100.0
-        sx = int(scene.render.resolution_x * scale)
-        sy = int(scene.render.resolution_y * scale)
-
-        print("Starting render, resolution {} {}".format(sx, sy))
-        textureUtil.resetTextureCounter()
-
-        # Compute pbrt executable path
-        pbrtExecPath = install.getExecutablePath(
-            scene.iilePath,
-            pbrt.DEFAULT_IILE_PROJECT_PATH,
-            "pbrt"
-        )
+    bl_use_preview = True # capabilities
+
+    # Legacy geometry export: background Blender OBJ export,
+    # obj2pbrt and PLY conversion
+    # Writes the export script and returns a function that runs the tools,
+    # and may be called on another thread. It does not use the engine: the
+    # tools stop when cancelled() returns True, and a failed tool raises
+    # processManager.ProcessError. The function returns the path of the
+    # converted scenefile
+    def exportGeometryObj(self, scene, outDir, cancelled=None):
+
+        # Compute obj2pbrt executable path
         obj2pbrtExecPath = install.getExecutablePath(
             scene.iilePath,
             pbrt.DEFAULT_IILE_PROJECT_PATH,
             "obj2pbrt"
         )
 
-        if pbrtExecPath is None:
-            errorMessage(self, "PBRT executable not found. The exporter can use the pbrt executable if it's in the system PATH, or you can specify the directory of the PBRT executable from the Render properties tab")
         if obj2pbrtExecPath is None:
             errorMessage(self, "obj2pbrt executable not found. The exporter can use the obj2pbrt executable if it's in the system PATH, or you can specify the directory of the PBRT and OBJ2PBRT executables from the Render properties tab")
 
-        print("PBRT: {}".format(pbrtExecPath))
-        print("OBJ2PBRT: {}".format(obj2pbrtExecPath))
-
-        # Determine PBRT project directory
-        if not os.path.exists(scene.iilePath):
-            # Check fallback
-            if not os.path.exists(pbrt.DEFAULT_IILE_PROJECT_PATH):
-                warningMessage(self, "WARNING no project directory found. Are you using vanilla PBRTv3? Some features might not work, such as IILE integrator and GUI renderer")
-            else:
-                scene.iilePath = pbrt.DEFAULT_IILE_PROJECT_PATH
-
-        rootDir = os.path.abspath(os.path.join(scene.iilePath, ".."))
+        log.info("OBJ2PBRT: {}".format(obj2pbrtExecPath))
 
-        # Get the output path
-        outDir = bpy.data.scenes["Scene"].render.filepath
-        outDir = bpy.path.abspath(outDir)
-        print("Out dir is {}".format(outDir))
         outObjPath = os.path.join(outDir, "exp.obj")
         outExpPbrtPath = os.path.join(outDir, "exp.pbrt")
         outExp2PbrtPath = os.path.join(outDir, "exp2.pbrt")
-        outScenePath = os.path.join(outDir, "scene.pbrt")
 
         # Create exporting script
         expScriptPath = os.path.join(outDir, "exp.py")
@@ -300,182 +523,377 @@ class IILERenderEngine(bpy.types.RenderEngine):
             "--python",
             expScriptPath
         ]
-        runCmd(cmd)
+        timeout = scene.iileExportTimeout * 60 if scene.iileExportTimeout > 0 else None
 
-        print("OBJ export completed")
+        def convert():
+            stage = self.profile.begin("obj export")
+            stage["exitStatus"] = runCmd(None, "Blender OBJ export", cmd, timeout=timeout,
+                cancelled=cancelled)
+            self.profile.addOutputFile(stage, outObjPath)
 
-        # Run obj2pbrt
-        cmd = [
-            obj2pbrtExecPath,
-            outObjPath,
-            outExpPbrtPath
-        ]
-        runCmd(cmd, cwd=outDir)
+            log.info("OBJ export completed")
 
-        # Run pbrt --toply
-        cmd = [
-            pbrtExecPath,
-            "--toply",
-            outExpPbrtPath
-        ]
-        outExp2PbrtFile = open(outExp2PbrtPath, "w")
-        runCmd(cmd, stdout=outExp2PbrtFile, cwd=outDir)
-        outExp2PbrtFile.close()
+            # Run obj2pbrt
+            obj2pbrtCmd = [
+                obj2pbrtExecPath,
+                outObjPath,
+                outExpPbrtPath
+            ]
+            stage = self.profile.begin("obj2pbrt")
+            stage["exitStatus"] = runCmd(None, "obj2pbrt", obj2pbrtCmd, cwd=outDir, timeout=timeout,
+                cancelled=cancelled)
+            self.profile.addOutputFile(stage, outExpPbrtPath)
 
-        # -----------------------------------------------------------
-        # Scene transformation
-        doc = sceneParser.SceneDocument()
-        doc.parse(outExp2PbrtPath)
+            # Move triangle meshes to PLY files, replaces pbrt --toply
+            self.profile.begin("toply")
+            plyConvert.convertToPly(outExpPbrtPath, outExp2PbrtPath, outDir)
+            self.profile.end()
 
-        # Write initial things
-        headerBlocks = []
+            return outExp2PbrtPath
 
-        # Film, Camera, transformations
-        b = sceneParser.SceneBlock([])
-        headerBlocks.append(b)
-        b.appendLine(0, 'Film "image" "integer xresolution" {} "integer yresolution" {}'.format(sx, sy))
+        return convert
 
-        # Integrator name
-        integratorName = "path"
-        if bpy.context.scene.iileIntegrator == "PATH":
-            integratorName = "path"
-        elif bpy.context.scene.iileIntegrator == "IILE":
-            integratorName = "iispt"
-        elif bpy.context.scene.iileIntegrator == "BDPT":
-            integratorName = "bdpt"
-        else:
-            errorMessage(self, "Unrecognized iileIntegrator {}".format(
-                bpy.context.scene.iileIntegrator))
-        b.appendLine(0, 'Integrator "{}"'.format(integratorName))
+    def render(self, scene):
+        if self.is_preview:
+            self.renderPreview(scene)
+            return
+
+        generalUtil.setLogLevel(scene.iileLogLevel)
+        self.profile = exportProfile.ExportProfile(scene.iileProfileExport)
 
-        # Integrator specifics
-        if bpy.context.scene.iileIntegrator == "PATH":
+        # Get the output path
+        outDir = bpy.data.scenes["Scene"].render.filepath
+        outDir = bpy.path.abspath(outDir)
+        log.info("Out dir is {}".format(outDir))
+
+        try:
+            self.exportScene(scene, outDir)
+        except processManager.ProcessCancelled as e:
+            self.profile.end("cancelled")
+            log.info("{}".format(e))
+        finally:
+            if os.path.isdir(outDir):
+                self.profile.write(outDir)
+
+    # Renders the material of a material preview scene with the cached
+    # preview template
+    def renderPreview(self, scene):
+        scale = scene.render.resolution_percentage / 100.0
+        sx = int(scene.render.resolution_x * scale)
+        sy = int(scene.render.resolution_y * scale)
+        pixels = None
+        try:
+            matObj = previewMaterial(scene)
+            # The preview scene does not carry the add-on settings
+            settings = bpy.data.scenes["Scene"] if "Scene" in bpy.data.scenes else scene
+            pbrtTool = toolchain.getToolchain().lookup("pbrt",
+                [settings.iilePath, pbrt.DEFAULT_IILE_PROJECT_PATH])
+            if matObj is not None and pbrtTool is not None:
+                # The previewed material may be a copy of the one in
+                # bpy.data, the materials it mixes are looked up by name
+                def createBlocks(outDir):
+                    blocks = []
+                    for matName in materialTree.resolveMaterialOrder([matObj.name]):
+                        if matName == matObj.name:
+                            obj = matObj
+                        elif matName in bpy.data.materials:
+                            obj = bpy.data.materials[matName]
+                        else:
+                            obj = createEmptyMaterialObject()
+                        blocks.append(createMaterialBlock(self, matName, obj, outDir))
+                    return blocks
+                def runPbrt(cmd, cwd):
+                    runCmd(self, "pbrt", cmd, cwd=cwd)
+                pixels = materialPreview.getPreviewRenderer().render(
+                    matObj.name, sx, sy, pbrtTool.path, createBlocks, runPbrt)
+        except processManager.ProcessCancelled:
             pass
-        elif bpy.context.scene.iileIntegrator == "BDPT":
-            b.appendLine(1, '"integer maxdepth" [{}]'.format(bpy.context.scene.iileIntegratorBdptMaxdepth))
-            b.appendLine(1, '"string lightsamplestrategy" "{}"'.format(bpy.context.scene.iileIntegratorBdptLightsamplestrategy.lower()))
-            b.appendLine(1, '"bool visualizestrategies" "{}"'.format("true" if bpy.context.scene.iileIntegratorBdptVisualizestrategies else "false"))
-            b.appendLine(1, '"bool visualizeweights" "{}"'.format("true" if bpy.context.scene.iileIntegratorBdptVisualizeweights else "false"))
+        except Exception as e:
+            log.warning("Material preview failed: {}".format(e))
 
-        samplerName = "random"
-        if bpy.context.scene.iileIntegratorPathSampler == "RANDOM":
-            samplerName = "random"
-        elif bpy.context.scene.iileIntegratorPathSampler == "SOBOL":
-            samplerName = "sobol"
-        elif bpy.context.scene.iileIntegratorPathSampler == "HALTON":
-            samplerName = "halton"
+        result = self.begin_result(0, 0, sx, sy)
+        try:
+            if pixels is not None:
+                setResultPixels(result, pixels)
+        finally:
+            self.end_result(result)
+
+    # Returns a function that calls fn in profile stage name
+    def profiled(self, name, fn):
+        def run():
+            self.profile.begin(name)
+            try:
+                result = fn()
+            except:
+                self.profile.end("failed")
+                raise
+            self.profile.end()
+            return result
+        return run
+
+    # Renders every scene file in tiles, each one to a PFM next to it
+    def renderTiled(self, scene, pbrtPath, scenePaths, sx, sy):
+        if scene.iileRenderExecutor == "SSH":
+            hosts = [h.strip() for h in scene.iileRenderHosts.split(",") if h.strip() != ""]
+            if len(hosts) == 0:
+                errorMessage(self, "No render hosts set")
+            executor = tiledRender.SshExecutor(hosts, scene.iileRenderWorkers)
         else:
-            errorMessage(self, "Unrecognized sampler {}".format(bpy.context.scene.iileIntegratorPathSampler))
-
-        b.appendLine(0, 'Sampler "{}" "integer pixelsamples" {}'.format(samplerName, bpy.context.scene.iileIntegratorPathSamples))
+            executor = tiledRender.LocalExecutor(scene.iileRenderWorkers)
+
+        stage = self.profile.begin("tiled render")
+        stage["workers"] = len(executor.slots)
+        for i, scenePath in enumerate(scenePaths):
+            def progress(fraction):
+                self.update_progress((i + fraction) / len(scenePaths))
+            def onTile(tile, pixels):
+                self.showPixels(pixels, tile.x0, tile.y0, sy)
+            outPath = os.path.splitext(scenePath)[0] + ".pfm"
+            tiledRender.renderTiles(pbrtPath, scenePath, outPath, sx, sy,
+                scene.iileTileSize, executor, scene.iileWorkerThreads,
+                progress, self.test_break, onTile)
+            self.profile.addOutputFile(stage, outPath)
+        self.profile.end()
+
+    # Shows pixels at (x, y) of the image, y from the top
+    def showPixels(self, pixels, x, y, sy):
+        height, width = pixels.shape[:2]
+        result = self.begin_result(x, sy - y - height, width, height)
+        setResultPixels(result, pixels)
+        self.end_result(result)
+
+    # Renders every scene file with pbrt, each one to an image next to it
+    def renderFrames(self, scene, pbrtPath, scenePaths, sx, sy):
+        stage = self.profile.begin("render")
+        for i, scenePath in enumerate(scenePaths):
+            def progress(fraction):
+                self.update_progress((i + fraction) / len(scenePaths))
+            imagePath = os.path.splitext(scenePath)[0] + "." + scene.iileImageFormat.lower()
+            self.renderImage(pbrtPath, scenePath, imagePath, sx, sy, progress)
+            self.profile.addOutputFile(stage, imagePath)
+        self.profile.end()
+
+    # Runs pbrt on scenePath and shows imagePath in the render result
+    # The image is reloaded whenever pbrt rewrites it while running
+    def renderImage(self, pbrtPath, scenePath, imagePath, sx, sy, progress):
+        if os.path.exists(imagePath):
+            os.remove(imagePath)
+        cmd = [pbrtPath, "--outfile", imagePath, scenePath]
+        result = self.begin_result(0, 0, sx, sy)
+        shownTime = None
+        lastCheck = time.time()
+        def refresh():
+            nonlocal shownTime, lastCheck
+            if time.time() - lastCheck >= RESULT_REFRESH_SECONDS:
+                lastCheck = time.time()
+                shownTime = self.refreshResult(result, imagePath, shownTime)
+        try:
+            runCmd(self, "pbrt", cmd, cwd=os.path.dirname(scenePath),
+                onPoll=refresh, onProgress=progress)
+            setResultPixels(result, imageIo.readImage(imagePath))
+        finally:
+            self.end_result(result)
+
+    # Shows imagePath in the render result if it changed since shownTime
+    # Returns the modification time of the image shown
+    def refreshResult(self, result, imagePath, shownTime):
+        try:
+            mtime = os.path.getmtime(imagePath)
+            if mtime == shownTime:
+                return shownTime
+            setResultPixels(result, imageIo.readImage(imagePath))
+        except Exception:
+            # Not written yet, or being written
+            return shownTime
+        self.update_result(result)
+        return mtime
+
+    def exportScene(self, scene, outDir):
 
-        b.appendLine(0, 'Scale -1 1 1')
+        # Check first-run installation
+        self.profile.begin("install")
+        install.install()
+        self.profile.end()
 
-        # Get camera
-        theCameraName = bpy.context.scene.camera.name
-        theCamera = bpy.data.cameras[theCameraName]
+        # Compute film dimensions
+        scale = scene.render.resolution_percentage / 100.0
+        sx = int(scene.render.resolution_x * scale)
+        sy = int(scene.render.resolution_y * scale)
 
-        bpy.context.scene.camera.rotation_mode = "AXIS_ANGLE"
-        print("Camera rotation axis angle is {} {} {} {}".format(bpy.context.scene.camera.rotation_axis_angle[0], bpy.context.scene.camera.rotation_axis_angle[1], bpy.context.scene.camera.rotation_axis_angle[2], bpy.context.scene.camera.rotation_axis_angle[3]))
+        log.info("Starting render, resolution {} {}".format(sx, sy))
 
-        # Write camera rotation
-        cameraRotationAmount = bpy.context.scene.camera.rotation_axis_angle[0]
-        cameraRotationAmount = math.degrees(cameraRotationAmount)
-        cameraRotationX, cameraRotationY, cameraRotationZ = \
-            bpy.context.scene.camera.rotation_axis_angle[1:]
-        # Flip Y
-        cameraRotationY = -cameraRotationY
-        b.appendLine(0, 'Rotate {} {} {} {}'.format(
-            cameraRotationAmount, cameraRotationX,
-            cameraRotationY, cameraRotationZ))
+        # Determine PBRT project directory
+        if not os.path.exists(scene.iilePath):
+            # Check fallback
+            if not os.path.exists(pbrt.DEFAULT_IILE_PROJECT_PATH):
+                warningMessage(self, "WARNING no project directory found. Are you using vanilla PBRTv3? Some features might not work, such as IILE integrator and GUI renderer")
+            else:
+                scene.iilePath = pbrt.DEFAULT_IILE_PROJECT_PATH
 
-        # Write camera translation
-        cameraLocX, cameraLocY, cameraLocZ = bpy.context.scene.camera.location
-        # Flip Y
-        cameraLocY = -cameraLocY
-        b.appendLine(0, 'Translate {} {} {}'.format(
-            cameraLocX, cameraLocY, cameraLocZ))
+        rootDir = os.path.abspath(os.path.join(scene.iilePath, ".."))
 
-        # Write camera fov
-        b.appendLine(0, 'Camera "perspective" "float fov" [{}]'.format(math.degrees(theCamera.angle / 2.0)))
+        # Executables are found and checked without running them
+        stage = self.profile.begin("toolchain")
+        pbrtTool = toolchain.getToolchain().lookup("pbrt",
+            [scene.iilePath, pbrt.DEFAULT_IILE_PROJECT_PATH])
+        if pbrtTool is not None:
+            stage["pbrt"] = pbrtTool.path
+            stage["pbrtVersion"] = pbrtTool.version
+            if scene.iileIntegrator == "IILE" and not pbrtTool.hasCapability("iispt"):
+                warningMessage(self, "{} does not support the IILE integrator".format(pbrtTool.path))
+        self.profile.end()
 
-        # Write world begin
-        b.appendLine(0, 'WorldBegin')
+        outScenePath = os.path.join(outDir, "scene.pbrt")
 
-        # Set environment lighting
-        envBlock = lightEnv.createEnvironmentBlock(scene.world, outDir)
-        if envBlock is not None:
-            headerBlocks.append(envBlock)
+        # Views as (camera object, camera part, scene file, image name)
+        # A camera batch writes one camera part and scene file per camera,
+        # which share the other parts
+        if scene.iileCameraBatch and not scene.iileExportAnimation:
+            cameraObjs = batchCameras(scene)
+            stems = sceneParts.batchStems([cameraObj.name for cameraObj in cameraObjs])
+            views = [(cameraObj, sceneParts.batchCameraName(stem),
+                os.path.join(outDir, sceneParts.batchSceneName(stem)), sceneParts.batchImageName(stem))
+                for cameraObj, stem in zip(cameraObjs, stems)]
+            outScenePath = views[0][2]
+            log.info("Rendering {} cameras: {}".format(len(views),
+                ", ".join(cameraObj.name for cameraObj in cameraObjs)))
+        else:
+            views = [(scene.camera, sceneParts.CAMERA_NAME, outScenePath, None)]
+
+        # Previews at a reduced resolution do not need full size textures
+        proxySize = None
+        if scene.iileTextureProxies and scene.render.resolution_percentage < 100:
+            proxySize = max(sx, sy)
+        textureUtil.beginTextures(outDir, scene.iileTextureStoreSize * 1024 * 1024, proxySize,
+            scene.iileTextureNormalize)
+
+        # Stages that use the Blender API run in order on this thread, the
+        # OBJ tools and the texture wait overlap with them. Cancelling the
+        # render is checked on this thread and stops the worker stages
+        graph = stageGraph.StageGraph(stopRequested=self.test_break)
+
+        # Environment and materials come first, so that their textures are
+        # converted in the background while geometry is exported
+        # The materials are those of the objects the geometry export
+        # writes, which for the OBJ exporter includes hidden objects
+        graph.add("environment", self.profiled("environment",
+            lambda: lightEnv.createEnvironmentBlock(scene.world, outDir)), mainThread=True)
+        renderedOnly = scene.iileGeometryExport == "NATIVE"
+        graph.add("materials", self.profiled("materials",
+            lambda: createMaterialBlocks(self, outDir,
+                meshExport.collectGeometryObjects(scene, renderedOnly), scene.iileMaterialCache)),
+            mainThread=True)
 
-        # Do materials
-        materialsResolutionOrder = materialTree.buildMaterialsDependencies()
+        # Film, Camera, transformations
+        graph.add("camera", self.profiled("camera",
+            lambda: [createCameraBlock(self, sx, sy, imageName, scene.iileExportAnimation, cameraObj)
+                for cameraObj, cameraName, scenePath, imageName in views]),
+            mainThread=True)
 
-        for i in range(len(materialsResolutionOrder)):
-            matName = materialsResolutionOrder[i]
-            matBlock = sceneParser.SceneBlock([])
-            headerBlocks.append(matBlock)
+        # Textures are staged in the background until here
+        graph.add("textures", self.profiled("textures", textureUtil.waitTextures),
+            ["environment", "materials"])
 
-            matBlock.appendLine(0, 'MakeNamedMaterial "{}"'.format(matName))
-            print("Processing material {}".format(matName))
-            if matName not in bpy.data.materials:
-                matObj = createEmptyMaterialObject()
+        # -----------------------------------------------------------
+        # Geometry export
+        # Animations export geometry frame by frame with the scene files
+        if scene.iileExportAnimation:
+            if scene.iileGeometryExport != "NATIVE":
+                errorMessage(self, "Animation export requires the native geometry export")
+            outScenePath = os.path.join(outDir, animationExport.frameSceneName(scene.frame_start))
+            geometryDeps = []
+        elif scene.iileGeometryExport == "NATIVE":
+            graph.add("geometry", self.profiled("geometry",
+                lambda: meshExport.exportGeometry(scene, outDir, scene.iileGeometryCache)),
+                mainThread=True)
+            geometryDeps = ["geometry"]
+        else:
+            # The OBJ tools run on a worker thread, the scene is parsed
+            # while it is written
+            graph.add("geometry", self.exportGeometryObj(scene, outDir, graph.cancelled))
+            geometryDeps = ["geometry"]
+
+        def writeScene():
+            textureErrors = graph.result("textures")
+            if len(textureErrors) > 0:
+                errorMessage(self, "\n".join(textureErrors))
+
+            envBlocks = []
+            if graph.result("environment") is not None:
+                envBlocks.append(graph.result("environment"))
+            materialBlocks = graph.result("materials")
+
+            # Geometry blocks are transformed and written one at a time
+            geometryStages = [setAreaLightEmission, stripNamedMaterial]
+            if scene.iileExportAnimation:
+                stage = self.profile.begin("animation")
+                stage.update(animationExport.exportAnimation(scene, outDir, envBlocks + materialBlocks,
+                    lambda frame: createCameraBlock(self, sx, sy, animationExport.frameImageName(frame)),
+                    geometryStages, scene.iileGeometryCache))
+                self.profile.end()
+                return
+
+            # The scene file includes one file per part, parts that did not
+            # change since the last render are not written again
+            stage = self.profile.begin("write scene")
+            parts = sceneParts.SceneParts(outDir)
+            parts.load()
+            for view, cameraBlock in zip(views, graph.result("camera")):
+                parts.write(view[1],
+                    sceneParts.blocksFingerprint([cameraBlock]), lambda: [cameraBlock])
+            parts.write(sceneParts.ENVIRONMENT_NAME,
+                sceneParts.blocksFingerprint(envBlocks), lambda: envBlocks)
+            parts.write(sceneParts.MATERIALS_NAME,
+                sceneParts.blocksFingerprint(materialBlocks), lambda: materialBlocks)
+
+            # Geometry is fingerprinted before area lights get their emission
+            geometry = graph.result("geometry")
+            if scene.iileGeometryExport == "NATIVE":
+                geometryFingerprint = sceneParts.blocksFingerprint(geometry)
+                geometryBlocks = lambda: geometry
             else:
-                matObj = bpy.data.materials[matName]
-            # Write material type
-            if matObj.iileMaterial == "MATTE":
-                processMatteMaterial(matName, outDir, matBlock, matObj)
-            elif matObj.iileMaterial == "PLASTIC":
-                processPlasticMaterial(matName, outDir, matBlock, matObj)
-            elif matObj.iileMaterial == "MIRROR":
-                processMirrorMaterial(matName, outDir, matBlock, matObj)
-            elif matObj.iileMaterial == "MIX":
-                processMixMaterial(matName, outDir, matBlock, matObj)
-            elif matObj.iileMaterial == "GLASS":
-                processGlassMaterial(matName, outDir, matBlock, matObj)
-            elif matObj.iileMaterial == "NONE":
-                processNoneMaterial(matName, outDir, matBlock, matObj)
+                geometryFingerprint = sceneParts.fileFingerprint(geometry)
+                geometryBlocks = lambda: pbrtParser.iterSceneBlocks(geometry)
+            parts.write(sceneParts.GEOMETRY_NAME,
+                "{} {}".format(geometryFingerprint, emissionFingerprint()),
+                lambda: sceneParser.pipeline(geometryBlocks(), geometryStages))
+
+            for cameraObj, cameraName, scenePath, imageName in views:
+                parts.writeScene(scenePath, cameraName)
+            parts.save()
+            stage["written"] = parts.written
+            stage["cameras"] = len(views)
+            self.profile.end()
+
+        graph.add("write scene", writeScene,
+            ["camera", "environment", "materials", "textures"] + geometryDeps, mainThread=True)
+        graph.add("texture store", self.profiled("texture store", textureUtil.endTextures),
+            ["write scene"], mainThread=True)
+
+        # Worker stages cannot report, their tool failures are reported here
+        try:
+            graph.run()
+        except processManager.ProcessError as e:
+            errorMessage(self, "{}".format(e))
+        finally:
+            self.profile.setGraph(graph.summary())
+
+        log.info("Rendering finished.")
+
+        if scene.iileExportAnimation:
+            scenePaths = [os.path.join(outDir, animationExport.frameSceneName(frame))
+                for frame in animationExport.frameRange(scene)]
+        else:
+            scenePaths = [scenePath for cameraObj, cameraName, scenePath, imageName in views]
+        renderWithPbrt = scene.iileTiledRender or scene.iileRenderImage
+        if renderWithPbrt and pbrtTool is None:
+            errorMessage(self, "pbrt executable not found in {}".format(scene.iilePath))
 
-            else:
-                errorMessage(self, "Unrecognized material {}".format(
-                    matObj.iileMaterial))
-
-        blocks = doc.getBlocks()
-        for block in blocks:
-
-            # Set area light emission color
-            if block.isAreaLightSource():
-                print("Processing an area light source")
-                matName = block.getAssignedMaterial()
-                print(matName)
-                if matName not in bpy.data.materials:
-                    continue
-                matObj = bpy.data.materials[matName]
-                emitIntensity = matObj.emit
-                emitColor = [0.0, 0.0, 0.0]
-                emitColor[0] = emitIntensity * matObj.iileEmission[0]
-                emitColor[1] = emitIntensity * matObj.iileEmission[1]
-                emitColor[2] = emitIntensity * matObj.iileEmission[2]
-                block.replaceLine(3, '"rgb L"',
-                    '"rgb L" [ {} {} {} ]'.format(
-                        emitColor[0], emitColor[1], emitColor[2]))
-
-            # Set material properties
-            if block.isMakeNamedMaterial():
-                block.clearAll()
-
-        doc.addBlocksBeginning(headerBlocks)
-
-        # WorldEnd block
-        weBlock = sceneParser.SceneBlock([])
-        weBlock.appendLine(0, "WorldEnd")
-        doc.addBlocksEnd([weBlock])
-
-        doc.write(outScenePath)
-
-        print("Rendering finished.")
-
-        if (bpy.context.scene.iileIntegrator == "IILE") and bpy.context.scene.iileStartRenderer:
-            print("Starting IILE GUI...")
+        if scene.iileTiledRender:
+            self.renderTiled(scene, pbrtTool.path, scenePaths, sx, sy)
+
+        elif (bpy.context.scene.iileIntegrator == "IILE") and bpy.context.scene.iileStartRenderer:
+            log.info("Starting IILE GUI...")
 
             # Setup PATH for nodejs executable
             nodeBinDir = install.findNodeDir(scene.iilePath)
@@ -486,14 +904,17 @@ class IILERenderEngine(bpy.types.RenderEngine):
                 if not oldPath.endswith(addition):
                     oldPath = oldPath + addition
                 newEnv["PATH"] = oldPath
-                print("Updated PATH to {}".format(oldPath))
+                log.debug("Updated PATH to {}".format(oldPath))
 
             guiDir = os.path.join(rootDir, "gui")
-            electronPath = os.path.join(guiDir,
+            electronDir = os.path.join(guiDir,
                 "node_modules",
                 "electron",
-                "dist",
-                "electron")
+                "dist")
+            electronTool = toolchain.getToolchain().lookup("electron", [electronDir], usePath=False)
+            if electronTool is None:
+                errorMessage(self, "Electron not found in {}".format(electronDir))
+            electronPath = electronTool.path
             jsPbrtPath = os.path.join(rootDir,
                 "bin",
                 "pbrt")
@@ -504,7 +925,13 @@ class IILERenderEngine(bpy.types.RenderEngine):
             cmd.append(outScenePath)
             cmd.append("{}".format(bpy.context.scene.iileIntegratorIileIndirect))
             cmd.append("{}".format(bpy.context.scene.iileIntegratorIileDirect))
-            runCmd(cmd, cwd=guiDir, env=newEnv)
+            stage = self.profile.begin("iile gui")
+            stage["exitStatus"] = runCmd(self, "IILE GUI", cmd, cwd=guiDir, env=newEnv)
+            self.profile.end()
 
-        result = self.begin_result(0, 0, sx, sy)
-        self.end_result(result)
\ No newline at end of file
+        elif scene.iileRenderImage:
+            self.renderFrames(scene, pbrtTool.path, scenePaths, sx, sy)
+
+        if not renderWithPbrt:
+            result = self.begin_result(0, 0, sx, sy)
+            self.end_result(result)
\ No newline at end of file
@@ -1,100 +1,314 @@
 # Scene parser ===================================================================================
 
+import itertools
+import mmap
+import os
+import re
+
+import generalUtil
+
+log = generalUtil.getLogger(__name__)
+
 TABSIZE = 4
 
+# Blocks with fewer lines are scanned instead of indexed
+INDEX_MIN_LINES = 16
+
+# Shared placeholder for blocks without prepended lines
+EMPTY = ()
+
+# Newlines followed by a line that starts a block: a line not indented
+# by a whole number of levels
+BLOCK_BREAK = re.compile(rb"\n(?!(?:" + b" " * TABSIZE + rb")+(?! ))")
+
+# Serialized output buffered before a write
+WRITE_BUFFER = 1 << 20
+
 def lineIndentTabs(l):
-    count = 0
-    for c in l:
-        if c == ' ':
-            count += 1
-        else:
-            break
+    count = len(l) - len(l.lstrip(" "))
     if (count % TABSIZE) != 0:
         return 0
-    return count / TABSIZE
+    return count // TABSIZE
 
 def indentBy(l, levels):
-    idt = ""
-    for i in range(TABSIZE * levels):
-        idt += " "
-    return idt + l
+    return " " * (TABSIZE * levels) + l
+
+# Index key of a line without its indentation:
+# the directive name, or the full quoted parameter declaration
+def lineKey(rawLine):
+    if rawLine.startswith('"'):
+        end = rawLine.find('"', 1)
+        if end >= 0:
+            return rawLine[:end + 1]
+        return rawLine
+    return rawLine.split(" ", 1)[0]
 
 # A block is a collection of lines part of a logical block,
 # for example in MakeNamedMaterial or in AttributeBegin
+# Indentation levels are computed once when lines are added. Blocks of
+# INDEX_MIN_LINES or more get a level -> key -> positions index, built on
+# the first lookup and then kept up to date, smaller blocks are cheaper
+# to scan. Levels are stored in bytearrays, which the garbage collector
+# does not track. Prepended lines are kept in a separate
+# reversed list so that both ends can grow in O(1). Positions are
+# negative for prepended lines: -1 is the first line of the block.
+# Blocks read from a file keep their byte range in the source and only
+# split it into lines when a line is looked at. Until the block is
+# modified, writeBlocks copies the range instead of serializing it.
 class SceneBlock():
 
-    def __init__(self, lines):
-        self.lines = lines
+    __slots__ = ("head", "headLevels", "body", "bodyLevels", "index", "blockType",
+        "source", "start", "end", "node")
+
+    def __init__(self, lines, levels=None):
+        self.head = EMPTY
+        self.headLevels = EMPTY
+        self.body = lines
+        if levels is None:
+            levels = bytearray(lineIndentTabs(l) for l in lines)
+        self.bodyLevels = levels
+        self.index = None
+        self.blockType = lines[0].split(" ", 1)[0] if len(lines) > 0 else None
+        self.source = None
+        self.start = 0
+        self.end = 0
+        self.node = None
+
+    # Splits the source range into lines, the first time lines are needed
+    # Blocks with a node take their lines from its formatLines()
+    def load(self):
+        if self.node is not None:
+            formatted = self.node.formatLines()
+            self.body = [indentBy(text, level) for level, text in formatted]
+            self.bodyLevels = bytearray(level for level, text in formatted)
+            self.node = None
+        else:
+            text = self.source.data[self.start:self.end].decode("utf-8")
+            if text.endswith("\n"):
+                text = text[:-1]
+            self.body = text.split("\n")
+            self.bodyLevels = bytearray(lineIndentTabs(l) for l in self.body)
+
+    # True until the block is modified
+    def isUnmodified(self):
+        return self.source is not None
+
+    # All lines of the block, in order
+    @property
+    def lines(self):
+        if self.body is None:
+            self.load()
+        return list(itertools.chain(reversed(self.head), self.body))
+
+    def lineCount(self):
+        if self.body is None:
+            self.load()
+        return len(self.head) + len(self.body)
+
+    def addLine(self, line, level, atBeginning):
+        if self.body is None:
+            self.load()
+        self.source = None
+        if atBeginning:
+            if self.head is EMPTY:
+                self.head = []
+                self.headLevels = bytearray()
+            self.head.append(line)
+            self.headLevels.append(level)
+            pos = -len(self.head)
+        else:
+            self.body.append(line)
+            self.bodyLevels.append(level)
+            pos = len(self.body) - 1
+        if self.index is not None:
+            self.indexLine(pos, level, lineKey(line[(TABSIZE * level):]))
+
+    def buildIndex(self):
+        self.index = {}
+        for i in range(len(self.head)):
+            level = self.headLevels[i]
+            self.indexLine(-i - 1, level, lineKey(self.head[i][(TABSIZE * level):]))
+        for i in range(len(self.body)):
+            level = self.bodyLevels[i]
+            self.indexLine(i, level, lineKey(self.body[i][(TABSIZE * level):]))
+
+    def indexLine(self, pos, level, key):
+        keys = self.index.setdefault(level, {})
+        if key in keys:
+            keys[key].append(pos)
+        else:
+            keys[key] = [pos]
+
+    def unindexLine(self, pos, level, key):
+        keys = self.index[level]
+        keys[key].remove(pos)
+        if len(keys[key]) == 0:
+            del keys[key]
+
+    def getLine(self, pos):
+        if pos < 0:
+            return self.head[-pos - 1]
+        return self.body[pos]
+
+    def setLine(self, pos, line):
+        self.source = None
+        if pos < 0:
+            self.head[-pos - 1] = line
+        else:
+            self.body[pos] = line
+
+    def firstLine(self):
+        if self.body is None:
+            self.load()
+        if len(self.head) > 0:
+            return self.head[-1]
+        if len(self.body) > 0:
+            return self.body[0]
+        return None
+
+    def updateBlockType(self):
+        first = self.firstLine()
+        if first is None:
+            self.blockType = None
+        else:
+            self.blockType = first.split(" ", 1)[0]
+
+    # Positions of the lines at <level> that start with <startMatch>, in order
+    # Only the lines whose key is compatible with startMatch are looked at,
+    # a block has few distinct keys per level
+    def matchPositions(self, level, startMatch):
+        if self.index is None:
+            if self.lineCount() < INDEX_MIN_LINES:
+                return self.scanPositions(level, startMatch)
+            self.buildIndex()
+        keys = self.index.get(level)
+        if keys is None:
+            return []
+        res = []
+        for key, positions in keys.items():
+            if key.startswith(startMatch):
+                res.extend(positions)
+            elif startMatch.startswith(key):
+                for pos in positions:
+                    if self.getLine(pos)[(TABSIZE * level):].startswith(startMatch):
+                        res.append(pos)
+        res.sort()
+        return res
+
+    def scanPositions(self, level, startMatch):
+        offset = TABSIZE * level
+        res = []
+        for i in range(len(self.head) - 1, -1, -1):
+            if self.headLevels[i] == level and self.head[i].startswith(startMatch, offset):
+                res.append(-i - 1)
+        for i in range(len(self.body)):
+            if self.bodyLevels[i] == level and self.body[i].startswith(startMatch, offset):
+                res.append(i)
+        return res
 
     # Returns the string representation for writing to file
     # There is no trailing \n
     def toString(self):
-        return "\n".join(self.lines)
+        if self.body is None:
+            self.load()
+        if len(self.head) == 0:
+            return "\n".join(self.body)
+        return "\n".join(itertools.chain(reversed(self.head), self.body))
 
     # Returns None if this type of block is not recognized
     def getBlockType(self):
-        if len(self.lines) == 0:
-            return None
-        first = self.lines[0]
-        splt = first.split(" ")
-        if len(splt) != 0:
-            return splt[0]
-        else:
-            return None
+        return self.blockType
 
     # Replaces a line content
     # if the line is at the specified <level> of indentation
     # and if it starts with <startMatch>
     def replaceLine(self, level, startMatch, newStr):
-        for i in range(len(self.lines)):
-            l = self.lines[i]
-            if lineIndentTabs(l) == level:
-                rawLine = l[(TABSIZE * level):]
-                if rawLine.startswith(startMatch):
-                    transformedLine = indentBy(newStr, level)
-                    self.lines[i] = transformedLine
+        positions = self.matchPositions(level, startMatch)
+        if len(positions) == 0:
+            return
+        newKey = lineKey(newStr)
+        for pos in positions:
+            oldKey = lineKey(self.getLine(pos)[(TABSIZE * level):])
+            self.setLine(pos, indentBy(newStr, level))
+            if oldKey != newKey and self.index is not None:
+                self.unindexLine(pos, level, oldKey)
+                self.indexLine(pos, level, newKey)
+        # The first line is the last prepended one, or body line 0
+        firstPos = -len(self.head) if len(self.head) > 0 else 0
+        if firstPos in positions:
+            self.updateBlockType()
 
     # Matching function
     def contains(self, level, startMatch):
-        for i in range(len(self.lines)):
-            l = self.lines[i]
-            if lineIndentTabs(l) == level:
-                rawLine = l[(TABSIZE * level):]
-                if rawLine.startswith(startMatch):
-                    return True
-        return False
+        if self.body is None:
+            found = self.sourceContains(level, startMatch)
+            if found is not None:
+                return found
+        return len(self.matchPositions(level, startMatch)) > 0
+
+    # contains() without splitting the source into lines
+    # Returns None when the source cannot answer
+    def sourceContains(self, level, startMatch):
+        if self.node is not None:
+            if level == 0:
+                heads = [self.node]
+                if self.node.closer is not None:
+                    heads.append(self.node.closer)
+            elif level == 1 and self.node.children is not None:
+                heads = self.node.children
+            else:
+                return None
+            return any(h.headText().startswith(startMatch) for h in heads)
+        if len(startMatch) == 0 or startMatch.startswith(" "):
+            return None
+        pattern = (" " * (TABSIZE * level) + startMatch).encode("utf-8")
+        data = self.source.data
+        if level == 0:
+            return data[self.start:self.start + len(pattern)] == pattern
+        return data.find(b"\n" + pattern, self.start, self.end) >= 0
 
     def findLine(self, level, startMatch):
-        for i in range(len(self.lines)):
-            l = self.lines[i]
-            if lineIndentTabs(l) == level:
-                rawLine = l[(TABSIZE * level):]
-                if rawLine.startswith(startMatch):
-                    return rawLine
-        return None
+        positions = self.matchPositions(level, startMatch)
+        if len(positions) == 0:
+            return None
+        return self.getLine(positions[0])[(TABSIZE * level):]
 
     # Finds AttributeBegin->AreaLightSource blocks
     def isAreaLightSource(self):
-        return (self.getBlockType() == "AttributeBegin") and (self.contains(1, "AreaLightSource"))
+        return (self.blockType == "AttributeBegin") and (self.contains(1, "AreaLightSource"))
 
     def isMakeNamedMaterial(self):
-        return self.getBlockType() == "MakeNamedMaterial"
+        return self.blockType == "MakeNamedMaterial"
 
     def getMaterialDefinitionName(self):
-        first = self.lines[0].rstrip()
+        first = self.firstLine().rstrip()
         splt = first.split(" ")
         return " ".join(splt[1:]).replace('"', '')
 
     def clearBody(self):
-        if len(self.lines) >= 1:
-            self.lines = self.lines[0:1]
-    
+        first = self.firstLine()
+        if first is None:
+            return
+        level = self.headLevels[-1] if len(self.head) > 0 else self.bodyLevels[0]
+        self.clearAll()
+        self.addLine(first, level, False)
+        self.updateBlockType()
+
     def clearAll(self):
-        self.lines = []
+        self.source = None
+        self.node = None
+        self.head = EMPTY
+        self.headLevels = EMPTY
+        self.body = []
+        self.bodyLevels = bytearray()
+        self.index = None
+        self.blockType = None
 
     def getAssignedMaterial(self):
-        if self.getBlockType() == "AttributeBegin":
+        if self.blockType == "AttributeBegin":
             line = self.findLine(1, "NamedMaterial")
+            if line is None:
+                return None
             splt = line.split(" ")
             if len(splt) > 0:
                 selection = splt[1:]
@@ -105,11 +319,198 @@ class SceneBlock():
             return None
 
     def appendLine(self, level, content):
-        self.lines.append(indentBy(content, level))
+        self.addLine(indentBy(content, level), level, False)
+        if self.lineCount() == 1:
+            self.updateBlockType()
 
     def addBeginning(self, level, content):
-        newLine = indentBy(content, level)
-        self.lines = [newLine] + self.lines
+        self.addLine(indentBy(content, level), level, True)
+        self.updateBlockType()
+
+# Streaming ====================================================================
+
+# A scenefile mapped in memory
+# Blocks read from it keep a reference to it, the file is closed
+# when the last of them is released
+class SourceFile():
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            self.data = b""
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap) and not self.data.closed:
+            self.data.close()
+        self.file.close()
+
+    def __del__(self):
+        self.close()
+
+# Creates an unloaded block for the byte range [start, end) of source
+# node, if given, provides the lines through its formatLines()
+# This runs once per block of large files, the slots are set directly
+def sourceBlock(source, start, end, blockType=None, node=None):
+    if blockType is None:
+        lineEnd = source.data.find(b"\n", start, end)
+        if lineEnd < 0:
+            lineEnd = end
+        blockType = source.data[start:lineEnd].split(b" ", 1)[0].decode("utf-8")
+    block = SceneBlock.__new__(SceneBlock)
+    block.head = EMPTY
+    block.headLevels = EMPTY
+    block.body = None
+    block.bodyLevels = None
+    block.index = None
+    block.blockType = blockType
+    block.source = source
+    block.start = start
+    block.end = end
+    block.node = node
+    return block
+
+# Yields the blocks of a scenefile one at a time
+# Block boundaries are found on the mapped file, lines are only
+# decoded for the blocks that are looked at
+def iterBlocks(filepath):
+    source = SourceFile(filepath)
+    size = len(source.data)
+    start = 0
+    for m in BLOCK_BREAK.finditer(source.data):
+        pos = m.end()
+        if pos >= size:
+            break
+        if pos > start:
+            yield sourceBlock(source, start, pos)
+            start = pos
+    if start < size:
+        yield sourceBlock(source, start, size)
+
+# Passes every block through the stages in order
+# A stage takes a block and returns it, possibly modified,
+# or None to drop it from the output
+def pipeline(blocks, stages):
+    for block in blocks:
+        for stage in stages:
+            block = stage(block)
+            if block is None:
+                break
+        if block is not None:
+            yield block
+
+# Output of writeBlocks
+# Serialized blocks are buffered, unmodified source ranges are merged
+# when contiguous and copied between file descriptors by the kernel,
+# with copy_file_range or sendfile, falling back to a write of the
+# mapped bytes
+class BlockWriter():
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.buffer = []
+        self.bufferSize = 0
+        # (source, start, end) of the range waiting to be copied
+        self.pending = None
+        self.useCopyFileRange = hasattr(os, "copy_file_range")
+        self.useSendfile = hasattr(os, "sendfile")
+        self.serializedBytes = 0
+        self.copiedBytes = 0
+
+    def writeAll(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            written = os.write(self.fd, view)
+            view = view[written:]
+
+    def flushBuffer(self):
+        if len(self.buffer) > 0:
+            data = "".join(self.buffer).encode("utf-8")
+            self.writeAll(data)
+            self.serializedBytes += len(data)
+            self.buffer = []
+            self.bufferSize = 0
+
+    def write(self, text):
+        self.flushPending()
+        self.buffer.append(text)
+        self.bufferSize += len(text)
+        if self.bufferSize >= WRITE_BUFFER:
+            self.flushBuffer()
+
+    def copy(self, source, start, end):
+        if self.pending is not None:
+            pendingSource, pendingStart, pendingEnd = self.pending
+            if pendingSource is source and pendingEnd == start:
+                self.pending = (source, pendingStart, end)
+                return
+            self.flushPending()
+        self.flushBuffer()
+        self.pending = (source, start, end)
+
+    def flushPending(self):
+        if self.pending is None:
+            return
+        source, start, end = self.pending
+        self.pending = None
+        self.copyRange(source, start, end)
+        self.copiedBytes += end - start
+        if source.data[end - 1:end] != b"\n":
+            self.writeAll(b"\n")
+
+    def copyRange(self, source, start, end):
+        while start < end and (self.useCopyFileRange or self.useSendfile):
+            try:
+                if self.useCopyFileRange:
+                    copied = os.copy_file_range(source.fileno(), self.fd, end - start, start)
+                else:
+                    copied = os.sendfile(self.fd, source.fileno(), start, end - start)
+            except OSError:
+                # Not supported for these files, use the next method
+                if self.useCopyFileRange:
+                    self.useCopyFileRange = False
+                else:
+                    self.useSendfile = False
+                continue
+            if copied == 0:
+                break
+            start += copied
+        if start < end:
+            self.writeAll(source.data[start:end])
+
+    def close(self):
+        try:
+            self.flushPending()
+            self.flushBuffer()
+        finally:
+            os.close(self.fd)
+
+# Writes blocks to outPath as they are produced
+# Unmodified blocks are copied from their source, the others serialized.
+# The file is written next to outPath and renamed at the end, so outPath
+# can be one of the sources
+def writeBlocks(outPath, blocks):
+    tmpPath = outPath + ".tmp"
+    writer = BlockWriter(tmpPath)
+    try:
+        for block in blocks:
+            if block.isUnmodified():
+                writer.copy(block.source, block.start, block.end)
+            else:
+                writer.write(block.toString() + "\n")
+    finally:
+        writer.close()
+    os.replace(tmpPath, outPath)
+    log.info("Wrote {}: {:.1f} MB copied, {:.1f} MB serialized".format(
+        outPath, writer.copiedBytes / (1024.0 * 1024.0),
+        writer.serializedBytes / (1024.0 * 1024.0)))
+    return writer
 
 # Represents the entire parsed scenefile
 class SceneDocument():
@@ -118,39 +519,13 @@ class SceneDocument():
         self.blocks = []
 
     def parse(self, filepath):
-        f = open(filepath, "r")
-
-        sceneBlocks = []
-        currentBlock = []
-
-        for line in f:
-            line = line[:-1]
-            if lineIndentTabs(line) > 0:
-                currentBlock.append(line)
-            else:
-                # Collect previous block
-                if len(currentBlock) > 0:
-                    sceneBlocks.append(SceneBlock(currentBlock))
-                # Start a new block
-                currentBlock = []
-                currentBlock.append(line)
-
-        # Collect last block
-        if len(currentBlock) > 0:
-            sceneBlocks.append(SceneBlock(currentBlock))
-
-        f.close()
-
-        self.blocks = sceneBlocks
+        self.blocks = list(iterBlocks(filepath))
 
     def getBlocks(self):
         return self.blocks
 
     def write(self, outPath):
-        outFile = open(outPath, 'w')
-        for block in self.blocks:
-            outFile.write("{}\n".format(block.toString()))
-        outFile.close()
+        writeBlocks(outPath, self.blocks)
 
     def addBlocksBeginning(self, newBlocks):
         self.blocks = newBlocks + self.blocks
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import re
+
+import generalUtil
+import sceneParser
+
+log = generalUtil.getLogger(__name__)
+
+# Scene parts ==================================================================
+# The scene file only includes one file per part of the scene, so that an
+# edit rewrites the parts it touches. Every part is written with the
+# fingerprint of what it was generated from, and a part whose fingerprint
+# did not change since the last render is left as it is. The fingerprints
+# are kept in a manifest in the output directory.
+# A camera batch writes one camera part and one scene file per camera,
+# all including the same environment, materials and geometry parts
+
+MANIFEST_NAME = "scene_parts.json"
+MANIFEST_VERSION = 1
+
+CAMERA_NAME = "camera.pbrt"
+ENVIRONMENT_NAME = "world_env.pbrt"
+MATERIALS_NAME = "materials.pbrt"
+GEOMETRY_NAME = "geometry.pbrt"
+
+# Lines of the scene file rendered from camera part cameraName
+def sceneLines(cameraName=CAMERA_NAME):
+    return [
+        'Include "{}"'.format(cameraName),
+        "WorldBegin",
+        'Include "{}"'.format(ENVIRONMENT_NAME),
+        'Include "{}"'.format(MATERIALS_NAME),
+        'Include "{}"'.format(GEOMETRY_NAME),
+        "WorldEnd"
+    ]
+
+# Camera batches ---------------------------------------------------------------
+
+UNSAFE_CHARS = re.compile(r"[^A-Za-z0-9_.-]")
+
+# File name stems for the cameras of a batch, in the same order
+# Characters that do not belong in file names are replaced, and stems that
+# end up the same are numbered
+def batchStems(cameraNames):
+    stems = []
+    used = set()
+    for name in cameraNames:
+        stem = UNSAFE_CHARS.sub("_", name)
+        unique = stem
+        n = 1
+        while unique.lower() in used:
+            n += 1
+            unique = "{}_{}".format(stem, n)
+        used.add(unique.lower())
+        stems.append(unique)
+    return stems
+
+def batchCameraName(stem):
+    return "camera_{}.pbrt".format(stem)
+
+def batchSceneName(stem):
+    return "scene_{}.pbrt".format(stem)
+
+def batchImageName(stem):
+    return "scene_{}.exr".format(stem)
+
+# Fingerprints ------------------------------------------------------------------
+
+def blocksFingerprint(blocks):
+    h = hashlib.sha1()
+    for block in blocks:
+        h.update(block.toString().encode("utf-8"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+def fileFingerprint(path):
+    h = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if len(chunk) == 0:
+                break
+            h.update(chunk)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+class SceneParts():
+
+    def __init__(self, outDir):
+        self.outDir = outDir
+        self.fingerprints = {}
+        self.written = []
+        self.kept = []
+
+    def manifestPath(self):
+        return os.path.join(self.outDir, MANIFEST_NAME)
+
+    def load(self):
+        path = self.manifestPath()
+        if not os.path.exists(path):
+            return
+        try:
+            f = open(path, "r")
+            manifest = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            log.warning("Ignoring unreadable scene parts manifest")
+            return
+        if manifest.get("version") == MANIFEST_VERSION:
+            self.fingerprints = manifest.get("fingerprints", {})
+
+    # Writes part name with the blocks returned by createBlocks(), unless
+    # it was written from the same fingerprint before
+    # Returns True if the part was written
+    def write(self, name, fingerprint, createBlocks):
+        path = os.path.join(self.outDir, name)
+        if self.fingerprints.get(name) == fingerprint and os.path.exists(path):
+            self.kept.append(name)
+            return False
+        # A part interrupted while written is written again next time
+        if self.fingerprints.pop(name, None) is not None:
+            self.saveManifest()
+        sceneParser.writeBlocks(path, createBlocks())
+        self.fingerprints[name] = fingerprint
+        self.written.append(name)
+        return True
+
+    # Writes the scene file including the parts, rendered from camera part
+    # cameraName
+    def writeScene(self, scenePath, cameraName=CAMERA_NAME):
+        block = sceneParser.SceneBlock([])
+        for line in sceneLines(cameraName):
+            block.appendLine(0, line)
+        self.write(os.path.basename(scenePath), blocksFingerprint([block]), lambda: [block])
+
+    def saveManifest(self):
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "fingerprints": self.fingerprints
+        }
+        f = open(self.manifestPath(), "w")
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.close()
+
+    def save(self):
+        self.saveManifest()
+        log.info("Scene parts: wrote {}, kept {}".format(
+            ", ".join(self.written) or "none", ", ".join(self.kept) or "none"))
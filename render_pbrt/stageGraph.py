@@ -0,0 +1,155 @@
+import collections
+import concurrent.futures
+import threading
+import time
+
+import generalUtil
+import processManager
+
+log = generalUtil.getLogger(__name__)
+
+# Stage graph ==================================================================
+# Runs the export as stages with dependencies. A stage starts once the
+# stages it depends on are done, so independent stages overlap. The Blender
+# API is not thread safe: stages that use it run one at a time on the
+# calling thread, the others on worker threads. When a stage fails, or
+# stopRequested() returns True, no further stage starts, and cancelled()
+# tells the running ones to stop. stopRequested() is only called on the
+# calling thread, while it waits for the workers.
+
+POLL_SECONDS = 0.1
+
+class Stage():
+
+    def __init__(self, name, fn, deps, mainThread):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.mainThread = mainThread
+        self.result = None
+        self.start = None
+        self.end = None
+        # Main thread stage that ran before this one
+        self.previous = None
+
+    def seconds(self):
+        return self.end - self.start
+
+class StageGraph():
+
+    def __init__(self, maxWorkers=4, stopRequested=None):
+        self.stages = collections.OrderedDict()
+        self.maxWorkers = maxWorkers
+        self.stopRequested = stopRequested
+        self.failed = threading.Event()
+        self.startTime = None
+        self.endTime = None
+
+    # Adds stage name, which calls fn() once the stages in deps are done
+    # Stages that use the Blender API need mainThread
+    def add(self, name, fn, deps=(), mainThread=False):
+        for dep in deps:
+            if dep not in self.stages:
+                raise Exception("Stage {} depends on unknown stage {}".format(name, dep))
+        self.stages[name] = Stage(name, fn, deps, mainThread)
+
+    # Returns the value returned by the function of stage name
+    def result(self, name):
+        return self.stages[name].result
+
+    # True once a stage failed, for stages that can stop early
+    def cancelled(self):
+        return self.failed.is_set()
+
+    def runStage(self, stage):
+        stage.start = time.time() - self.startTime
+        try:
+            stage.result = stage.fn()
+        finally:
+            stage.end = time.time() - self.startTime
+
+    # Runs all stages
+    # Raises the exception of the first stage that failed, or
+    # processManager.ProcessCancelled when stopRequested() returned True
+    def run(self):
+        self.startTime = time.time()
+        pending = list(self.stages.values())
+        done = set()
+        running = {}
+        lastMain = None
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.maxWorkers)
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                ready = [s for s in pending if all(d in done for d in s.deps)]
+                for stage in ready:
+                    if not stage.mainThread:
+                        pending.remove(stage)
+                        running[pool.submit(self.runStage, stage)] = stage
+
+                mainReady = [s for s in ready if s.mainThread]
+                if len(mainReady) > 0:
+                    stage = mainReady[0]
+                    pending.remove(stage)
+                    stage.previous = lastMain
+                    lastMain = stage
+                    self.runStage(stage)
+                    done.add(stage.name)
+                    continue
+
+                if len(running) == 0:
+                    raise Exception("Stages {} wait on each other".format(
+                        ", ".join(s.name for s in pending)))
+                finished, notFinished = concurrent.futures.wait(
+                    list(running.keys()), timeout=POLL_SECONDS,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                if self.stopRequested is not None and self.stopRequested():
+                    # Running stages stop before the pool shuts down
+                    raise processManager.ProcessCancelled("Export cancelled")
+                for future in finished:
+                    stage = running.pop(future)
+                    future.result()
+                    done.add(stage.name)
+        except:
+            self.failed.set()
+            raise
+        finally:
+            pool.shutdown(wait=True)
+            self.endTime = time.time() - self.startTime
+
+    # Stages that determined the total time, last first: from the stage
+    # that ended last, the dependency or previous main thread stage that
+    # ended last, and so on
+    def criticalPath(self):
+        finished = [s for s in self.stages.values() if s.end is not None]
+        if len(finished) == 0:
+            return []
+        stage = max(finished, key=lambda s: s.end)
+        path = [stage]
+        while True:
+            before = [self.stages[d] for d in stage.deps]
+            if stage.previous is not None:
+                before.append(stage.previous)
+            before = [s for s in before if s.end is not None]
+            if len(before) == 0:
+                break
+            stage = max(before, key=lambda s: s.end)
+            path.append(stage)
+        return path
+
+    # Returns the timings of the stages and the critical path
+    def summary(self):
+        path = self.criticalPath()
+        finished = [s for s in self.stages.values() if s.end is not None]
+        return {
+            "wallSeconds": self.endTime,
+            "serialSeconds": sum(s.seconds() for s in finished),
+            "criticalPath": [s.name for s in reversed(path)],
+            "criticalPathSeconds": sum(s.seconds() for s in path),
+            "stages": [{
+                "name": s.name,
+                "deps": s.deps,
+                "thread": "main" if s.mainThread else "worker",
+                "start": s.start,
+                "seconds": s.seconds()
+            } for s in finished]
+        }
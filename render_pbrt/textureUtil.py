@@ -1,37 +1,489 @@
 import bpy
+import concurrent.futures
+import errno
+import hashlib
+import json
 import os
 import shutil
+import time
 
-globalTextureCounter = 0
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-def makeNewTextureName(extension):
-    global globalTextureCounter
-    globalTextureCounter += 1
-    return "tex_{}{}".format(globalTextureCounter, extension)
+import generalUtil
+import imageIo
+
+log = generalUtil.getLogger(__name__)
+
+# Texture store ================================================================
+# Staged textures are named after their source path, so the same file is
+# staged once per output directory and only recopied when the source
+# changes. Files are hardlinked or reflinked when possible.
+# Staging runs on a thread pool while the scene is generated, and is
+# awaited before the scene file is written.
+# The manifest records source stats and last use for LRU eviction.
+# With a proxy size, images pbrt would load at full size for nothing are
+# replaced by downscaled copies. With normalize, images are resampled to
+# power of two sizes, which pbrt would otherwise do on every scene load,
+# and JPEG and 16 bit PNG files are converted to formats pbrt reads
+# directly. Converted copies are generated by the staging threads and kept
+# until the content of the source changes. JPEG files are converted by
+# Blender on the calling thread, the staging threads only move the copies
+# into place.
+
+MANIFEST_NAME = "texture_store.json"
+MANIFEST_VERSION = 1
+
+DEFAULT_MAX_BYTES = 2048 * 1024 * 1024
+
+# Staging threads, file copies mostly wait on I/O
+DEFAULT_WORKERS = 4
+
+# Source formats that can be converted, and the format of the copies.
+# 8 bit images stay 8 bit sRGB PNG, 16 bit PNG and float images become PFM
+CONVERTED_FORMATS = {".png": ".png", ".jpg": ".png", ".jpeg": ".png", ".exr": ".pfm", ".pfm": ".pfm"}
+
+# Formats only Blender decodes here, converted on the calling thread
+BLENDER_FORMATS = {".jpg", ".jpeg"}
+
+HASH_CHUNK_BYTES = 1024 * 1024
+
+# Linux FICLONE ioctl, copy-on-write clone of a whole file
+FICLONE = 0x40049409
+
+class TextureStore():
+
+    def __init__(self, outDir, maxBytes=DEFAULT_MAX_BYTES, workers=DEFAULT_WORKERS,
+            proxySize=None, normalize=False):
+        self.outDir = outDir
+        self.maxBytes = maxBytes
+        # Longest side of proxy textures, None to stage the originals
+        self.proxySize = proxySize
+        self.normalize = normalize
+        self.entries = {}
+        # (destName, texType) -> texture name declared during this render
+        self.declared = {}
+        # destName -> name of the source texture, the same for its proxies
+        self.sourceNames = {}
+        # destName -> (source path, future) of the staging jobs
+        self.jobs = {}
+        # (source path, type) of the textures added since startRecording()
+        self.recorded = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.startTime = None
+        self.stagedCount = 0
+        self.skippedCount = 0
+        self.stagedBytes = 0
+
+    def manifestPath(self):
+        return os.path.join(self.outDir, MANIFEST_NAME)
+
+    def load(self):
+        path = self.manifestPath()
+        if not os.path.exists(path):
+            return
+        try:
+            f = open(path, "r")
+            manifest = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            log.warning("Ignoring unreadable texture store manifest")
+            return
+        if manifest.get("version") == MANIFEST_VERSION:
+            self.entries = manifest.get("entries", {})
+
+    def save(self):
+        self.evict()
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "entries": self.entries
+        }
+        f = open(self.manifestPath(), "w")
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.close()
+
+    # Schedules the staging of texAbsPath in outDir
+    # Returns the staged file name right away, the file is only
+    # guaranteed to exist after wait()
+    def stage(self, texAbsPath):
+        texAbsPath = os.path.normpath(texAbsPath)
+        baseName = os.path.basename(texAbsPath)
+        stem, ext = os.path.splitext(baseName)
+        pathHash = hashlib.sha1(texAbsPath.encode("utf-8")).hexdigest()[:16]
+        sourceName = "tex_{}".format(pathHash)
+        convertedExt = self.convertedExt(texAbsPath, ext.lower())
+        if convertedExt is not None:
+            destName = "{}_{}{}".format(sourceName, self.conversionTag(), convertedExt)
+        else:
+            destName = sourceName + ext
+
+        if destName not in self.jobs:
+            if self.startTime is None:
+                self.startTime = time.time()
+            entry = self.entries.get(destName)
+            if convertedExt is None:
+                job = self.executor.submit(self.stageFile, texAbsPath, destName, entry)
+            elif ext.lower() in BLENDER_FORMATS and not isStaged(texAbsPath, destName, self.outDir, entry):
+                converted = os.path.join(self.outDir, destName + ".tmp")
+                try:
+                    convertBlenderTexture(texAbsPath, converted, self.proxySize, self.normalize)
+                    job = self.executor.submit(self.stageConverted, texAbsPath, destName, entry, converted)
+                except Exception as e:
+                    # Reported by wait() like the failures of the staging threads
+                    job = concurrent.futures.Future()
+                    job.set_exception(e)
+            else:
+                job = self.executor.submit(self.stageConverted, texAbsPath, destName, entry)
+            self.jobs[destName] = (texAbsPath, job)
+            self.sourceNames[destName] = sourceName
+        return destName
+
+    # Returns the extension of the converted copy of texAbsPath,
+    # None to stage the file itself
+    def convertedExt(self, texAbsPath, ext):
+        if ext not in CONVERTED_FORMATS:
+            return None
+        if ext in BLENDER_FORMATS:
+            return CONVERTED_FORMATS[ext] if self.normalize else None
+        if not self.normalize and self.proxySize is None:
+            return None
+        # Files that cannot be decoded here are staged as they are
+        if not imageIo.canRead(texAbsPath):
+            return None
+        if ext == ".png" and self.normalize and imageIo.readPngHeader(texAbsPath)[2] == 16:
+            return ".pfm"
+        return CONVERTED_FORMATS[ext]
+
+    # Part of the converted file names that depends on the settings
+    def conversionTag(self):
+        parts = []
+        if self.proxySize is not None:
+            parts.append("{}".format(self.proxySize))
+        if self.normalize:
+            parts.append("pot")
+        return "_".join(parts)
+
+    # Runs on a worker thread
+    # Copies the file unless an identical copy is already staged
+    # Returns (manifest entry, True if the file was copied)
+    def stageFile(self, texAbsPath, destName, entry):
+        destPath = os.path.join(self.outDir, destName)
+        st = os.stat(texAbsPath)
+        copied = False
+        if entry is None \
+                or entry["source"] != texAbsPath \
+                or entry["mtime"] != st.st_mtime \
+                or entry["size"] != st.st_size \
+                or not os.path.exists(destPath):
+            linkOrCopy(texAbsPath, destPath)
+            copied = True
+        newEntry = {
+            "source": texAbsPath,
+            "mtime": st.st_mtime,
+            "size": st.st_size,
+            "lastUsed": time.time()
+        }
+        return newEntry, copied
+
+    # Runs on a worker thread
+    # Writes the converted copy of the file unless the one in outDir was
+    # made from the same content. converted is the copy already written by
+    # Blender, for formats converted on the calling thread
+    # Returns (manifest entry, True if the copy was written)
+    def stageConverted(self, texAbsPath, destName, entry, converted=None):
+        destPath = os.path.join(self.outDir, destName)
+        try:
+            st = os.stat(texAbsPath)
+            exists = os.path.exists(destPath)
+            if isStaged(texAbsPath, destName, self.outDir, entry):
+                digest = entry.get("hash")
+                copied = False
+            else:
+                digest = fileHash(texAbsPath)
+                copied = entry is None or not exists or entry.get("hash") != digest
+                if copied and converted is not None:
+                    # Replaces dest, which may be a hardlink, without writing to it
+                    os.replace(converted, destPath)
+                elif copied:
+                    convertTexture(texAbsPath, destPath, self.proxySize, self.normalize)
+        finally:
+            if converted is not None and os.path.exists(converted):
+                os.remove(converted)
+        newEntry = {
+            "source": texAbsPath,
+            "mtime": st.st_mtime,
+            "size": st.st_size,
+            "hash": digest,
+            "lastUsed": time.time()
+        }
+        return newEntry, copied
+
+    # Waits for all staging jobs
+    # Returns the list of error messages, one per failed texture
+    def wait(self):
+        errors = []
+        for destName in sorted(self.jobs.keys()):
+            texAbsPath, job = self.jobs[destName]
+            try:
+                entry, copied = job.result()
+            except Exception as e:
+                errors.append("Texture {} could not be staged: {}".format(texAbsPath, e))
+                continue
+            self.entries[destName] = entry
+            if copied:
+                self.stagedCount += 1
+                self.stagedBytes += entry["size"]
+            else:
+                self.skippedCount += 1
+        self.executor.shutdown(wait=True)
+
+        elapsed = 0.0
+        if self.startTime is not None:
+            elapsed = time.time() - self.startTime
+        mb = self.stagedBytes / (1024.0 * 1024.0)
+        log.info("Textures: {} staged ({:.1f} MB in {:.2f}s, {:.1f} MB/s), {} unchanged, {} failed".format(
+            self.stagedCount, mb, elapsed, mb / elapsed if elapsed > 0.0 else 0.0,
+            self.skippedCount, len(errors)))
+        return errors
+
+    # Returns (texture name, True if it still has to be declared)
+    def declare(self, destName, texType):
+        key = (destName, texType)
+        if key in self.declared:
+            return self.declared[key], False
+        # Proxies and originals declare the same name, so that blocks
+        # written for one can be used with the other
+        texName = "{}_{}".format(self.sourceNames[destName], texType)
+        self.declared[key] = texName
+        return texName, True
+
+    def startRecording(self):
+        self.recorded = []
+
+    # Returns the textures added since startRecording()
+    def stopRecording(self):
+        recorded = self.recorded
+        self.recorded = None
+        return recorded
+
+    # Deletes least recently used tex_* files not needed by this render
+    # until the staged textures fit in maxBytes
+    def evict(self):
+        candidates = []
+        total = 0
+        for name in os.listdir(self.outDir):
+            if not name.startswith("tex_"):
+                continue
+            size = os.path.getsize(os.path.join(self.outDir, name))
+            total += size
+            if name not in self.jobs:
+                lastUsed = self.entries.get(name, {}).get("lastUsed", 0)
+                candidates.append((lastUsed, name, size))
+        candidates.sort()
+        for lastUsed, name, size in candidates:
+            if total <= self.maxBytes:
+                break
+            os.remove(os.path.join(self.outDir, name))
+            self.entries.pop(name, None)
+            total -= size
+
+def fileHash(path):
+    h = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+        while True:
+            chunk = f.read(HASH_CHUNK_BYTES)
+            if len(chunk) == 0:
+                break
+            h.update(chunk)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+# True if the copy destName of texAbsPath in outDir is up to date
+# according to its manifest entry
+def isStaged(texAbsPath, destName, outDir, entry):
+    if entry is None or not os.path.exists(os.path.join(outDir, destName)):
+        return False
+    try:
+        st = os.stat(texAbsPath)
+    except OSError:
+        return False
+    return entry["source"] == texAbsPath \
+        and entry["mtime"] == st.st_mtime \
+        and entry["size"] == st.st_size
+
+def roundUpPow2(n):
+    p = 1
+    while p < n:
+        p *= 2
+    return p
+
+def roundDownPow2(n):
+    p = 1
+    while p * 2 <= n:
+        p *= 2
+    return p
+
+# Size of the converted copy of a width by height image: the longest side
+# at most maxSize, and power of two sides as pbrt would resample them
+def convertedDimensions(width, height, maxSize, powerOfTwo):
+    if maxSize is not None and max(width, height) > maxSize:
+        scale = maxSize / float(max(width, height))
+        width = max(1, int(round(width * scale)))
+        height = max(1, int(round(height * scale)))
+    if powerOfTwo:
+        width = roundUpPow2(width)
+        height = roundUpPow2(height)
+        if maxSize is not None:
+            width = min(width, roundDownPow2(maxSize))
+            height = min(height, roundDownPow2(maxSize))
+    return width, height
+
+# Writes the converted copy of an image only Blender decodes to dest as
+# a PNG, resized as convertTexture would. Uses the Blender API, so it runs
+# on the calling thread, but decoding, resizing and encoding are native
+def convertBlenderTexture(source, dest, maxSize, powerOfTwo):
+    # A separate image, the ones of the blend file are left as they are
+    image = bpy.data.images.load(source, check_existing=False)
+    try:
+        width, height = image.size
+        newWidth, newHeight = convertedDimensions(width, height, maxSize, powerOfTwo)
+        if (newWidth, newHeight) != (width, height):
+            image.scale(newWidth, newHeight)
+        image.filepath_raw = dest
+        image.file_format = "PNG"
+        image.save()
+    finally:
+        bpy.data.images.remove(image)
+
+# Writes the converted copy of the image at source to dest, its format
+# given by the extension of dest
+# The size is read from the header first, images that need no
+# conversion are linked or copied unchanged without being decoded
+def convertTexture(source, dest, maxSize, powerOfTwo):
+    # dest may be a hardlink to an earlier version of source
+    if os.path.lexists(dest):
+        os.remove(dest)
+    sourceExt = os.path.splitext(source)[1].lower()
+    sameFormat = sourceExt == os.path.splitext(dest)[1].lower()
+    width, height = imageIo.readDimensions(source)
+    newWidth, newHeight = convertedDimensions(width, height, maxSize, powerOfTwo)
+    if (newWidth, newHeight) == (width, height) and sameFormat:
+        linkOrCopy(source, dest)
+        return
+
+    convert = None
+    if sourceExt == ".png":
+        values, depth = imageIo.decodePng(source)
+        convert = lambda strip: imageIo.pngToLinear(strip, depth)
+    else:
+        values = imageIo.readImage(source)
+    channels = values.shape[2]
+    pixels = imageIo.resize(values, newWidth, newHeight, convert)
+    if dest.endswith(".png"):
+        imageIo.writePng(dest, pixels)
+    else:
+        imageIo.writePfm(dest, pixels[:, :, :3] if channels >= 3 else pixels[:, :, :1])
+
+# Hardlinks, reflinks or copies source to dest, in order of preference
+def linkOrCopy(source, dest):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+        return
+    except OSError:
+        pass
+    if fcntl is None:
+        shutil.copyfile(source, dest)
+        return
+    try:
+        src = open(source, "rb")
+        dst = open(dest, "wb")
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        finally:
+            src.close()
+            dst.close()
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EBADF):
+            raise
+    shutil.copyfile(source, dest)
+
+# Module level store, one per render
+globalTextureStore = None
+
+# Textures larger than proxySize are replaced by downscaled copies,
+# None stages the original files. normalize resamples textures to power
+# of two sizes and converts JPEG and 16 bit PNG files
+def beginTextures(outDir, maxBytes=DEFAULT_MAX_BYTES, proxySize=None, normalize=False):
+    global globalTextureStore
+    if globalTextureStore is not None:
+        globalTextureStore.executor.shutdown(wait=False)
+    globalTextureStore = TextureStore(outDir, maxBytes, proxySize=proxySize, normalize=normalize)
+    globalTextureStore.load()
+
+# Waits for the staging jobs of the current render
+# Returns the list of error messages
+def waitTextures():
+    if globalTextureStore is None:
+        return []
+    return globalTextureStore.wait()
+
+def endTextures():
+    global globalTextureStore
+    if globalTextureStore is not None:
+        globalTextureStore.save()
+    globalTextureStore = None
+
+# Stores opened next to the one of the render, by output directory
+openStores = {}
+
+# Opens a store for outDir that does not replace the one of the render
+def openTextureStore(outDir, maxBytes=DEFAULT_MAX_BYTES, proxySize=None, normalize=False):
+    store = TextureStore(outDir, maxBytes, proxySize=proxySize, normalize=normalize)
+    store.load()
+    openStores[outDir] = store
+    return store
+
+# Saves the manifest of a store from openTextureStore, once it was waited
+def closeTextureStore(store):
+    store.save()
+    if openStores.get(store.outDir) is store:
+        del openStores[store.outDir]
+
+def getTextureStore(outDir):
+    if outDir in openStores:
+        return openStores[outDir]
+    if globalTextureStore is None or globalTextureStore.outDir != outDir:
+        beginTextures(outDir)
+    return globalTextureStore
 
 def addTexture(texSource, outDir, block, texType="color"):
-    texAbsPath = bpy.path.abspath(texSource)
-    baseName = os.path.basename(texAbsPath)
-    stem, ext = os.path.splitext(baseName)
-    destName = makeNewTextureName(ext)
-    destPath = os.path.join(outDir, destName)
-    shutil.copyfile(texAbsPath, destPath)
+    return addTextureFile(bpy.path.abspath(texSource), outDir, block, texType)
+
+# Stages the texture at texAbsPath and declares it at the beginning of
+# block, unless it was already declared during this render
+# Returns the texture name
+def addTextureFile(texAbsPath, outDir, block, texType="color"):
+    store = getTextureStore(outDir)
+    if store.recorded is not None:
+        store.recorded.append((texAbsPath, texType))
+    destName = store.stage(texAbsPath)
+    texName, isNew = store.declare(destName, texType)
     # Add the texture to the block
-    textureLine = 'Texture "{}" "{}" "imagemap" "string filename" "{}"'.format(
-        destName, texType, destName
-    )
-    block.addBeginning(0, textureLine)
-    return destName
+    if isNew:
+        textureLine = 'Texture "{}" "{}" "imagemap" "string filename" "{}"'.format(
+            texName, texType, destName
+        )
+        block.addBeginning(0, textureLine)
+    return texName
 
 def copyTexture(texSource, outDir):
+    store = getTextureStore(outDir)
     texAbsPath = bpy.path.abspath(texSource)
-    baseName = os.path.basename(texAbsPath)
-    stem, ext = os.path.splitext(baseName)
-    destName = makeNewTextureName(ext)
-    destPath = os.path.join(outDir, destName)
-    shutil.copyfile(texAbsPath, destPath)
-    return destName
-
-def resetTextureCounter():
-    global globalTextureCounter
-    globalTextureCounter = 0
\ No newline at end of file
+    return store.stage(texAbsPath)
@@ -0,0 +1,172 @@
+import numpy as np
+import os
+import shlex
+import subprocess
+import time
+
+import generalUtil
+import imageIo
+import processManager
+
+log = generalUtil.getLogger(__name__)
+
+# Tiled render =================================================================
+# Splits the film in cropwindow tiles and renders each tile in its own pbrt
+# process, then merges the tile images with NumPy. Processes are started by
+# an executor, which provides the worker slots: LocalExecutor runs them on
+# this machine, SshExecutor on remote hosts that see the output directory
+# and the pbrt executable at the same paths. Any object with a list of
+# slots and a start method can be used.
+
+POLL_SECONDS = 0.05
+LOG_TAIL_BYTES = 2048
+
+class Tile():
+
+    def __init__(self, index, x0, x1, y0, y1, sx, sy):
+        self.index = index
+        self.x0 = x0
+        self.x1 = x1
+        self.y0 = y0
+        self.y1 = y1
+        self.sx = sx
+        self.sy = sy
+
+    # pbrt rounds the crop window up to pixel bounds, so the window starts
+    # half a pixel before the tile edges
+    def cropWindow(self):
+        return [
+            max(0.0, (self.x0 - 0.5) / self.sx),
+            (self.x1 - 0.5) / self.sx,
+            max(0.0, (self.y0 - 0.5) / self.sy),
+            (self.y1 - 0.5) / self.sy
+        ]
+
+# Returns the tiles of a sx by sy film, in rows from the top
+def splitTiles(sx, sy, tileSize):
+    tileSize = max(tileSize, 1)
+    tiles = []
+    for y0 in range(0, sy, tileSize):
+        for x0 in range(0, sx, tileSize):
+            tiles.append(Tile(len(tiles), x0, min(x0 + tileSize, sx),
+                y0, min(y0 + tileSize, sy), sx, sy))
+    return tiles
+
+# Executors ====================================================================
+
+class LocalExecutor():
+
+    def __init__(self, workers):
+        self.slots = ["localhost"] * max(workers, 1)
+
+    # Starts cmd in cwd, with its output going to logFile
+    # Returns the Popen
+    def start(self, slot, cmd, cwd, logFile):
+        return processManager.startProcess(cmd, cwd, None, logFile, subprocess.STDOUT)
+
+class SshExecutor():
+
+    def __init__(self, hosts, workersPerHost):
+        self.slots = [host for host in hosts for i in range(max(workersPerHost, 1))]
+
+    # The remote command gets a terminal (-tt), so that when the local ssh
+    # is killed on cancel, the remote pbrt is hung up instead of running on
+    def start(self, slot, cmd, cwd, logFile):
+        remote = "cd {} && exec {}".format(shlex.quote(cwd), " ".join(shlex.quote(a) for a in cmd))
+        return processManager.startProcess(["ssh", "-tt", "-o", "BatchMode=yes", slot, remote],
+            None, None, logFile, subprocess.STDOUT)
+
+# Scheduler ====================================================================
+
+def logTail(path):
+    try:
+        f = open(path, "rb")
+        f.seek(max(os.path.getsize(path) - LOG_TAIL_BYTES, 0))
+        tail = f.read().decode("utf-8", "replace")
+        f.close()
+        return tail
+    except (IOError, OSError):
+        return ""
+
+def tileCommand(pbrtPath, scenePath, tile, outPath, threads):
+    cmd = [pbrtPath, "--nthreads", "{}".format(threads), "--cropwindow"]
+    cmd.extend(repr(v) for v in tile.cropWindow())
+    cmd.extend(["--outfile", outPath, scenePath])
+    return cmd
+
+# Renders scenePath tile by tile and merges the tiles into outPath
+# At most one tile runs on each executor slot, with threads pbrt threads.
+# progress(fraction) and onTile(tile, pixels) are called when a tile is
+# done, and the render stops when cancelled() returns True
+# Raises processManager.ProcessCancelled if cancelled
+# Returns the merged image
+def renderTiles(pbrtPath, scenePath, outPath, sx, sy, tileSize, executor, threads,
+        progress=None, cancelled=None, onTile=None):
+    workDir = os.path.dirname(os.path.abspath(scenePath))
+    base = os.path.splitext(os.path.basename(scenePath))[0]
+    tiles = splitTiles(sx, sy, tileSize)
+    log.info("Rendering {} tiles of {} on {} workers".format(len(tiles), scenePath, len(executor.slots)))
+
+    def tilePath(tile, ext):
+        return os.path.join(workDir, "{}_tile_{:03d}{}".format(base, tile.index, ext))
+
+    image = np.zeros((sy, sx, 3), dtype=np.float32)
+    pending = list(reversed(tiles))
+    freeSlots = list(reversed(range(len(executor.slots))))
+    # Slot index -> (tile, process, log file)
+    running = {}
+    done = 0
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            if cancelled is not None and cancelled():
+                raise processManager.ProcessCancelled("Tiled render cancelled")
+
+            while len(pending) > 0 and len(freeSlots) > 0:
+                slotIndex = freeSlots.pop()
+                tile = pending.pop()
+                cmd = tileCommand(pbrtPath, scenePath, tile, tilePath(tile, ".pfm"), threads)
+                logFile = open(tilePath(tile, ".log"), "wb")
+                try:
+                    proc = executor.start(executor.slots[slotIndex], cmd, workDir, logFile)
+                except OSError:
+                    logFile.close()
+                    raise
+                running[slotIndex] = (tile, proc, logFile)
+                log.debug("Tile {} on {}: {}".format(tile.index, executor.slots[slotIndex], " ".join(cmd)))
+
+            finished = False
+            for slotIndex, (tile, proc, logFile) in list(running.items()):
+                status = proc.poll()
+                if status is None:
+                    continue
+                logFile.close()
+                del running[slotIndex]
+                freeSlots.append(slotIndex)
+                finished = True
+                if status != 0:
+                    raise Exception("Tile {} failed with exit status {}\n{}".format(
+                        tile.index, status, logTail(tilePath(tile, ".log"))))
+
+                pixels = imageIo.readPfm(tilePath(tile, ".pfm"))
+                if pixels.shape[:2] != (tile.y1 - tile.y0, tile.x1 - tile.x0):
+                    raise Exception("Tile {} is {}x{}, expected {}x{}".format(tile.index,
+                        pixels.shape[1], pixels.shape[0], tile.x1 - tile.x0, tile.y1 - tile.y0))
+                image[tile.y0:tile.y1, tile.x0:tile.x1] = pixels[:, :, :3]
+                os.remove(tilePath(tile, ".pfm"))
+                os.remove(tilePath(tile, ".log"))
+                done += 1
+                if onTile is not None:
+                    onTile(tile, image[tile.y0:tile.y1, tile.x0:tile.x1])
+                if progress is not None:
+                    progress(float(done) / len(tiles))
+
+            if not finished:
+                time.sleep(POLL_SECONDS)
+    finally:
+        for tile, proc, logFile in running.values():
+            processManager.killTree(proc)
+            logFile.close()
+
+    imageIo.writePfm(outPath, image)
+    log.info("Merged {} tiles into {}".format(len(tiles), outPath))
+    return image
@@ -0,0 +1,166 @@
+import bpy
+import json
+import mmap
+import os
+import shutil
+import tempfile
+
+import generalUtil
+
+log = generalUtil.getLogger(__name__)
+
+# Toolchain discovery ==========================================================
+# Executables are looked up in the build directories and then in PATH
+# without running them. Version and capabilities are read from the strings
+# embedded in the binary, once per executable: the results are cached in
+# toolchain_cache.json by path, and reused while size and mtime match.
+# The cache is kept in the Blender user configuration, as the add-on
+# directory is read-only for system-wide installs
+
+CACHE_NAME = "toolchain_cache.json"
+CACHE_VERSION = 1
+
+# Returns the path of the cache, in the temp directory when the user
+# configuration cannot be created
+def defaultCachePath():
+    try:
+        cacheDir = bpy.utils.user_resource("CONFIG", "pbrt_exporter", create=True)
+    except (IOError, OSError):
+        cacheDir = ""
+    if cacheDir == "":
+        cacheDir = tempfile.gettempdir()
+    return os.path.join(cacheDir, CACHE_NAME)
+
+# Capability -> string found in executables that have it
+CAPABILITY_MARKERS = {
+    "iispt": b"iispt",
+    "bdpt": b"bdpt",
+    "toply": b"toply"
+}
+
+# pbrt prints "pbrt version 3 (built ...)" at startup
+VERSION_MARKER = b"pbrt version"
+VERSION_MAX_LENGTH = 80
+
+class ToolInfo():
+
+    def __init__(self, path, mtime, size, version=None, capabilities=None):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.version = version
+        self.capabilities = [] if capabilities is None else capabilities
+
+    def hasCapability(self, name):
+        return name in self.capabilities
+
+    def toDict(self):
+        return {
+            "mtime": self.mtime,
+            "size": self.size,
+            "version": self.version,
+            "capabilities": self.capabilities
+        }
+
+# Reads version and capabilities from the strings of an executable
+# Returns (version or None, list of capabilities)
+def scanExecutable(path):
+    f = open(path, "rb")
+    try:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return None, []
+        try:
+            capabilities = sorted(name for name, marker in CAPABILITY_MARKERS.items()
+                if data.find(marker) >= 0)
+            version = None
+            start = data.find(VERSION_MARKER)
+            if start >= 0:
+                raw = data[start:start + VERSION_MAX_LENGTH].split(b"\0", 1)[0]
+                version = raw.split(b"\n", 1)[0].decode("ascii", "replace").strip()
+        finally:
+            data.close()
+    finally:
+        f.close()
+    return version, capabilities
+
+# Returns the absolute path of execName in one of dirs, or in PATH when
+# usePath is set, or None
+def findExecutable(dirs, execName, usePath=True):
+    for d in dirs:
+        if d is None or d == "":
+            continue
+        candidate = os.path.join(d, execName)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return os.path.abspath(candidate)
+    if not usePath:
+        return None
+    found = shutil.which(execName)
+    if found is None:
+        return None
+    return os.path.abspath(found)
+
+class Toolchain():
+
+    def __init__(self, cachePath=None):
+        self.cachePath = defaultCachePath() if cachePath is None else cachePath
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.cachePath):
+            return
+        try:
+            f = open(self.cachePath, "r")
+            cache = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            log.warning("Ignoring unreadable toolchain cache")
+            return
+        if cache.get("version") == CACHE_VERSION:
+            self.entries = cache.get("entries", {})
+
+    # A cache that cannot be written is only logged
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            f = open(self.cachePath, "w")
+            json.dump({"version": CACHE_VERSION, "entries": self.entries}, f,
+                indent=1, sort_keys=True)
+            f.close()
+            self.dirty = False
+        except (IOError, OSError) as e:
+            log.debug("Toolchain cache not saved: {}".format(e))
+
+    # Returns the ToolInfo of execName found in dirs, or in PATH when
+    # usePath is set, or None
+    # The executable is scanned only if it changed since it was cached
+    def lookup(self, execName, dirs, usePath=True):
+        path = findExecutable(dirs, execName, usePath)
+        if path is None:
+            return None
+        st = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry["mtime"] == st.st_mtime and entry["size"] == st.st_size:
+            return ToolInfo(path, st.st_mtime, st.st_size, entry["version"], entry["capabilities"])
+
+        version, capabilities = scanExecutable(path)
+        info = ToolInfo(path, st.st_mtime, st.st_size, version, capabilities)
+        self.entries[path] = info.toDict()
+        self.dirty = True
+        self.save()
+        log.info("Found {} {} {}".format(execName, path, version or ""))
+        return info
+
+# Module level toolchain, loaded on first use
+globalToolchain = None
+
+def getToolchain():
+    global globalToolchain
+    if globalToolchain is None:
+        globalToolchain = Toolchain()
+    return globalToolchain